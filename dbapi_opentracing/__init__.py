@@ -1,2 +1,18 @@
+import sys
+
 from .tracing import ConnectionTracing, Cursor  # noqa
 from .psycopg2_tracing import PsycopgConnectionTracing  # noqa
+from .sampling import TokenBucketSampler, fingerprint_key, verb_table_key  # noqa
+from .errors import StackCapture  # noqa
+from .pool import TracedConnectionPool, PoolError  # noqa
+from .subclass_tracing import SubclassConnectionTracing  # noqa
+from .paging import InsertPaging  # noqa
+from .prepared import AutoPrepare  # noqa
+from .wait_callback import TracedWaitCallback  # noqa
+
+if sys.version_info >= (3, 7):  # contextvars
+    try:
+        from .asyncio_tracing import AsyncConnectionTracing, AsyncCursor, ExecutorConnectionTracing, ExecutorCursor  # noqa
+    except ImportError:  # opentracing < 2.2 has no ContextVarsScopeManager
+        pass
+    from .psycopg_tracing import PsycopgConnectTracing  # noqa
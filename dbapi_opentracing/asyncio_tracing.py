@@ -0,0 +1,565 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import asyncio
+import contextvars
+import inspect
+
+from opentracing.ext import tags
+from opentracing.scope_managers.contextvars import ContextVarsScopeManager
+import wrapt
+
+from .sql import RAW
+from .tracing import (_CONNECTION_FLAG_METHODS, ConnectionTracing, _ConnectionTracing, _Cursor, _SpecializedClasses,
+                      _cursor_flags, _enabled_cursor_flags, _enabled_flags, _is_noop_tracer, _is_unsampled,
+                      _operation_name, _PERF_COUNTER_OFFSET, perf_counter)
+
+try:
+    from asyncio import get_running_loop
+except ImportError:  # py3.6, where the event loop of a coroutine is also the current one
+    from asyncio import get_event_loop as get_running_loop
+
+# Traced methods enabled by each of the _CURSOR_TRACE_FLAGS.  asyncpg connections' fetch(), fetchrow(), and fetchval()
+# are executions whose results are returned directly.
+_ASYNC_CURSOR_FLAG_METHODS = (('execute', 'fetch', 'fetchrow', 'fetchval'), ('executemany',), ('callproc',),
+                              ('fetchone', 'fetchmany', 'fetchall', '__anext__'))
+
+# Traced methods enabled by the connection trace_commit and trace_rollback flags, and connection statement methods
+# of drivers without cursors (asyncpg)
+_ASYNC_CONNECTION_FLAG_METHODS = _CONNECTION_FLAG_METHODS + (('execute', 'executemany', 'fetch', 'fetchrow',
+                                                              'fetchval'),)
+
+# Scope manager of tracers that are not contextvars-based, in which traced executions are activated
+_scope_manager = ContextVarsScopeManager()
+
+
+def _contextvars_scope_manager(tracer, scope_manager):
+    if scope_manager is not None:
+        return scope_manager
+    if isinstance(tracer.scope_manager, ContextVarsScopeManager):
+        return tracer.scope_manager
+    return _scope_manager
+
+
+class _AsyncCursorMethods(object):
+    """Traced AsyncCursor methods, overridden by its classes specialized for their trace flag."""
+
+    async def execute(self, *args, **kwargs):
+        return await self._traced_async_execution(self.__wrapped__.execute, *args, **kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        return await self._traced_async_execution(self.__wrapped__.executemany, *args, **kwargs)
+
+    async def callproc(self, *args, **kwargs):
+        return await self._traced_async_execution(self.__wrapped__.callproc, *args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        return await self._traced_async_execution(self.__wrapped__.fetch, *args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        return await self._traced_async_execution(self.__wrapped__.fetchrow, *args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        return await self._traced_async_execution(self.__wrapped__.fetchval, *args, **kwargs)
+
+    async def fetchone(self):
+        return await self._traced_async_fetch(self.__wrapped__.fetchone)
+
+    async def fetchmany(self, *args, **kwargs):
+        return await self._traced_async_fetch(self.__wrapped__.fetchmany, *args, **kwargs)
+
+    async def fetchall(self):
+        return await self._traced_async_fetch(self.__wrapped__.fetchall)
+
+    async def __anext__(self):
+        fetch = self._self_fetch
+        if fetch is None:
+            return await self.__wrapped__.__anext__()
+
+        start = perf_counter()
+        try:
+            row = await self.__wrapped__.__anext__()
+        except StopAsyncIteration:
+            fetch.fetched(start, 0)
+            if self._self_fetch is fetch:
+                self._finish_fetch()
+            raise
+        fetch.fetched(start, 1)
+        return row
+
+
+class _AsyncIterationProxy(wrapt.ObjectProxy):
+    """Async iteration of wrapped cursors, which wrapt does not forward."""
+    __slots__ = ()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.__wrapped__.__anext__()
+
+
+class _AsyncCursorProxy(_AsyncIterationProxy):
+    """Untraced AsyncCursor methods, which its classes specialized for their trace flags override if traced."""
+    __slots__ = ()
+
+    def execute(self, *args, **kwargs):
+        return self.__wrapped__.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self.__wrapped__.executemany(*args, **kwargs)
+
+    def callproc(self, *args, **kwargs):
+        return self.__wrapped__.callproc(*args, **kwargs)
+
+    def fetchone(self):
+        return self.__wrapped__.fetchone()
+
+    def fetchmany(self, *args, **kwargs):
+        return self.__wrapped__.fetchmany(*args, **kwargs)
+
+    def fetchall(self):
+        return self.__wrapped__.fetchall()
+
+
+_async_cursor_classes = _SpecializedClasses(_AsyncCursorMethods, _ASYNC_CURSOR_FLAG_METHODS, _AsyncCursorProxy)
+
+
+class AsyncCursor(_Cursor, _AsyncCursorProxy):
+    """
+    A wrapper for an asyncio driver cursor (e.g. aiopg or aiomysql) with awaitable traced execute(), executemany(),
+    callproc(), and, with `trace_fetch`, fetch*() methods and async iteration.  Spans are tagged like those of Cursor,
+    and are children of the span active in `scope_manager`, which defaults to the tracer's own if contextvars-based,
+    so that each task's executions have their own parent.
+    """
+    __slots__ = ('_self_config', '_self_fetch', '_self_rowcount', '_self_scope_manager')
+    # Trace flags of specialized subclasses
+    _trace_flags = None
+
+    def __new__(cls, cursor, tracer=None, span_tags=None, trace_execute=True, trace_executemany=True,
+                trace_callproc=True, span_template_cache=None, statement_mode=RAW, sampler=None,
+                slow_query_threshold=None, stack_capture=None, max_statement_length=None, measure_batch_bytes=False,
+                trace_fetch=False, leaf_spans=False, config=None, scope_manager=None, *args, **kwargs):
+        if cls._trace_flags is None:
+            if config is not None:
+                flags = _cursor_flags(config)
+            else:
+                flags = _enabled_cursor_flags(tracer, trace_execute, trace_executemany, trace_callproc, trace_fetch)
+            cls = _async_cursor_classes.get(cls, flags)
+        return wrapt.ObjectProxy.__new__(cls)
+
+    def __init__(self, cursor, tracer=None, span_tags=None, trace_execute=True, trace_executemany=True,
+                 trace_callproc=True, span_template_cache=None, statement_mode=RAW, sampler=None,
+                 slow_query_threshold=None, stack_capture=None, max_statement_length=None, measure_batch_bytes=False,
+                 trace_fetch=False, leaf_spans=False, config=None, scope_manager=None, *args, **kwargs):
+        wrapt.ObjectProxy.__init__(self, cursor)
+        _Cursor.__init__(self, tracer, span_tags, trace_execute, trace_executemany, trace_callproc,
+                         span_template_cache, statement_mode, sampler, slow_query_threshold, stack_capture,
+                         max_statement_length, measure_batch_bytes, trace_fetch, leaf_spans, config=config)
+        self._self_scope_manager = _contextvars_scope_manager(self._self_config.tracer, scope_manager)
+
+    def _get_query(self, args):
+        return self._format_query(args[0])
+
+    def _active_span(self):
+        scope = self._self_scope_manager.active
+        return scope.span if scope is not None else None
+
+    def _start_span(self, template, **kwargs):
+        # The tracer's own active span may be that of another task
+        return self._self_config.tracer.start_span(template.operation_name, child_of=self._active_span(),
+                                                   tags=dict(template.tags), ignore_active_span=True, **kwargs)
+
+    def _set_rows_produced(self, span):
+        # asyncpg connections have no rowcount
+        rowcount = getattr(self.__wrapped__, 'rowcount', None)
+        if rowcount is not None:
+            span.set_tag('db.rows_produced', rowcount)
+
+    async def _traced_async_execution(self, func, *args, **kwargs):
+        self._finish_fetch()
+        if _is_unsampled(self._active_span()):
+            return await func(*args, **kwargs)
+        config = self._self_config
+        dropped = 0
+        if config.sampler is not None:
+            dropped = config.sampler.sample(self._get_sampling_key(args))
+            if dropped is None:
+                return await func(*args, **kwargs)
+
+        args, batch = self._get_batch(func, args)
+        if config.slow_query_threshold is not None:
+            return await self._tail_traced_async_execution(dropped, batch, func, *args, **kwargs)
+
+        template = self._get_span_template(func, args)
+        span = self._start_span(template)
+        if dropped:
+            span.set_tag('db.sampler.dropped', dropped)
+        with self._self_scope_manager.activate(span, True):
+            start = perf_counter()
+            try:
+                val = await func(*args, **kwargs)
+            except Exception as e:
+                config.stack_capture.set_error_tags(span, e)
+                raise
+            finally:
+                if batch is not None:
+                    batch.set_tags(span, perf_counter() - start)
+            self._set_rows_produced(span)
+        self._start_fetch(func, span, template, perf_counter())
+        return val
+
+    async def _tail_traced_async_execution(self, dropped, batch, func, *args, **kwargs):
+        """
+        Await function and only create its span afterwards if it failed, was slow, or has a parent that its tracer
+        doesn't report as unsampled.
+        """
+        start = perf_counter()
+        try:
+            val = await func(*args, **kwargs)
+        except Exception as e:
+            finish = perf_counter()
+            span, _ = self._finished_span(func, args, start, dropped)
+            self._self_config.stack_capture.set_error_tags(span, e)
+            if batch is not None:
+                batch.set_tags(span, finish - start)
+            span.finish(finish_time=finish + _PERF_COUNTER_OFFSET)
+            raise
+        finish = perf_counter()
+
+        if finish - start < self._self_config.slow_query_threshold:
+            active_span = self._active_span()
+            if active_span is None or _is_unsampled(active_span):
+                return val
+
+        span, template = self._finished_span(func, args, start, dropped)
+        if batch is not None:
+            batch.set_tags(span, finish - start)
+        self._set_rows_produced(span)
+        span.finish(finish_time=finish + _PERF_COUNTER_OFFSET)
+        self._start_fetch(func, span, template, finish)
+        return val
+
+    async def _traced_async_fetch(self, func, *args, **kwargs):
+        """Await fetch*() function, aggregating its rows into the fetch span of the last traced execution"""
+        fetch = self._self_fetch
+        if fetch is None:
+            return await func(*args, **kwargs)
+
+        start = perf_counter()
+        rows = await func(*args, **kwargs)
+        self._fetched(fetch, func, start, rows)
+        return rows
+
+    def close(self):
+        # aiopg cursors close synchronously, and aiomysql ones return a coroutine
+        self._finish_fetch()
+        return self.__wrapped__.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc, value, tb):
+        closed = self.close()
+        if inspect.isawaitable(closed):
+            await closed
+
+
+class _CursorContext(object):
+    """
+    Result of AsyncConnectionTracing and ExecutorConnectionTracing cursor(), to be awaited or used with `async with`
+    like aiopg and aiomysql's.
+    """
+    __slots__ = ('_coro', '_cursor')
+
+    def __init__(self, coro):
+        self._coro = coro
+        self._cursor = None
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self):
+        self._cursor = await self._coro
+        return self._cursor
+
+    async def __aexit__(self, exc, value, tb):
+        await self._cursor.__aexit__(exc, value, tb)
+
+
+class _AsyncConnectionMethods(object):
+    """Traced AsyncConnectionTracing methods, overridden by its classes specialized for their trace flag."""
+
+    async def commit(self):
+        return await self._traced_async_execution(self._self_commit_operation_name, self.__wrapped__.commit)
+
+    async def rollback(self):
+        return await self._traced_async_execution(self._self_rollback_operation_name, self.__wrapped__.rollback)
+
+    def execute(self, *args, **kwargs):
+        return self._self_statements.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._self_statements.executemany(*args, **kwargs)
+
+    def fetch(self, *args, **kwargs):
+        return self._self_statements.fetch(*args, **kwargs)
+
+    def fetchrow(self, *args, **kwargs):
+        return self._self_statements.fetchrow(*args, **kwargs)
+
+    def fetchval(self, *args, **kwargs):
+        return self._self_statements.fetchval(*args, **kwargs)
+
+
+class _AsyncConnectionProxy(wrapt.ObjectProxy):
+    """
+    Untraced AsyncConnectionTracing methods, which its classes specialized for their trace flags override if traced.
+    """
+
+    def commit(self):
+        return self.__wrapped__.commit()
+
+    def rollback(self):
+        return self.__wrapped__.rollback()
+
+
+_async_connection_tracing_classes = _SpecializedClasses(_AsyncConnectionMethods, _ASYNC_CONNECTION_FLAG_METHODS,
+                                                        _AsyncConnectionProxy)
+
+
+class AsyncConnectionTracing(_ConnectionTracing, _AsyncConnectionProxy):
+    """
+    A wrapper for asyncio driver connections with awaitable traced commit() and rollback() methods, whose cursor()
+    provides AsyncCursor wrappers when awaited or used with `async with` (e.g. aiopg and aiomysql).  Connections
+    without cursors that execute statements themselves (asyncpg) have traced execute(), executemany(), fetch(),
+    fetchrow(), and fetchval() methods instead, while their cursor() is not traced.
+
+    Spans are children of the span active in `scope_manager`, which defaults to the tracer's own if contextvars-based
+    (e.g. ContextVarsScopeManager), and to a separate ContextVarsScopeManager otherwise.
+
+    connection = AsyncConnectionTracing(await aiopg.connect(dsn), tracer)
+    async with connection.cursor() as cursor:
+        await cursor.execute('SELECT 1')
+    """
+    # Trace flags of specialized subclasses
+    _trace_flags = None
+
+    def __new__(cls, connection, tracer=None, span_tags=None, trace_commit=True, trace_rollback=True, *args, **kwargs):
+        if cls._trace_flags is None:
+            flags = _enabled_flags(tracer, trace_commit, trace_rollback) + (hasattr(connection, 'fetchrow'),)
+            cls = _async_connection_tracing_classes.get(cls, flags)
+        return wrapt.ObjectProxy.__new__(cls)
+
+    def __init__(self, connection, tracer=None, span_tags=None, trace_commit=True, trace_rollback=True,
+                 trace_execute=True, trace_executemany=True, trace_callproc=True, span_template_cache_size=128,
+                 statement_mode=RAW, sampler=None, slow_query_threshold=None, stack_capture=None,
+                 max_statement_length=None, measure_batch_bytes=False, trace_fetch=False, leaf_spans=False,
+                 scope_manager=None, *args, **kwargs):
+        wrapt.ObjectProxy.__init__(self, connection)
+        _ConnectionTracing.__init__(self, tracer, span_tags, trace_commit, trace_rollback, trace_execute,
+                                    trace_executemany, trace_callproc, span_template_cache_size, statement_mode,
+                                    sampler, slow_query_threshold, stack_capture, max_statement_length,
+                                    measure_batch_bytes, trace_fetch, leaf_spans)
+        self._self_scope_manager = _contextvars_scope_manager(self._self_tracer, scope_manager)
+        self._self_commit_operation_name = _operation_name(self, _AsyncConnectionMethods.commit)
+        self._self_rollback_operation_name = _operation_name(self, _AsyncConnectionMethods.rollback)
+        self._self_statements = None
+        if hasattr(connection, 'fetchrow'):
+            self._self_statements = AsyncCursor(connection, config=self._self_cursor_config,
+                                                scope_manager=self._self_scope_manager)
+
+    def cursor(self, *args, **kwargs):
+        config = self._get_cursor_config(kwargs)
+        if self._self_statements is not None:
+            return self.__wrapped__.cursor(*args, **kwargs)
+        return _CursorContext(self._cursor(config, *args, **kwargs))
+
+    async def _cursor(self, config, *args, **kwargs):
+        cursor = self.__wrapped__.cursor(*args, **kwargs)
+        if inspect.isawaitable(cursor):
+            cursor = await cursor
+        return AsyncCursor(cursor, config=config, scope_manager=self._self_scope_manager)
+
+    async def _traced_async_execution(self, operation_name, func, *args, **kwargs):
+        """Await function under a span activated in the connection's scope manager and return its value"""
+        scope = self._self_scope_manager.active
+        parent = scope.span if scope is not None else None
+        if _is_unsampled(parent):
+            return await func(*args, **kwargs)
+        span = self._self_tracer.start_span(operation_name, child_of=parent, ignore_active_span=True)
+        span.set_tag(tags.DATABASE_TYPE, 'sql')
+        span.set_tag(tags.SPAN_KIND, tags.SPAN_KIND_RPC_CLIENT)
+        for tag, value in self._self_span_tags.items():
+            span.set_tag(tag, value)
+
+        with self._self_scope_manager.activate(span, True):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                self._self_stack_capture.set_error_tags(span, e)
+                raise
+
+    async def __aenter__(self):
+        await self.__wrapped__.__aenter__()
+        return self
+
+    async def __aexit__(self, exc, value, tb):
+        return await self.__wrapped__.__aexit__(exc, value, tb)
+
+
+class ExecutorCursor(object):
+    """
+    Asyncio facade of a synchronous traced cursor, whose blocking execute(), executemany(), callproc(), fetch*(), and
+    close() calls are awaitable and run on the executor of its ExecutorConnectionTracing.  Async iteration fetches
+    `arraysize` rows per call.  Other attributes are those of the cursor.
+    """
+
+    def __init__(self, cursor, connection):
+        self._cursor = cursor
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, *args, **kwargs):
+        return self._connection._run(self._cursor.execute, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._connection._run(self._cursor.executemany, *args, **kwargs)
+
+    def callproc(self, *args, **kwargs):
+        return self._connection._run(self._cursor.callproc, *args, **kwargs)
+
+    def fetchone(self):
+        return self._connection._run(self._cursor.fetchone)
+
+    def fetchmany(self, *args, **kwargs):
+        return self._connection._run(self._cursor.fetchmany, *args, **kwargs)
+
+    def fetchall(self):
+        return self._connection._run(self._cursor.fetchall)
+
+    def close(self):
+        return self._connection._run(self._cursor.close)
+
+    async def _rows(self):
+        while True:
+            rows = await self.fetchmany(self._cursor.arraysize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def __aiter__(self):
+        return self._rows()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc, value, tb):
+        await self.close()
+
+
+class ExecutorConnectionTracing(object):
+    """
+    Asyncio facade of a synchronous traced connection (e.g. ConnectionTracing or PsycopgConnectionTracing), for
+    drivers without asyncio support.  Untraced connections are wrapped by ConnectionTracing with `tracer` and any other
+    ConnectionTracing named arguments.  Its cursor() provides ExecutorCursor facades when awaited or used with
+    `async with`, and commit(), rollback(), and close() are awaitable.
+
+    Blocking calls run on `executor`, or on a ThreadPoolExecutor of `max_workers` threads owned by the facade and shut
+    down by close().  Up to `max_in_flight` calls per connection are submitted at once, and later ones wait on the
+    event loop instead of occupying executor threads.  Each call runs in a copy of the calling task's context, under
+    the span active in `scope_manager` (as for AsyncConnectionTracing), so that traced executions are its children.
+
+    Unless `trace_offload` is False, each call is reported as an `executor.{method}` span, activated around the call
+    and tagged with its `db.executor.queue_wait` time until a thread started it and the connection's
+    `db.executor.in_flight` calls, so that queue wait is told apart from the execution time of its child span.
+
+    connection = ExecutorConnectionTracing(pymysql.connect(...), tracer, max_workers=8)
+    async with connection.cursor() as cursor:
+        await cursor.execute('SELECT 1')
+        rows = await cursor.fetchall()
+    """
+
+    def __init__(self, connection, tracer=None, executor=None, max_workers=4, max_in_flight=1, trace_offload=True,
+                 scope_manager=None, **tracing_kwargs):
+        if not isinstance(connection, _ConnectionTracing):
+            connection = ConnectionTracing(connection, tracer, **tracing_kwargs)
+        self._connection = connection
+        self._tracer = connection._self_tracer
+        self._scope_manager = _contextvars_scope_manager(self._tracer, scope_manager)
+        self._stack_capture = connection._self_stack_capture
+        self._owns_executor = executor is None
+        self._executor = ThreadPoolExecutor(max_workers) if executor is None else executor
+        self.max_in_flight = max_in_flight
+        self._trace_offload = trace_offload and not _is_noop_tracer(self._tracer)
+        # Created on first use, within the event loop
+        self._semaphore = None
+        self.in_flight = 0
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    @contextmanager
+    def _offload_scope(self, parent, func, queued, started):
+        """Activates the offload span of a call, or its parent if any, in the executor thread."""
+        tracer = self._tracer
+        if not self._trace_offload or _is_unsampled(parent):
+            if parent is None:
+                yield
+                return
+            with tracer.scope_manager.activate(parent, False):
+                yield
+            return
+
+        span = tracer.start_span(u'executor.{}'.format(func.__name__), child_of=parent, ignore_active_span=True,
+                                 start_time=queued + _PERF_COUNTER_OFFSET)
+        span.set_tag('db.executor.queue_wait', started - queued)
+        span.set_tag('db.executor.in_flight', self.in_flight)
+        with tracer.scope_manager.activate(span, True):
+            try:
+                yield
+            except Exception as e:
+                self._stack_capture.set_error_tags(span, e)
+                raise
+
+    def _call(self, parent, queued, func, args, kwargs):
+        with self._offload_scope(parent, func, queued, perf_counter()):
+            return func(*args, **kwargs)
+
+    async def _run(self, func, *args, **kwargs):
+        """Awaits `func` called on the executor, once fewer than `max_in_flight` calls of the connection are."""
+        scope = self._scope_manager.active
+        parent = scope.span if scope is not None else None
+        queued = perf_counter()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                return await get_running_loop().run_in_executor(
+                    self._executor, contextvars.copy_context().run, self._call, parent, queued, func, args, kwargs
+                )
+            finally:
+                self.in_flight -= 1
+
+    def cursor(self, *args, **kwargs):
+        return _CursorContext(self._cursor(*args, **kwargs))
+
+    async def _cursor(self, *args, **kwargs):
+        # DB API cursor creation does not block
+        return ExecutorCursor(self._connection.cursor(*args, **kwargs), self)
+
+    def commit(self):
+        return self._run(self._connection.commit)
+
+    def rollback(self):
+        return self._run(self._connection.rollback)
+
+    async def close(self):
+        try:
+            await self._run(self._connection.close)
+        finally:
+            if self._owns_executor:
+                self._executor.shutdown(wait=False)
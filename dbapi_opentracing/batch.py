@@ -0,0 +1,64 @@
+def _value_size(value):
+    """Approximate payload size of a query parameter value in bytes (or characters)."""
+    if value is None:
+        return 0
+    try:
+        return len(value)
+    except TypeError:  # Numbers, dates, and other fixed-size values
+        return 8
+
+
+def _parameters_size(parameters):
+    values = parameters.values() if hasattr(parameters, 'values') else parameters
+    try:
+        return sum(_value_size(value) for value in values)
+    except TypeError:  # Single non-sequence parameter
+        return _value_size(parameters)
+
+
+class _ParameterBatch(object):
+    """
+    Counts (and optionally sizes) the executemany() parameter sets consumed by the client.  Sized sequences are passed
+    to the client unchanged, while other iterables are wrapped by the batch itself to be counted lazily as the client
+    iterates over them, so that they are never materialized.
+    """
+    __slots__ = ('parameters', 'count', 'size', 'page_size', '_iterator', '_measure_size')
+
+    def __init__(self, parameters, measure_size=False, page_size=None):
+        self.size = 0
+        # Number of parameter sets per statement sent by InsertPaging, if any
+        self.page_size = page_size
+        self._measure_size = measure_size
+        if hasattr(parameters, '__len__'):
+            self.parameters = parameters
+            self.count = len(parameters)
+            self._iterator = None
+        else:
+            self.parameters = self
+            self.count = 0
+            self._iterator = iter(parameters)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        parameters = next(self._iterator)
+        self.count += 1
+        if self._measure_size:
+            self.size += _parameters_size(parameters)
+        return parameters
+
+    next = __next__  # py2
+
+    def set_tags(self, span, elapsed):
+        """Tags `span` with batch totals for an executemany() call lasting `elapsed` seconds."""
+        span.set_tag('db.batch.size', self.count)
+        if self._measure_size:
+            if self._iterator is None:
+                self.size = sum(_parameters_size(parameters) for parameters in self.parameters)
+            span.set_tag('db.batch.bytes', self.size)
+        if self.page_size is not None:
+            span.set_tag('db.batch.page_size', self.page_size)
+            span.set_tag('db.batch.pages', (self.count + self.page_size - 1) // self.page_size)
+        if elapsed > 0:
+            span.set_tag('db.batch.rows_per_second', self.count / float(elapsed))
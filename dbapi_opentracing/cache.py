@@ -0,0 +1,51 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """
+    Bounded, thread-safe least-recently-used mapping.  Lookup hit and miss counts are tracked in `hits` and `misses`
+    to allow sizing `maxsize` from observed traffic.
+    """
+
+    def __init__(self, maxsize=128):
+        if maxsize < 1:
+            raise ValueError('LRUCache maxsize must be positive.')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Reinsertion marks key as most recently used (OrderedDict.move_to_end() is unavailable in py2)
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Stores `value` under `key`, returning the evicted least recently used (key, value) item, if any."""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                return self._data.popitem(last=False)
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
@@ -0,0 +1,152 @@
+from collections import deque
+from threading import Lock
+import hashlib
+import linecache
+import sys
+import traceback
+
+from opentracing.ext import tags
+
+from .cache import LRUCache
+from .sampling import _TokenBucket, monotonic
+
+# Top-level package of traced methods, whose frames are never error sites
+_PACKAGE = __name__.split('.')[0]
+
+
+class StackCapture(object):
+    """
+    Configurable `sfx.error.stack` capture for traced execution errors.
+
+    `limit` restricts captured stacks to their innermost `limit` frames (all by default, and none if 0).  With
+    `deduplicate`, a stack is only captured for the first error of a given type raised from a given site (among the
+    `max_stacks` most recent ones), and all errors from that site are tagged with its short `sfx.error.stack_id`.
+    `rate` limits stack captures to that many per second for each exception class.
+    """
+
+    def __init__(self, limit=None, deduplicate=False, max_stacks=1024, rate=None, clock=monotonic):
+        self.limit = limit
+        self.deduplicate = deduplicate
+        self.rate = rate
+        self._clock = clock
+        self._stack_ids = LRUCache(max_stacks) if deduplicate else None
+        self._buckets = {}
+        self._lock = Lock()
+        # Error class str() values, which are otherwise recomputed for each error
+        self._class_names = {}
+        # Packages skipped for the error site of each error class
+        self._skipped = {}
+
+    def _format_stack(self, error_type, error, tb):
+        if self.limit is None:
+            return ''.join(traceback.format_exception(error_type, error, tb))
+
+        frames = deque(maxlen=self.limit)
+        while tb is not None:
+            frames.append(tb)
+            tb = tb.tb_next
+        lines = ['Traceback (most recent call last):\n']
+        for tb in frames:
+            code = tb.tb_frame.f_code
+            lines.append('  File "{}", line {}, in {}\n'.format(code.co_filename, tb.tb_lineno, code.co_name))
+            source = linecache.getline(code.co_filename, tb.tb_lineno).strip()
+            if source:
+                lines.append('    {}\n'.format(source))
+        lines.extend(traceback.format_exception_only(error_type, error))
+        return ''.join(lines)
+
+    def _rate_limited(self, error_type):
+        if self.rate is None:
+            return False
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(error_type)
+            if bucket is None:
+                bucket = self._buckets[error_type] = _TokenBucket(self.rate, now)
+            else:
+                bucket.refill(now)
+            if bucket.tokens < 1:
+                return True
+            bucket.tokens -= 1
+            return False
+
+    def _skipped_packages(self, error_type):
+        """
+        Top-level packages whose frames aren't error sites: this one, and that of DB API driver errors, i.e. of error
+        types deriving from an `Error` class of their own package.
+        """
+        skipped = self._skipped.get(error_type)
+        if skipped is None:
+            package = error_type.__module__.split('.')[0]
+            skipped = (_PACKAGE,)
+            if any(cls.__name__ == 'Error' and cls.__module__.split('.')[0] == package for cls in error_type.__mro__):
+                skipped += (package,)
+            self._skipped[error_type] = skipped
+        return skipped
+
+    def _site(self, error_type, tb):
+        """
+        Returns the (file name, line number) of the innermost frame raising an error outside of this package and of its
+        driver, or else of the innermost caller of the frame handling it (e.g. that of a C driver execution) outside of
+        them, so that errors of all executions aren't attributed to the same traced method.
+        """
+        skipped = self._skipped_packages(error_type)
+        handling, site = tb.tb_frame, None
+        while tb is not None:
+            if tb.tb_frame.f_globals.get('__name__', '').split('.')[0] not in skipped:
+                site = (tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+            innermost, tb = tb, tb.tb_next
+        if site is not None:
+            return site
+
+        frame = handling.f_back
+        while frame is not None and frame.f_globals.get('__name__', '').split('.')[0] in skipped:
+            frame = frame.f_back
+        if frame is None:
+            return innermost.tb_frame.f_code.co_filename, innermost.tb_lineno
+        return frame.f_code.co_filename, frame.f_lineno
+
+    def _stack_tags(self, error_type, error, tb):
+        """Returns the (stack, stack id) of an error, either of which may be None."""
+        if self.limit == 0:
+            return None, None
+
+        stack_id = None
+        if self.deduplicate and tb is not None:
+            site = (error_type,) + self._site(error_type, tb)
+            stack_id = self._stack_ids.get(site)
+            if stack_id is not None:
+                return None, stack_id
+            stack_id = hashlib.sha1('{}.{}:{}:{}'.format(error_type.__module__, error_type.__name__, *site[1:])
+                                    .encode('utf8')).hexdigest()[:12]
+
+        # Rate limited errors still report the stack id of their site, whose stack is captured by a later error
+        if self._rate_limited(error_type):
+            return None, stack_id
+        stack = self._format_stack(error_type, error, tb)
+        if stack_id is not None:
+            self._stack_ids.put(site, stack_id)
+        return stack, stack_id
+
+    def set_error_tags(self, span, error):
+        """Tags `span` with `error`, which must be currently handled."""
+        tb = sys.exc_info()[2]
+        error_type = error.__class__
+        class_name = self._class_names.get(error_type)
+        if class_name is None:
+            class_name = self._class_names[error_type] = str(error_type)
+
+        span.set_tag(tags.ERROR, True)
+        span.set_tag('sfx.error.message', str(error))
+        span.set_tag('sfx.error.object', class_name)
+        span.set_tag('sfx.error.kind', error_type.__name__)
+
+        stack, stack_id = self._stack_tags(error_type, error, tb)
+        if stack is not None:
+            span.set_tag('sfx.error.stack', stack)
+        if stack_id is not None:
+            span.set_tag('sfx.error.stack_id', stack_id)
+
+
+# Captures full stacks of all errors, as format_exc() would
+_full_stack_capture = StackCapture()
@@ -0,0 +1,144 @@
+from datetime import date, datetime, time
+from decimal import Decimal
+from itertools import chain, islice
+from uuid import UUID
+import io
+import math
+import numbers
+import re
+
+# Simple INSERT INTO table [(columns)] VALUES (placeholder, ...) statements, whose single row of uniform %s or ?
+# placeholders can be repeated for each parameter set
+_INSERT_VALUES_PATTERN = re.compile(r"""
+    ^\s*INSERT\s+INTO\s+(?P<target>[\w."]+(?:\s*\([\w\s,."]*\))?)
+    \s+VALUES\s*(?P<row>\(\s*(?P<placeholder>%s|\?)(?:\s*,\s*(?P=placeholder))*\s*\))
+    \s*;?\s*$
+""", re.IGNORECASE | re.VERBOSE)
+
+if bytes is str:  # py2
+    _TEXT_TYPES = (unicode,)  # noqa: F821
+    _BINARY_TYPES = (bytearray, memoryview)
+else:
+    _TEXT_TYPES = (str,)
+    _BINARY_TYPES = (bytes, bytearray, memoryview)
+
+# Characters escaped in COPY text format values
+_COPY_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'))
+
+
+def _escape(text):
+    for char, escape in _COPY_ESCAPES:
+        if char in text:
+            text = text.replace(char, escape)
+    return text
+
+
+def _copy_value(value):
+    """COPY text format representation of a parameter value, or None for values whose representation is unknown."""
+    if value is None:
+        return u'\\N'
+    if isinstance(value, bool):
+        return u't' if value else u'f'
+    if isinstance(value, _TEXT_TYPES):
+        return _escape(value)
+    if isinstance(value, str):  # py2 byte strings
+        return _escape(value.decode('utf8'))
+    if isinstance(value, _BINARY_TYPES):
+        return u'\\\\x' + u''.join(u'{:02x}'.format(byte) for byte in bytearray(value))
+    if isinstance(value, float):
+        if math.isnan(value):
+            return u'NaN'
+        if math.isinf(value):
+            return u'Infinity' if value > 0 else u'-Infinity'
+        return repr(value)
+    if isinstance(value, (numbers.Integral, Decimal, UUID)):
+        return u'{}'.format(value)
+    if isinstance(value, (date, datetime, time)):
+        return value.isoformat()
+    return None
+
+
+def _add_rowcount(total, rowcount):
+    """Running rowcount `total` of paged executions, which is -1 once any page's rowcount is unknown."""
+    if total < 0 or rowcount is None or rowcount < 0:
+        return -1
+    return total + rowcount
+
+
+class _PagedInsert(object):
+    """
+    executemany() replacement sending the parameter sets of an INSERT statement `page_size` at a time, with the
+    untraced driver execute() of the traced `cursor` as a single multi-row INSERT, or with its copy_expert() as COPY
+    FROM STDIN if `copy`.  The `rowcount` total of its pages is reported as the span's rows produced, and as the
+    cursor's rowcount until its next execution, as the client's executemany() would.
+    """
+    # Named like the replaced method, for the operation name and batch tags of its spans
+    __name__ = 'executemany'
+
+    def __init__(self, match, page_size, cursor, copy=False):
+        self.page_size = page_size
+        self.rowcount = 0
+        self._cursor = cursor
+        self._execute = cursor._driver_method('execute')
+        self._copy_expert = cursor._driver_method('copy_expert') if copy else None
+        self._insert = match.string[:match.start('row')]
+        self._row = match.group('row')
+        self._copy = u'COPY {} FROM STDIN'.format(match.group('target'))
+
+    def __call__(self, *args):
+        # Parameter sets are the last of the driver executemany() arguments
+        parameters = iter(args[-1])
+        page_size = self.page_size
+        while True:
+            page = list(islice(parameters, page_size))
+            if not page:
+                break
+            if self._copy_expert is None or not self._copy_page(page):
+                self._execute(self._insert + u', '.join([self._row] * len(page)), list(chain.from_iterable(page)))
+            self.rowcount = _add_rowcount(self.rowcount, self._cursor._driver_rowcount())
+            if len(page) < page_size:
+                break
+        self._cursor._self_rowcount = (self.rowcount, self._cursor._driver_rowcount())
+
+    def _copy_page(self, page):
+        """COPYs the parameter sets of `page`, returning False if some value cannot be represented as COPY text."""
+        lines = []
+        for parameters in page:
+            values = [_copy_value(value) for value in parameters]
+            if None in values:
+                return False
+            lines.append(u'\t'.join(values))
+        lines.append(u'')
+        self._copy_expert(self._copy, io.StringIO(u'\n'.join(lines)))
+        return True
+
+
+class InsertPaging(object):
+    """
+    Speeds up executemany() of simple ``INSERT INTO table [(columns)] VALUES (%s, ...)`` statements by sending their
+    parameter sets `page_size` at a time, as a single multi-row INSERT statement with the page's parameter sets as its
+    VALUES rows, or, with `copy` and clients providing copy_expert() (e.g. psycopg2), as COPY FROM STDIN of their text
+    representation.  Pages with values lacking a known text representation are sent as multi-row INSERTs instead.
+    Other statements are passed to the client's executemany() as is.
+    """
+
+    def __init__(self, page_size=100, copy=False):
+        if page_size < 1:
+            raise ValueError('page_size must be at least 1.')
+        self.page_size = page_size
+        self.copy = copy
+
+    def executemany(self, func, args, kwargs, cursor):
+        """
+        Paged replacement of the driver executemany() `func` for the `args` and `kwargs` of an executemany() call of
+        the traced `cursor`, or `func` itself if it can't be paged.
+        """
+        if len(args) != 2 or kwargs:
+            return func
+        try:
+            match = _INSERT_VALUES_PATTERN.match(args[0])
+        except TypeError:  # bytes and Composable queries
+            return func
+        if match is None:
+            return func
+        return _PagedInsert(match, self.page_size, cursor, self.copy and match.group('placeholder') == '%s')
@@ -0,0 +1,234 @@
+from collections import deque
+from threading import Condition, Lock
+
+from opentracing.ext import tags
+import opentracing
+
+from .errors import _full_stack_capture
+from .tracing import ConnectionTracing, _ConnectionTracing, _PERF_COUNTER_OFFSET, perf_counter
+
+
+def _unwrap(connection):
+    return connection.__wrapped__ if isinstance(connection, ConnectionTracing) else connection
+
+
+class PoolError(Exception):
+    """
+    Raised when no pooled connection becomes available within the checkout timeout, or when returning a connection
+    that isn't checked out from the pool.
+    """
+
+
+class TracedConnectionPool(object):
+    """
+    A connection pool with traced checkouts, wrapping either a psycopg2.pool pool (or any pool with compatible
+    getconn(), putconn(), and closeall() methods) or a DB-API connect callable.
+
+    Connections are wrapped in ConnectionTracing proxies once, configured by `tracer`, `span_tags`, and any other
+    ConnectionTracing named arguments, and the same proxy is handed out for each checkout of a connection.  Pooled
+    connections that are already traced (e.g. by a PsycopgConnectionTracing connection_factory) are not wrapped.
+
+    Connect callables are pooled up to `maxconn` connections, and getconn() waits for one to be returned once they
+    are all in use, for up to `timeout` seconds if provided before raising PoolError.  psycopg2 pools never wait, as
+    they raise their own PoolError when exhausted, so their checkout time is that of getconn() itself.
+
+    `prewarm` connections are checked out and returned upon creation, so that they are connected (and wrapped) ahead
+    of their first use.  psycopg2 pools only keep up to their `minconn` idle connections.
+
+    Unless `trace_checkout` is False, each checkout is reported as a `getconn` span tagged with its
+    `db.pool.wait_time` and the pool's `db.pool.in_use`, `db.pool.idle`, `db.pool.max`, `db.pool.saturation`, and
+    `db.pool.peak_in_use` as of the checkout.
+    """
+
+    def __init__(self, pool, tracer=None, span_tags=None, maxconn=10, timeout=None, prewarm=0, trace_checkout=True,
+                 **tracing_kwargs):
+        if hasattr(pool, 'getconn'):
+            self._pool, self._connect = pool, None
+            self.maxconn = pool.maxconn
+            self._operation_name = '{}.getconn'.format(pool.__class__.__name__)
+        else:
+            self._pool, self._connect = None, pool
+            self.maxconn = maxconn
+            self._operation_name = '{}.getconn'.format(self.__class__.__name__)
+
+        self._tracer = tracer or opentracing.tracer
+        self._span_tags = span_tags
+        self._timeout = timeout
+        self._trace_checkout = trace_checkout
+        self._tracing_kwargs = tracing_kwargs
+        self._stack_capture = tracing_kwargs.get('stack_capture') or _full_stack_capture
+
+        self._tags = {tags.DATABASE_TYPE: 'sql'}
+        if span_tags is not None:
+            self._tags.update(span_tags)
+
+        self._condition = Condition(Lock())
+        # Idle connect callable proxies, most recently returned last
+        self._idle = deque()
+        # Number of connect callable connections
+        self._size = 0
+        # Proxies of psycopg2 pool connections
+        self._proxies = {}
+        # Checked out (unwrapped) connections
+        self._checked_out_connections = set()
+        self.in_use = 0
+        self.peak_in_use = 0
+
+        if prewarm:
+            self.prewarm(prewarm)
+
+    @property
+    def idle(self):
+        """Number of connections available for checkout without connecting."""
+        if self._connect is None:
+            return len(self._proxies) - self.in_use
+        return len(self._idle)
+
+    def prewarm(self, count):
+        """Connects up to `count` connections ahead of their first checkout."""
+        connections = []
+        try:
+            for _ in range(min(count, self.maxconn)):
+                connections.append(self._checkout(None)[0])
+        finally:
+            for connection in connections:
+                self.putconn(connection)
+
+    def _wrap(self, connection):
+        if isinstance(connection, _ConnectionTracing):
+            return connection
+        return ConnectionTracing(connection, tracer=self._tracer, span_tags=self._span_tags, **self._tracing_kwargs)
+
+    def _checked_out(self, connection):
+        """
+        Counts the checkout of `connection`, unless it is already checked out (e.g. by a previous psycopg2 pool
+        getconn() of the same key), returning the pool's in use, idle, and peak in use counts after it.
+        """
+        if connection is not None:
+            if connection in self._checked_out_connections:
+                return self.in_use, self.idle, self.peak_in_use
+            self._checked_out_connections.add(connection)
+        self.in_use += 1
+        if self.in_use > self.peak_in_use:
+            self.peak_in_use = self.in_use
+        return self.in_use, self.idle, self.peak_in_use
+
+    def _check_in(self, connection):
+        """Uncounts the checkout of the unwrapped `connection`, raising PoolError if it isn't checked out."""
+        try:
+            self._checked_out_connections.remove(connection)
+        except KeyError:
+            raise PoolError('Connection is not checked out from this pool')
+        self.in_use -= 1
+
+    def _checkout(self, key):
+        """
+        Returns a checked out connection proxy, the time spent waiting for it, and the pool's in use, idle, and peak in
+        use counts as of its checkout.
+        """
+        start = perf_counter()
+        if self._connect is None:
+            connection = self._pool.getconn(key)
+            waited = perf_counter() - start
+            with self._condition:
+                proxy = self._proxies.get(connection)
+                if proxy is None:
+                    proxy = self._proxies[connection] = self._wrap(connection)
+                counts = self._checked_out(connection)
+            return proxy, waited, counts
+
+        with self._condition:
+            while not self._idle and self._size >= self.maxconn:
+                remaining = None
+                if self._timeout is not None:
+                    remaining = self._timeout - (perf_counter() - start)
+                    if remaining <= 0:
+                        raise PoolError('No connection available within {} seconds'.format(self._timeout))
+                self._condition.wait(remaining)
+            waited = perf_counter() - start
+            proxy = self._idle.pop() if self._idle else None
+            if proxy is None:
+                self._size += 1
+            counts = self._checked_out(None if proxy is None else _unwrap(proxy))
+
+        if proxy is None:
+            try:
+                proxy = self._wrap(self._connect())
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self.in_use -= 1
+                    self._condition.notify()
+                raise
+            with self._condition:
+                self._checked_out_connections.add(_unwrap(proxy))
+        return proxy, waited, counts
+
+    def getconn(self, key=None):
+        """Checks out a traced connection, to be returned with putconn()."""
+        if not self._trace_checkout:
+            return self._checkout(key)[0]
+
+        start = perf_counter()
+        try:
+            connection, waited, (in_use, idle, peak_in_use) = self._checkout(key)
+        except Exception as e:
+            span = self._tracer.start_span(self._operation_name, tags=dict(self._tags),
+                                           start_time=start + _PERF_COUNTER_OFFSET)
+            self._stack_capture.set_error_tags(span, e)
+            span.finish()
+            raise
+
+        span = self._tracer.start_span(self._operation_name, tags=dict(self._tags),
+                                       start_time=start + _PERF_COUNTER_OFFSET)
+        span.set_tag('db.pool.wait_time', waited)
+        span.set_tag('db.pool.in_use', in_use)
+        span.set_tag('db.pool.idle', idle)
+        span.set_tag('db.pool.max', self.maxconn)
+        span.set_tag('db.pool.saturation', in_use / float(self.maxconn))
+        span.set_tag('db.pool.peak_in_use', peak_in_use)
+        span.finish()
+        return connection
+
+    def putconn(self, connection, key=None, close=False):
+        """
+        Returns a connection obtained from getconn(), closing it if `close`.  Raises PoolError for connections that
+        aren't checked out from this pool, which are left as is.
+        """
+        wrapped = _unwrap(connection)
+        if self._connect is None:
+            with self._condition:
+                self._check_in(wrapped)
+            self._pool.putconn(wrapped, key=key, close=close)
+            # psycopg2 pools close returned connections in excess of their minconn
+            if close or getattr(wrapped, 'closed', False):
+                with self._condition:
+                    self._proxies.pop(wrapped, None)
+            return
+
+        with self._condition:
+            self._check_in(wrapped)
+            if not close:
+                self._idle.append(connection)
+                self._condition.notify()
+                return
+        try:
+            wrapped.close()
+        finally:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+
+    def closeall(self):
+        """Closes all idle connections, and those of the wrapped pool."""
+        if self._connect is None:
+            self._pool.closeall()
+            with self._condition:
+                self._proxies.clear()
+            return
+
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+        for connection in idle:
+            _unwrap(connection).close()
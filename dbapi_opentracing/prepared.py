@@ -0,0 +1,269 @@
+from collections import namedtuple
+from datetime import date, datetime, time
+from decimal import Decimal
+from itertools import count
+from uuid import UUID
+import numbers
+import math
+import re
+
+from .cache import LRUCache
+from .paging import _BINARY_TYPES, _TEXT_TYPES
+from .sql import parse_statement
+
+try:
+    from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+except ImportError:
+    TRANSACTION_STATUS_INERROR = 3
+
+# Quoted text and comments, in which psycopg2 still replaces placeholders, or placeholders and other % sequences
+_PARAMETER_PATTERN = re.compile(r"""
+    (?P<quoted>--[^\n]*|/\*.*?\*/|"(?:[^"]|"")*"|(?<![\w$])[Ee]'(?:[^'\\]|\\.|'')*'|'(?:[^']|'')*'
+               |\$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?\$(?P=tag)\$)
+  | %(?:\((?P<name>[^)]*)\))?s
+  | %%
+  | %
+""", re.DOTALL | re.VERBOSE)
+
+# Statements that can be prepared, by verb
+_PREPARABLE_VERBS = frozenset(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'VALUES'))
+
+# Savepoint guarding the statements issued by AutoPrepare outside of autocommit mode
+_SAVEPOINT = '_dbapi_opentracing_prepare'
+
+# Count of statements that cannot be prepared
+_UNPREPARABLE = -1
+
+# Range of bigint parameters, beyond which psycopg2 adapts integers to numeric literals
+_BIGINT_MIN, _BIGINT_MAX = -2 ** 63, 2 ** 63 - 1
+
+# Prepared statement of a connection, with its EXECUTE query, the names of its named placeholders (None if positional),
+# and the types of its parameters
+_PreparedStatement = namedtuple('_PreparedStatement', 'name execute_query names types')
+
+
+def _prepared_query(query, parameters):
+    """
+    Converts a psycopg2 `query` and its `parameters` to a PREPARE-able query with $n placeholders, returning it along
+    with the names of its named placeholders, if any, or None if its placeholders cannot be converted.
+    """
+    if parameters is None:  # psycopg2 only replaces placeholders of queries with parameters
+        return query, None
+
+    parts, names, positions = [], [], {}
+    position = 0
+    for match in _PARAMETER_PATTERN.finditer(query):
+        parts.append(query[position:match.start()])
+        position = match.end()
+        text = match.group()
+        if match.group('quoted') is not None:
+            # Placeholders are replaced by psycopg2 (and other % sequences rejected) even within quotes
+            if '%' in text.replace('%%', ''):
+                return None
+            parts.append(text.replace('%%', '%'))
+        elif text == '%%':
+            parts.append('%')
+        elif text == '%':
+            return None
+        else:
+            name = match.group('name')
+            if name is None:
+                names.append(None)
+                parts.append(u'${}'.format(len(names)))
+            else:
+                if name not in positions:
+                    names.append(name)
+                    positions[name] = len(names)
+                parts.append(u'${}'.format(positions[name]))
+    parts.append(query[position:])
+
+    if None in names and positions:  # Mixed positional and named placeholders
+        return None
+    return u''.join(parts), names if positions else None
+
+
+def _parameter_type(value):
+    """Type of the literal psycopg2 adapts `value` to, None for NULL values, or False for unknown types."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, _TEXT_TYPES + (str,)):
+        return 'unknown'
+    if isinstance(value, _BINARY_TYPES):
+        return 'bytea'
+    if isinstance(value, float):
+        # Infinite and NaN values are adapted to 'Infinity'::float literals, which numeric only accepts as of PG 14
+        return 'double precision' if math.isinf(value) or math.isnan(value) else 'numeric'
+    if isinstance(value, Decimal):
+        return 'numeric'
+    if isinstance(value, numbers.Integral):
+        return 'bigint' if _BIGINT_MIN <= value <= _BIGINT_MAX else 'numeric'
+    if isinstance(value, datetime):
+        return 'timestamp' if value.tzinfo is None else 'timestamptz'
+    if isinstance(value, date):
+        return 'date'
+    if isinstance(value, time):
+        return 'time' if value.tzinfo is None else 'timetz'
+    if isinstance(value, UUID):
+        return 'uuid'
+    return False
+
+
+def _parameter_types(parameters, names):
+    """Types of the values of `parameters` of a statement with `names` placeholders, or None if they are missing."""
+    if parameters is None:
+        return []
+    try:
+        values = parameters if names is None else [parameters[name] for name in names]
+        return [_parameter_type(value) for value in values]
+    except (KeyError, TypeError):  # Left for psycopg2 to report
+        return None
+
+
+class _PreparedExecution(object):
+    """
+    psycopg2 cursor execute() replacement executing prepared statements with EXECUTE, preparing them once hot.  Its
+    spans are tagged with whether it was `prepared`.
+    """
+    __slots__ = ('statements', 'func', 'prepared')
+    # Named like the replaced method, for the operation name of its spans
+    __name__ = 'execute'
+
+    def __init__(self, statements, func):
+        self.statements = statements
+        self.func = func
+        self.prepared = False
+
+    def __call__(self, cursor, query, parameters=None):
+        statement = self.statements.get(cursor, self.func, query, parameters)
+        if statement is not None:
+            types = _parameter_types(parameters, statement.names)
+            # NULL values are valid for any parameter, but other values are only passed to parameters of their type
+            if types is not None and len(types) == len(statement.types) and all(
+                    found is None or found == expected for found, expected in zip(types, statement.types)):
+                self.prepared = True
+                return self.func(cursor, statement.execute_query, parameters)
+        return self.func(cursor, query, parameters)
+
+    def set_tags(self, span, elapsed):
+        span.set_tag('db.prepared', self.prepared)
+
+
+class _PreparedStatements(object):
+    """
+    Statements prepared by AutoPrepare on a psycopg2 connection, as _PreparedStatement by query, of which only the
+    `max_prepared` most recently executed are kept.
+    """
+
+    def __init__(self, auto_prepare):
+        self.auto_prepare = auto_prepare
+        self._statements = LRUCache(auto_prepare.max_prepared)
+        self._names = count(1)
+
+    def execution(self, func, args, kwargs):
+        """_PreparedExecution of cursor execute() `func` for its `args` and `kwargs`, or `func` if never prepared."""
+        if kwargs or not 1 <= len(args) <= 2 or not isinstance(args[0], _TEXT_TYPES + (str,)):
+            return func
+        return _PreparedExecution(self, func)
+
+    def get(self, cursor, func, query, parameters):
+        """Prepared statement of `query`, which is prepared by the `cursor` execute() `func` once hot if possible."""
+        statement = self._statements.get(query)
+        if statement is None and self.auto_prepare._executed(query):
+            statement = self._prepare(cursor, func, query, parameters)
+        return statement
+
+    def _prepare(self, cursor, func, query, parameters):
+        auto_prepare = self.auto_prepare
+        if cursor.connection.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+            return None
+        converted = _prepared_query(query, parameters)
+        if converted is None:
+            auto_prepare._unpreparable(query)
+            return None
+        text, names = converted
+        types = _parameter_types(parameters, names)
+        if types is None:
+            return None
+        if False in types:
+            auto_prepare._unpreparable(query)
+            return None
+        if None in types:  # Parameter types are declared once NULL values are provided for none of them
+            return None
+
+        name = '_dbapi_{}'.format(next(self._names))
+        declared = u' ({})'.format(u', '.join(types)) if types else u''
+        if not self._execute(cursor, func, u'PREPARE {}{} AS {}'.format(name, declared, text)):
+            auto_prepare._unpreparable(query)
+            return None
+
+        placeholders = (u'%({})s'.format(name) for name in names) if names is not None else (u'%s' for _ in types)
+        execute_query = u'EXECUTE {}'.format(name)
+        if types:
+            execute_query += u' ({})'.format(u', '.join(placeholders))
+        statement = _PreparedStatement(name, execute_query, names, tuple(types))
+        evicted = self._statements.put(query, statement)
+        if evicted is not None:
+            self._execute(cursor, func, u'DEALLOCATE {}'.format(evicted[1].name))
+        return statement
+
+    @staticmethod
+    def _execute(cursor, func, query):
+        """
+        Executes `query` with the untraced `cursor` execute() `func`, within a savepoint outside of autocommit mode so
+        that failures leave the transaction usable, returning whether it succeeded.
+        """
+        connection = cursor.connection
+        if connection.autocommit:
+            try:
+                func(cursor, query)
+            except connection.Error:
+                return False
+            return True
+
+        func(cursor, 'SAVEPOINT ' + _SAVEPOINT)
+        try:
+            func(cursor, query)
+        except connection.Error:
+            func(cursor, 'ROLLBACK TO SAVEPOINT ' + _SAVEPOINT)
+            return False
+        finally:
+            func(cursor, 'RELEASE SAVEPOINT ' + _SAVEPOINT)
+        return True
+
+
+class AutoPrepare(object):
+    """
+    Server-side prepared statements for the hot statements of PsycopgConnectionTracing connections.  Executions are
+    counted per statement (up to `max_tracked` most recently executed ones), and once a statement has been executed
+    `threshold` times, each connection executing it issues PREPARE once and then executes it with EXECUTE.  Connections
+    keep up to `max_prepared` statements, and DEALLOCATE the least recently executed ones beyond.
+
+    Statements are SELECT, INSERT, UPDATE, DELETE, and VALUES queries whose parameters are all either strings,
+    numbers, booleans, dates and times, bytes, or UUIDs, whose types are declared from the first execution that
+    provides no NULL value.  Executions whose parameter types differ are executed unprepared.
+    """
+
+    def __init__(self, threshold=5, max_prepared=64, max_tracked=1024):
+        if threshold < 1:
+            raise ValueError('threshold must be at least 1.')
+        self.threshold = threshold
+        self.max_prepared = max_prepared
+        self._counts = LRUCache(max_tracked)
+
+    def _executed(self, query):
+        """Counts an execution of `query`, returning whether it is hot enough to be prepared."""
+        executions = self._counts.get(query, 0)
+        if executions == _UNPREPARABLE:
+            return False
+        if executions == 0:
+            if parse_statement(query).verb not in _PREPARABLE_VERBS:
+                self._unpreparable(query)
+                return False
+        executions += 1
+        self._counts.put(query, executions)
+        return executions >= self.threshold
+
+    def _unpreparable(self, query):
+        self._counts.put(query, _UNPREPARABLE)
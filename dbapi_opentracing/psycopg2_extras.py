@@ -0,0 +1,125 @@
+from .batch import _ParameterBatch
+from .paging import _add_rowcount
+from .tracing import perf_counter
+
+try:
+    import psycopg2.extras as extras
+    from psycopg2.sql import Composable
+except ImportError:
+    extras = None
+    Composable = type('Composable', tuple(), {})
+
+
+class _PageCursor(object):
+    """
+    Traced psycopg2 `cursor` stand-in for psycopg2.extras functions, whose page execute() and fetchall() calls are
+    sent with the untraced cursor methods, with execute() calls timed and counted for `execution`.
+    """
+    __slots__ = ('_cursor', '_execution')
+
+    def __init__(self, cursor, execution):
+        self._cursor = cursor
+        self._execution = execution
+
+    def execute(self, query, args=None):
+        start = perf_counter()
+        try:
+            val = self._cursor._cursor_factory.execute(self._cursor, query, args)
+        finally:
+            self._execution.paged(perf_counter() - start)
+        self._execution.rowcount = _add_rowcount(self._execution.rowcount, self._cursor.rowcount)
+        return val
+
+    def fetchall(self):
+        return self._cursor._cursor_factory.fetchall(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _PagedExecution(object):
+    """
+    Replacement of a traced cursor's execute() running a psycopg2.extras function sending its argument list
+    `page_size` parameter sets per untraced execute() call, which are counted and timed as a batch of its span.  The
+    `rowcount` total of its pages is reported as the span's rows produced.
+    """
+    __slots__ = ('page_size', 'kwargs', 'batch', 'pages', 'page_time', 'max_page_time', 'rowcount')
+
+    def __init__(self, page_size, **kwargs):
+        self.page_size = page_size
+        self.kwargs = kwargs
+        self.batch = None
+        self.pages = 0
+        self.page_time = 0.0
+        self.max_page_time = 0.0
+        self.rowcount = 0
+
+    def __call__(self, cursor, sql, argslist):
+        self.batch = _ParameterBatch(argslist, cursor._self_config.measure_batch_bytes, self.page_size)
+        if isinstance(sql, Composable):  # Rendered by psycopg2 with the cursor, which the stand-in isn't
+            sql = sql.as_string(cursor)
+        return self._execute(_PageCursor(cursor, self), sql, self.batch.parameters)
+
+    def _execute(self, cursor, sql, argslist):
+        raise NotImplementedError
+
+    def paged(self, elapsed):
+        """Records a page execute() call lasting `elapsed` seconds."""
+        self.pages += 1
+        self.page_time += elapsed
+        if elapsed > self.max_page_time:
+            self.max_page_time = elapsed
+
+    def set_tags(self, span, elapsed):
+        # Unset if the argument list itself failed, e.g. as it isn't iterable
+        if self.batch is not None:
+            self.batch.set_tags(span, elapsed)
+        # Pages actually sent, as the call may have failed midway
+        span.set_tag('db.batch.pages', self.pages)
+        if self.pages:
+            span.set_tag('db.batch.page_latency.mean', self.page_time / self.pages)
+            span.set_tag('db.batch.page_latency.max', self.max_page_time)
+
+
+class _PagedBatch(_PagedExecution):
+    __slots__ = ()
+    # Named like the replaced function, for the operation name of its spans
+    __name__ = 'execute_batch'
+
+    def _execute(self, cursor, sql, argslist):
+        return extras.execute_batch(cursor, sql, argslist, page_size=self.page_size)
+
+
+class _PagedValues(_PagedExecution):
+    __slots__ = ()
+    __name__ = 'execute_values'
+
+    def _execute(self, cursor, sql, argslist):
+        return extras.execute_values(cursor, sql, argslist, page_size=self.page_size, **self.kwargs)
+
+
+def _traced_paging(cur, execution, sql, argslist):
+    """Runs `execution` as a single traced execution of `cur`, or its psycopg2.extras function if `cur` isn't traced."""
+    config = getattr(cur, '_self_config', None)
+    # Asynchronous connection executions are traced by poll(), which psycopg2.extras functions don't wait for
+    if config is None or not config.trace_execute or getattr(cur.connection, '_is_async', False):
+        return execution._execute(cur, sql, argslist)
+    return cur._traced_execution(execution, cur, sql, argslist)
+
+
+def execute_batch(cur, sql, argslist, page_size=100):
+    """
+    psycopg2.extras.execute_batch() traced as a single `execute_batch` span of PsycopgConnectionTracing cursors, tagged
+    with the batch size, its pages, and their latency, instead of one span per page.
+    """
+    return _traced_paging(cur, _PagedBatch(page_size), sql, argslist)
+
+
+def execute_values(cur, sql, argslist, template=None, page_size=100, fetch=False):
+    """
+    psycopg2.extras.execute_values() traced as a single `execute_values` span of PsycopgConnectionTracing cursors,
+    tagged with the batch size, its pages, and their latency, instead of one span per page.
+    """
+    # psycopg2 < 2.8 execute_values() has no `fetch` argument, which is only passed to it when set
+    kwargs = dict(fetch=fetch) if fetch else {}
+    return _traced_paging(cur, _PagedValues(page_size, template=template, **kwargs), sql, argslist)
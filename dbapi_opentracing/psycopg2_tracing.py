@@ -1,99 +1,401 @@
+from functools import partial
 from threading import Lock
 
-from .tracing import _ConnectionTracing, _Cursor, _operation_name
+from .prepared import _PreparedExecution, _PreparedStatements
+from .psycopg2_extras import _PagedExecution
+from .sql import RAW
+from .tracing import (_CONNECTION_FLAG_METHODS, _CURSOR_FLAG_METHODS, _ConnectionTracing, _Cursor, _Fetch,
+                      _PERF_COUNTER_OFFSET, _cursor_flags, _enabled_cursor_flags, _enabled_flags,
+                      _get_driver_attribute, _is_unsampled, _operation_name, _rowcount_reset_methods,
+                      _set_driver_attribute, _traced_methods, perf_counter)
 
 try:
     from psycopg2.extensions import connection as PsycopgConnection
     from psycopg2.extensions import cursor as PsycopgCursor
-    from psycopg2.sql import Composed
+    from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE
+    from psycopg2.sql import Composable, Composed
 except ImportError:
     PsycopgConnection = object
     PsycopgCursor = object
-    Composed = type('Composed', tuple(), {}) 
+    POLL_OK, POLL_READ, POLL_WRITE = 0, 1, 2
+    Composable = type('Composable', tuple(), {})
+    Composed = type('Composed', (Composable,), {})
+
+
+# Traced methods enabled by trace_fetch additionally include close(), which reports the pending fetch span.
+# Cursors of asynchronous connections additionally replace _traced_execution() (following the insert_paging flag,
+# which enables no traced method), and their connections poll().
+_PSYCOPG_CURSOR_FLAG_METHODS = _CURSOR_FLAG_METHODS[:-1] + (_CURSOR_FLAG_METHODS[-1] + ('close',), (),
+                                                            ('_traced_execution',))
+_PSYCOPG_CONNECTION_FLAG_METHODS = _CONNECTION_FLAG_METHODS + (('poll',),)
+
+# Upper bounds (in milliseconds) of named cursor round trip latency histogram buckets
+_ROUND_TRIP_BUCKETS = (1, 10, 100, 1000)
+
+
+class _StreamingFetch(_Fetch):
+    """
+    Fetch phase of a named (server-side) cursor, whose every fetch call is a FETCH FORWARD round trip to the server.
+    Round trips are only timed and counted into a latency histogram.
+    """
+    __slots__ = ('itersize', 'round_trips', 'latencies')
+
+    def __init__(self, context, template, executed, itersize):
+        _Fetch.__init__(self, context, template, executed)
+        self.itersize = itersize
+        self.round_trips = 0
+        self.latencies = [0] * (len(_ROUND_TRIP_BUCKETS) + 1)
+
+    def fetched(self, start, rows):
+        _Fetch.fetched(self, start, rows)
+        self.round_trips += 1
+        latency = (self.finished - start) * 1000
+        bucket = 0
+        while bucket < len(_ROUND_TRIP_BUCKETS) and latency > _ROUND_TRIP_BUCKETS[bucket]:
+            bucket += 1
+        self.latencies[bucket] += 1
+
+    def set_tags(self, span):
+        _Fetch.set_tags(self, span)
+        span.set_tag('db.fetch.itersize', self.itersize)
+        span.set_tag('db.fetch.round_trips', self.round_trips)
+        span.set_tag('db.fetch.rows_per_round_trip', self.rows / float(self.round_trips))
+        for bound, count in zip(_ROUND_TRIP_BUCKETS, self.latencies):
+            if count:
+                span.set_tag('db.fetch.round_trip_latency.le_{}ms'.format(bound), count)
+        if self.latencies[-1]:
+            span.set_tag('db.fetch.round_trip_latency.gt_{}ms'.format(_ROUND_TRIP_BUCKETS[-1]), self.latencies[-1])
+
+
+class _PolledExecution(object):
+    """
+    Execution of an asynchronous connection (async_=1) cursor, whose span is started by execute() and advanced by
+    the connection's poll() calls until POLL_OK or an error.  Time spent in poll() calls is processing time, while
+    time since execute() or the previous poll() is waiting time.
+    """
+    __slots__ = ('cursor', 'span', 'template', 'func', 'polled', 'polls', 'reads', 'writes', 'waiting', 'processing')
+
+    def __init__(self, cursor, span, template, func, executed):
+        self.cursor = cursor
+        self.span = span
+        self.template = template
+        self.func = func
+        self.polled = executed
+        self.polls = 0
+        self.reads = 0
+        self.writes = 0
+        self.waiting = 0.0
+        self.processing = 0.0
+
+    def poll(self, start, state):
+        """Records a poll() call started at `start` that returned `state`."""
+        now = perf_counter()
+        self.polls += 1
+        self.waiting += start - self.polled
+        self.processing += now - start
+        self.polled = now
+        if state == POLL_READ:
+            self.reads += 1
+        elif state == POLL_WRITE:
+            self.writes += 1
+
+    def set_tags(self, span):
+        span.set_tag('db.poll.count', self.polls)
+        span.set_tag('db.poll.read', self.reads)
+        span.set_tag('db.poll.write', self.writes)
+        span.set_tag('db.poll.wait_time', self.waiting)
+        span.set_tag('db.poll.processing_time', self.processing)
 
 
 class _PsycopgCursorTracing(_Cursor):
     """
     Traced mixin for subclass of psycopg2 cursor.  Intended to be used by connection.cursor(cursor_factory).
     """
+    # Traced methods are invoked unbound, so the query follows the cursor instance in `args`
+    _query_index = 1
+    # Statements prepared by the connection's auto_prepare, if any
+    _prepared_statements = None
+
     def __init__(self, cursor_factory, tracer=None, span_tags=None, trace_execute=True, trace_executemany=True,
-                 trace_callproc=True, *args, **kwargs):
+                 trace_callproc=True, span_template_cache=None, statement_mode=RAW, sampler=None,
+                 slow_query_threshold=None, stack_capture=None, max_statement_length=None, measure_batch_bytes=False,
+                 trace_fetch=False, leaf_spans=False, insert_paging=None, config=None, *args, **kwargs):
         _Cursor.__init__(self, tracer=tracer, span_tags=span_tags, trace_execute=trace_execute,
-                         trace_executemany=trace_executemany, trace_callproc=trace_callproc)
+                         trace_executemany=trace_executemany, trace_callproc=trace_callproc,
+                         span_template_cache=span_template_cache, statement_mode=statement_mode, sampler=sampler,
+                         slow_query_threshold=slow_query_threshold, stack_capture=stack_capture,
+                         max_statement_length=max_statement_length, measure_batch_bytes=measure_batch_bytes,
+                         trace_fetch=trace_fetch, leaf_spans=leaf_spans, insert_paging=insert_paging, config=config)
         # Since we should support any psycopg cursor type, proxy methods for traced execution
         self._cursor_factory = cursor_factory
 
-    def _get_statement(self, args):
-        if isinstance(args[1], bytes):
-            arg = args[1].decode('utf8', 'replace')
-        elif isinstance(args[1], Composed):
-            if len(args[1].seq) > 0:
-                arg = args[1].seq[0].string
-            else:
-                arg = ''
+    def _composable_strings(self, composable):
+        if isinstance(composable, Composed):
+            for part in composable.seq:
+                for string in self._composable_strings(part):
+                    yield string
         else:
-            arg = args[1]
-        return arg.split(' ')[0]
+            yield composable.as_string(self.connection)
+
+    def _render_composable(self, composable):
+        """Renders `composable` up to max_statement_length, returning the rendered query and whether it was truncated"""
+        limit = self._self_config.max_statement_length
+        if limit is None:
+            return composable.as_string(self.connection), False
+
+        strings, length = [], 0
+        for string in self._composable_strings(composable):
+            strings.append(string)
+            length += len(string)
+            if length > limit:
+                return u''.join(strings)[:limit], True
+        return u''.join(strings), False
 
     def _get_query(self, args):
         query = args[1]
-        if isinstance(query, Composed):
-            query = query.as_string(self.connection)
+        if isinstance(query, Composable):
+            return self._render_composable(query)
         return self._format_query(query)
 
-    def execute(self, *args, **kwargs):
-        if not self._self_trace_execute:
-            return self._cursor_factory.execute(self, *args, **kwargs)
+    def _driver_method(self, name):
+        method = getattr(self._cursor_factory, name, None)
+        return None if method is None else partial(method, self)
+
+    def _driver_rowcount(self):
+        return _get_driver_attribute(self, self._cursor_factory, 'rowcount')
+
+    def _set_driver_rowcount(self, value):
+        _set_driver_attribute(self, self._cursor_factory, 'rowcount', value)
+
+    def _prepared_execute(self, args, kwargs):
+        """Client execute(), or its auto_prepare replacement for `args` and `kwargs` if prepared statements are used."""
+        statements = self._prepared_statements
+        # Named cursor statements are DECLAREd, and can't be EXECUTEd
+        if statements is None or self.name is not None:
+            return self._cursor_factory.execute
+        return statements.execution(self._cursor_factory.execute, args, kwargs)
+
+    def _rows_produced(self, func):
+        if isinstance(func, _PagedExecution):
+            return func.rowcount
+        return _Cursor._rows_produced(self, func)
+
+    def _get_batch(self, func, args):
+        if isinstance(func, (_PreparedExecution, _PagedExecution)):
+            return args, func
+        return _Cursor._get_batch(self, func, args)
+
+    def _start_fetch(self, func, span, template, executed):
+        # psycopg2.extras functions only leave the results of their last page, if not fetched already
+        if not isinstance(func, _PagedExecution):
+            _Cursor._start_fetch(self, func, span, template, executed)
+
+    def _finish_polled(self, polled, error=None):
+        """Finishes the span of an asynchronous connection execution as of its last poll() call."""
+        span = polled.span
+        polled.set_tags(span)
+        if error is not None:
+            self._self_config.stack_capture.set_error_tags(span, error)
+        else:
+            span.set_tag('db.rows_produced', self._rows_produced(polled.func))
+        span.finish(finish_time=polled.polled + _PERF_COUNTER_OFFSET)
+        if error is None:
+            self._start_fetch(polled.func, span, polled.template, polled.polled)
+
+    def _new_fetch(self, context, template, executed):
+        if self.name is None:
+            return _Fetch(context, template, executed)
+        # Named cursor executions only declare the cursor, whose results are streamed by fetch calls
+        return _StreamingFetch(context, template, executed, self.itersize)
+
+    def _streamed_rows(self, fetch):
+        """Generates named cursor rows like psycopg iteration does, with a timed FETCH FORWARD itersize round trip."""
+        fetchmany = self._cursor_factory.fetchmany
+        try:
+            while True:
+                start = perf_counter()
+                rows = fetchmany(self, self.itersize)
+                fetch.fetched(start, len(rows))
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            fetch.finished = perf_counter()
+        if self._self_fetch is fetch:
+            self._finish_fetch()
+
+
+class _PsycopgCursorMethods(object):
+    """Traced _PsycopgCursorTracing methods, defined by its subclasses specialized for their trace flag."""
 
-        return self._traced_execution(self._cursor_factory.execute, self, *args, **kwargs)
+    def execute(self, *args, **kwargs):
+        return self._traced_execution(self._prepared_execute(args, kwargs), self, *args, **kwargs)
 
     def executemany(self, *args, **kwargs):
-        if not self._self_trace_executemany:
-            return self._cursor_factory.executemany(self, *args, **kwargs)
-
-        return self._traced_execution(self._cursor_factory.executemany, self, *args, **kwargs)
+        func = self._paged_executemany(self._cursor_factory.executemany, args, kwargs)
+        return self._traced_execution(func, self, *args, **kwargs)
 
     def callproc(self, *args, **kwargs):
-        if not self._self_trace_callproc:
-            return self._cursor_factory.callproc(self, *args, **kwargs)
-
         return self._traced_execution(self._cursor_factory.callproc, self, *args, **kwargs)
 
+    def fetchone(self):
+        return self._traced_fetch(self._cursor_factory.fetchone, self)
+
+    def fetchmany(self, *args, **kwargs):
+        return self._traced_fetch(self._cursor_factory.fetchmany, self, *args, **kwargs)
+
+    def fetchall(self):
+        return self._traced_fetch(self._cursor_factory.fetchall, self)
+
+    def __iter__(self):
+        if self._self_fetch is None:
+            return self._cursor_factory.__iter__(self)
+        if self.name is not None:
+            return self._streamed_rows(self._self_fetch)
+        # psycopg cursors are their own iterators
+        return self._traced_rows(self._self_fetch, self._cursor_factory.__iter__(self))
+
+    def close(self):
+        self._finish_fetch()
+        return self._cursor_factory.close(self)
+
+    def _untraced_execute(self, *args, **kwargs):
+        self._self_rowcount = None
+        return self._cursor_factory.execute(self, *args, **kwargs)
+
+    def _untraced_callproc(self, *args, **kwargs):
+        self._self_rowcount = None
+        return self._cursor_factory.callproc(self, *args, **kwargs)
+
+    def _traced_execution(self, func, *args, **kwargs):
+        # Asynchronous connection executions only send their query, and their span is finished by the connection's
+        # poll() once their results have arrived.  Tail-based tracing is not applied, as the span is already started.
+        self._finish_fetch()
+        self._self_rowcount = None
+        if _is_unsampled(self._active_span()):
+            return func(*args, **kwargs)
+        config = self._self_config
+        dropped = 0
+        if config.sampler is not None:
+            dropped = config.sampler.sample(self._get_sampling_key(args))
+            if dropped is None:
+                return func(*args, **kwargs)
+
+        template = self._get_span_template(func, args)
+        span = self._start_span(template)
+        if dropped:
+            span.set_tag('db.sampler.dropped', dropped)
+        try:
+            val = func(*args, **kwargs)
+        except Exception as e:
+            config.stack_capture.set_error_tags(span, e)
+            span.finish()
+            raise
+        self.connection._polled_execution = _PolledExecution(self, span, template, func, perf_counter())
+        return val
+
+
+class _FactoryClassCache(object):
+    """
+    Traced subclasses of psycopg factories, defined by `define` once per factory and trace flag combination under a
+    lock and then looked up without one.  Subclasses are strongly referenced by flags from their factory's own
+    `attribute` dict, so that they outlive their instances but are discarded along with their factory, which they
+    would keep alive through their __bases__ as values of a dict keyed by it.  Extension types (e.g.
+    psycopg2.extensions.cursor), which are never discarded, are stored in a dict instead.
+    """
+
+    def __init__(self, attribute, define):
+        self._attribute = attribute
+        self._define = define
+        self._classes = {}
+        self._lock = Lock()
+        # Number of defined subclasses
+        self.definitions = 0
+
+    def _lookup(self, factory):
+        classes = self._classes.get(factory)
+        if classes is None:
+            classes = factory.__dict__.get(self._attribute)
+        return classes
+
+    def get(self, factory, flags):
+        classes = self._lookup(factory)
+        traced = classes.get(flags) if classes is not None else None
+        if traced is None:
+            with self._lock:
+                classes = self._lookup(factory)
+                if classes is None:
+                    classes = {}
+                    try:
+                        setattr(factory, self._attribute, classes)
+                    except TypeError:  # Extension type
+                        self._classes[factory] = classes
+                traced = classes.get(flags)
+                if traced is None:
+                    traced = classes[flags] = self._define(factory, flags)
+                    self.definitions += 1
+        return traced
+
+
+def _define_cursor_factory(factory, flags):
+    class CursorFactory(_PsycopgCursorTracing, factory):
+        """Traced cursor_factory instance."""
+        def __init__(self, conn, *a, **kw):
+            # Pop all _PsycopgCursorTracing tracing flags to be able to
+            # pass custom cursor factory (kw)args
+            _PsycopgCursorTracing.__init__(
+                self, cursor_factory=factory,
+                tracer=kw.pop('tracer', None),
+                span_tags=kw.pop('span_tags', None),
+                trace_execute=kw.pop('trace_execute', True),
+                trace_executemany=kw.pop('trace_executemany', True),
+                trace_callproc=kw.pop('trace_callproc', True),
+                span_template_cache=kw.pop('span_template_cache', None),
+                statement_mode=kw.pop('statement_mode', RAW),
+                sampler=kw.pop('sampler', None),
+                slow_query_threshold=kw.pop('slow_query_threshold', None),
+                stack_capture=kw.pop('stack_capture', None),
+                max_statement_length=kw.pop('max_statement_length', None),
+                measure_batch_bytes=kw.pop('measure_batch_bytes', False),
+                trace_fetch=kw.pop('trace_fetch', False),
+                leaf_spans=kw.pop('leaf_spans', False),
+                insert_paging=kw.pop('insert_paging', None),
+                config=kw.pop('config', None)
+            )
+            factory.__init__(self, conn, *a, **kw)
+            self._prepared_statements = getattr(conn, '_prepared_statements', None)
+
+    methods = _traced_methods(_PsycopgCursorMethods, _PSYCOPG_CURSOR_FLAG_METHODS, flags)
+    methods.update(_rowcount_reset_methods(_PsycopgCursorMethods, _PSYCOPG_CURSOR_FLAG_METHODS, flags))
+    for name, method in methods.items():
+        setattr(CursorFactory, name, method)
+    CursorFactory.__name__ = factory.__name__
+    return CursorFactory
+
 
 # Storage for CursorFactory classes to prevent redundant definitions
-_cursor_factory_classes = {}
-_cursor_factory_lock = Lock()
+_cursor_factory_classes = _FactoryClassCache('_traced_cursor_factory', _define_cursor_factory)
 
 
 class PsycopgCursorTracing(object):
     """
     Traced psycopg cursor_factory-compatible pseudo-metaclass, which generates and instantiates traced
-    cursor_factory subclass.
+    cursor_factory subclass.  Subclasses are specialized per trace flag combination, and only override the methods
+    being traced, and on whether their connection is an asynchronous PsycopgConnectionTracing one.
     """
     def __new__(cls, *args, **kwargs):
         factory = kwargs.pop('cursor_factory', PsycopgCursor)
-        with _cursor_factory_lock:
-            if factory not in _cursor_factory_classes:
-
-                class CursorFactory(_PsycopgCursorTracing, factory):
-                    """Traced cursor_factory instance."""
-                    def __init__(self, conn, *a, **kw):
-                        # Pop all _PsycopgCursorTracing tracing flags to be able to
-                        # pass custom cursor factory (kw)args
-                        _PsycopgCursorTracing.__init__(
-                            self, cursor_factory=factory,
-                            tracer=kw.pop('tracer', None),
-                            span_tags=kw.pop('span_tags', None),
-                            trace_execute=kw.pop('trace_execute', True),
-                            trace_executemany=kw.pop('trace_executemany', True),
-                            trace_callproc=kw.pop('trace_callproc', True)
-                        )
-                        factory.__init__(self, conn, *a, **kw)
-
-                CursorFactory.__name__ = factory.__name__
-                _cursor_factory_classes[factory] = CursorFactory
-
-        return _cursor_factory_classes[factory](*args, **kwargs)
+        config = kwargs.get('config')
+        if config is not None:
+            flags = _cursor_flags(config)
+        else:
+            flags = _enabled_cursor_flags(kwargs.get('tracer'), kwargs.get('trace_execute', True),
+                                          kwargs.get('trace_executemany', True), kwargs.get('trace_callproc', True),
+                                          kwargs.get('trace_fetch', False), kwargs.get('insert_paging'))
+        conn = kwargs['conn'] if 'conn' in kwargs else args[0]
+        flags += (getattr(conn, '_is_async', False),)
+        return _cursor_factory_classes.get(factory, flags)(*args, **kwargs)
 
 
 class _PsycopgConnectionTracing(_ConnectionTracing):
@@ -101,45 +403,111 @@ class _PsycopgConnectionTracing(_ConnectionTracing):
     Traced mixin for psycopg2 connection.  `connection_factory` should be provided as invoking classes' psycopg
     connection superclass (psycopg.extensions.connection as default) for proxying traced commit and cursor.
     """
+    # Whether connections were created with async_=1, set for each generated subclass
+    _is_async = False
+
     def __init__(self, dsn, connection_factory=PsycopgConnection, cursor_factory=PsycopgCursor, tracer=None,
                  span_tags=None, trace_commit=True, trace_rollback=True, trace_execute=True, trace_executemany=True,
-                 trace_callproc=True, *args, **kwargs):
+                 trace_callproc=True, span_template_cache_size=128, statement_mode=RAW, sampler=None,
+                 slow_query_threshold=None, stack_capture=None, max_statement_length=None, measure_batch_bytes=False,
+                 trace_fetch=False, leaf_spans=False, insert_paging=None, auto_prepare=None, *args, **kwargs):
         _ConnectionTracing.__init__(
             self, tracer=tracer, span_tags=span_tags, trace_commit=trace_commit, trace_rollback=trace_rollback,
-            trace_execute=trace_execute, trace_executemany=trace_executemany, trace_callproc=trace_callproc
+            trace_execute=trace_execute, trace_executemany=trace_executemany, trace_callproc=trace_callproc,
+            span_template_cache_size=span_template_cache_size, statement_mode=statement_mode, sampler=sampler,
+            slow_query_threshold=slow_query_threshold, stack_capture=stack_capture,
+            max_statement_length=max_statement_length, measure_batch_bytes=measure_batch_bytes,
+            trace_fetch=trace_fetch, leaf_spans=leaf_spans, insert_paging=insert_paging
         )
         self._connection_factory = connection_factory
         self._cursor_factory = cursor_factory
+        # Asynchronous connection execution awaiting its results, if any
+        self._polled_execution = None
+        # Statements prepared by auto_prepare, which asynchronous connections can't PREPARE alongside their executions
+        self._prepared_statements = (_PreparedStatements(auto_prepare)
+                                     if auto_prepare is not None and not self._is_async else None)
 
         self._commit_operation_name = _operation_name(self, self.commit)
         self._rollback_operation_name = _operation_name(self, self.rollback)
 
     def cursor(self, name=None, *args, **kwargs):
-        trace_execute = kwargs.pop('trace_execute', self._self_trace_execute)
-        trace_executemany = kwargs.pop('trace_executemany', self._self_trace_executemany)
-        trace_callproc = kwargs.pop('trace_callproc', self._self_trace_callproc)
-
+        config = self._get_cursor_config(kwargs)
         cursor_factory = kwargs.pop('cursor_factory', self._cursor_factory)
-        return PsycopgCursorTracing(conn=self, name=name, cursor_factory=cursor_factory, tracer=self._self_tracer,
-                                    span_tags=self._self_span_tags, trace_execute=trace_execute,
-                                    trace_executemany=trace_executemany, trace_callproc=trace_callproc, *args, **kwargs)
+        return PsycopgCursorTracing(conn=self, name=name, cursor_factory=cursor_factory, config=config, *args,
+                                    **kwargs)
 
-    def commit(self):
-        if not self._self_trace_commit:
-            return self._connection_factory.commit(self)
 
+class _PsycopgConnectionMethods(object):
+    """Traced _PsycopgConnectionTracing methods, defined by its subclasses specialized for their trace flag."""
+
+    def commit(self):
         return self._traced_execution(self._commit_operation_name, self._connection_factory.commit, self)
 
     def rollback(self):
-        if not self._self_trace_rollback:
-            return self._connection_factory.rollback(self)
-
         return self._traced_execution(self._rollback_operation_name, self._connection_factory.rollback, self)
 
+    def poll(self):
+        polled = self._polled_execution
+        if polled is None:
+            return self._connection_factory.poll(self)
+
+        start = perf_counter()
+        try:
+            state = self._connection_factory.poll(self)
+        except Exception as e:
+            polled.poll(start, None)
+            self._polled_execution = None
+            polled.cursor._finish_polled(polled, e)
+            raise
+        polled.poll(start, state)
+        if state == POLL_OK:
+            self._polled_execution = None
+            polled.cursor._finish_polled(polled)
+        return state
+
+
+def _define_connection_factory(factory, flags):
+    class ConnectionFactory(_PsycopgConnectionTracing, factory):
+
+        def __init__(self, dsn, *a, **kw):
+            # Pop all _PsycopgConnectionTracing tracing flags to be able to
+            # pass custom connection factory (kw)args
+            pct_args = dict(
+                dsn=dsn, connection_factory=factory,
+                tracer=kw.pop('tracer', None),
+                span_tags=kw.pop('span_tags', None),
+                trace_commit=kw.pop('trace_commit', True),
+                trace_rollback=kw.pop('trace_rollback', True),
+                trace_execute=kw.pop('trace_execute', True),
+                trace_executemany=kw.pop('trace_executemany', True),
+                trace_callproc=kw.pop('trace_callproc', True),
+                span_template_cache_size=kw.pop('span_template_cache_size', 128),
+                statement_mode=kw.pop('statement_mode', RAW),
+                sampler=kw.pop('sampler', None),
+                slow_query_threshold=kw.pop('slow_query_threshold', None),
+                stack_capture=kw.pop('stack_capture', None),
+                max_statement_length=kw.pop('max_statement_length', None),
+                measure_batch_bytes=kw.pop('measure_batch_bytes', False),
+                trace_fetch=kw.pop('trace_fetch', False),
+                leaf_spans=kw.pop('leaf_spans', False),
+                insert_paging=kw.pop('insert_paging', None),
+                auto_prepare=kw.pop('auto_prepare', None)
+            )
+            if 'cursor_factory' in kw:
+                pct_args['cursor_factory'] = kw['cursor_factory']
+
+            _PsycopgConnectionTracing.__init__(self, **pct_args)
+            factory.__init__(self, dsn, *a, **kw)
+
+    for name, method in _traced_methods(_PsycopgConnectionMethods, _PSYCOPG_CONNECTION_FLAG_METHODS, flags).items():
+        setattr(ConnectionFactory, name, method)
+    ConnectionFactory._is_async = flags[2]
+    ConnectionFactory.__name__ = factory.__name__
+    return ConnectionFactory
+
 
 # Storage for ConnectionFactory classes to prevent redundant definitions
-_connection_factory_classes = {}
-_connection_factory_lock = Lock()
+_connection_factory_classes = _FactoryClassCache('_traced_connection_factory', _define_connection_factory)
 
 
 class PsycopgConnectionTracing(object):
@@ -158,35 +526,15 @@ class PsycopgConnectionTracing(object):
         )
     )
     assert isinstance(connection, LogicalReplicationConnection)
+
+    Subclasses are specialized per `trace_commit` and `trace_rollback` combination, and only override the methods
+    being traced.  Asynchronous connections (async_=1) trace each execution from execute() until their poll()
+    returns POLL_OK or raises, tagging it with the number of polls and time spent waiting versus processing.
     """
     def __new__(cls, *args, **kwargs):
         factory = kwargs.pop('connection_factory', PsycopgConnection)
-
-        with _connection_factory_lock:
-            if factory not in _cursor_factory_classes:
-
-                class ConnectionFactory(_PsycopgConnectionTracing, factory):
-
-                    def __init__(self, dsn, *a, **kw):
-                        # Pop all _PsycopgConnectionTracing tracing flags to be able to
-                        # pass custom connection factory (kw)args
-                        pct_args = dict(
-                            dsn=dsn, connection_factory=factory,
-                            tracer=kw.pop('tracer', None),
-                            span_tags=kw.pop('span_tags', None),
-                            trace_commit=kw.pop('trace_commit', True),
-                            trace_rollback=kw.pop('trace_rollback', True),
-                            trace_execute=kw.pop('trace_execute', True),
-                            trace_executemany=kw.pop('trace_executemany', True),
-                            trace_callproc=kw.pop('trace_callproc', True)
-                        )
-                        if 'cursor_factory' in kw:
-                            pct_args['cursor_factory'] = kw['cursor_factory']
-
-                        _PsycopgConnectionTracing.__init__(self, **pct_args)
-                        factory.__init__(self, dsn, *a, **kw)
-
-                ConnectionFactory.__name__ = factory.__name__
-                _connection_factory_classes[factory] = ConnectionFactory
-
-        return _connection_factory_classes[factory](*args, **kwargs)
+        # psycopg2.connect() passes `async_` positionally
+        is_async = args[1] if len(args) > 1 else kwargs.get('async_', kwargs.get('async', False))
+        flags = _enabled_flags(kwargs.get('tracer'), kwargs.get('trace_commit', True),
+                               kwargs.get('trace_rollback', True)) + (bool(is_async),)
+        return _connection_factory_classes.get(factory, flags)(*args, **kwargs)
@@ -0,0 +1,336 @@
+from collections import deque
+from contextlib import contextmanager
+import warnings
+import re
+
+from opentracing.ext import tags
+
+from .subclass_tracing import _TRACING_ARGUMENTS, _SubclassConnectionTracing, _SubclassCursorTracing, traced_subclass
+from .tracing import (_CURSOR_FLAG_METHODS, Cursor, _ConnectionTracing, _Cursor, _cursor_flags, _enabled_flags,
+                      _is_unsampled, _operation_name, perf_counter)
+from .sql import parse_statement
+
+try:
+    from psycopg import Connection as PsycopgConnection, __version__ as _psycopg_version
+    from psycopg.sql import Composable
+except ImportError:
+    PsycopgConnection = _psycopg_version = None
+    Composable = type('Composable', tuple(), {})
+
+
+def _version_info(version):
+    return tuple(int(part) for part in re.match(r'(\d+)\.(\d+)', version).groups())
+
+
+# Pipeline mode was added in psycopg 3.1.  Pipelined statements are observed through the cursor internals
+# _maybe_prepare_gen(), which queues them, and _check_results(), which their results are received by (through
+# _set_results_from_pipeline() in 3.1, and Pipeline._process_results() as of 3.2), and which are only known to
+# behave so up to PIPELINE_TRACING_VERSIONS[1].  Executions in pipeline mode of later versions are traced as they are
+# queued, and pipeline() blocks without their db.pipeline tags.
+PSYCOPG_MIN_VERSION = (3, 1)
+PIPELINE_TRACING_VERSIONS = (PSYCOPG_MIN_VERSION, (3, 3))
+_PSYCOPG_VERSION = _version_info(_psycopg_version) if _psycopg_version else None
+if _PSYCOPG_VERSION is not None and _PSYCOPG_VERSION > PIPELINE_TRACING_VERSIONS[1]:
+    warnings.warn('psycopg {} pipeline mode is not supported by dbapi_opentracing: pipelined executions will be '
+                  'traced as they are queued.'.format(_psycopg_version))
+
+
+def _pipeline_tracing():
+    version = _PSYCOPG_VERSION
+    return version is None or PIPELINE_TRACING_VERSIONS[0] <= version <= PIPELINE_TRACING_VERSIONS[1]
+
+
+# psycopg cursors have no callproc(), and traced methods enabled by trace_fetch additionally include close(), which
+# reports the pending fetch span
+_PSYCOPG_CURSOR_FLAG_METHODS = (_CURSOR_FLAG_METHODS[0], _CURSOR_FLAG_METHODS[1], (),
+                                _CURSOR_FLAG_METHODS[-1] + ('close',))
+
+
+class _PipelineTrace(object):
+    """
+    Statements queued by the traced cursors of a connection in pipeline mode.  Results received after statements
+    were queued since the previous ones are counted as a round trip.
+    """
+    __slots__ = ('statements', 'round_trips', 'cursors', '_queued')
+
+    def __init__(self):
+        self.statements = 0
+        self.round_trips = 0
+        # Cursors with pipelined executions, whose unreceived ones are discarded once the pipeline is exited
+        self.cursors = []
+        self._queued = False
+
+    def queued(self):
+        self.statements += 1
+        self._queued = True
+
+    def received(self):
+        if self._queued:
+            self.round_trips += 1
+            self._queued = False
+
+    def set_tags(self, span):
+        span.set_tag('db.pipeline.statements', self.statements)
+        span.set_tag('db.pipeline.round_trips', self.round_trips)
+        span.set_tag('db.pipeline.round_trips_saved', max(self.statements - self.round_trips, 0))
+
+
+class _PipelinedExecution(object):
+    """
+    Execution queued in pipeline mode, whose span is finished once the results of its statements (from `first` to
+    `until` in its cursor's count of queued statements) are received.
+    """
+    __slots__ = ('span', 'template', 'func', 'batch', 'started', 'first', 'until', 'rows', 'finished')
+
+    def __init__(self, span, template, func, batch, first):
+        self.span = span
+        self.template = template
+        self.func = func
+        self.batch = batch
+        self.started = perf_counter()
+        self.first = first
+        # Unknown until the execution has returned
+        self.until = None
+        self.rows = 0
+        self.finished = False
+
+    def finish(self, cursor, error=None):
+        self.finished = True
+        span = self.span
+        now = perf_counter()
+        if error is not None:
+            cursor._self_config.stack_capture.set_error_tags(span, error)
+        else:
+            span.set_tag('db.rows_produced', self.rows)
+        if self.batch is not None:
+            self.batch.set_tags(span, now - self.started)
+        span.finish()
+        if error is None:
+            cursor._start_fetch(self.func, span, self.template, now)
+
+
+class _PsycopgCursorTracing(_SubclassCursorTracing):
+    """
+    Traced mixin for subclasses of psycopg (3) cursor classes.  Executions in pipeline mode are traced from their
+    call until their results are received, without waiting for them.
+    """
+    _flag_methods = _PSYCOPG_CURSOR_FLAG_METHODS
+
+    def __init__(self, connection, *args, **kwargs):
+        _SubclassCursorTracing.__init__(self, connection, *args, **kwargs)
+        # Pipelined executions awaiting their results, and counts of this cursor's queued and received statements
+        self._self_pipelined = deque()
+        self._self_queued = 0
+        self._self_received = 0
+
+    def _get_query(self, args):
+        query = args[1]
+        if isinstance(query, Composable):
+            return self._format_query(query.as_string(self))
+        return self._format_query(query)
+
+    def _get_statement(self, args):
+        query = args[1]
+        if isinstance(query, Composable):
+            return parse_statement(query.as_string(self))
+        return parse_statement(query)
+
+    def _traced_execution(self, func, *args, **kwargs):
+        pipeline = getattr(self._conn, '_self_pipeline', None)
+        if pipeline is None or self._self_executing:
+            return _SubclassCursorTracing._traced_execution(self, func, *args, **kwargs)
+
+        # Tail-based tracing (slow_query_threshold) is not applied, as results have yet to be received
+        self._finish_fetch()
+        self._self_rowcount = None
+        if _is_unsampled(self._active_span()):
+            return func(*args, **kwargs)
+        config = self._self_config
+        dropped = 0
+        if config.sampler is not None:
+            dropped = config.sampler.sample(self._get_sampling_key(args))
+            if dropped is None:
+                return func(*args, **kwargs)
+
+        args, batch = self._get_batch(func, args)
+        template = self._get_span_template(func, args)
+        span = self._start_span(template)
+        if dropped:
+            span.set_tag('db.sampler.dropped', dropped)
+        execution = _PipelinedExecution(span, template, func, batch, self._self_queued)
+        if not self._self_pipelined:
+            pipeline.cursors.append(self)
+        self._self_pipelined.append(execution)
+        self._self_executing = True
+        try:
+            val = func(*args, **kwargs)
+        except Exception as e:
+            if not execution.finished:
+                self._self_pipelined.remove(execution)
+                execution.finish(self, e)
+            raise
+        finally:
+            self._self_executing = False
+        execution.until = self._self_queued
+        self._finish_pipelined()
+        return val
+
+    def _finish_pipelined(self):
+        pipelined = self._self_pipelined
+        while pipelined and pipelined[0].until is not None and pipelined[0].until <= self._self_received:
+            pipelined.popleft().finish(self)
+
+    def _discard_pipelined(self):
+        """Finishes the spans of pipelined executions whose results were never received (e.g. connection lost)"""
+        pipelined = self._self_pipelined
+        while pipelined:
+            pipelined.popleft().span.finish()
+        self._self_queued = self._self_received = 0
+
+    def _maybe_prepare_gen(self, *args, **kwargs):
+        # Statements are queued by (and only by) this generator in pipeline mode
+        results = yield from self._driver_class._maybe_prepare_gen(self, *args, **kwargs)
+        if self._conn._pipeline is not None:
+            self._self_queued += 1
+            pipeline = getattr(self._conn, '_self_pipeline', None)
+            if pipeline is not None:
+                pipeline.queued()
+        elif self._self_queued != self._self_received:
+            self._discard_pipelined()
+        return results
+
+    def _check_results(self, results):
+        # Results of statements queued in pipeline mode are checked as they are received, and only then set
+        if self._conn._pipeline is None:
+            return self._driver_class._check_results(self, results)
+
+        self._self_received += 1
+        pipeline = getattr(self._conn, '_self_pipeline', None)
+        if pipeline is not None:
+            pipeline.received()
+
+        pipelined = self._self_pipelined
+        # Results of untraced executions precede those of the first pending one
+        execution = pipelined[0] if pipelined and pipelined[0].first < self._self_received else None
+        try:
+            self._driver_class._check_results(self, results)
+        except Exception as e:
+            if execution is not None:
+                pipelined.popleft()
+                execution.finish(self, e)
+            raise
+        if execution is not None:
+            execution.rows += sum(result.command_tuples or 0 for result in results)
+        self._finish_pipelined()
+
+
+def _traced_cursor_class(cls, flags):
+    return traced_subclass(cls, _PsycopgCursorTracing, flags) or cls
+
+
+class _PsycopgConnectionTracing(_SubclassConnectionTracing):
+    """
+    Traced mixin for subclasses of psycopg (3) connection classes, whose cursor factories provide traced subclasses
+    of their cursor classes, and whose outermost pipeline() blocks are traced.
+    """
+
+    def __init__(self, *args, **kwargs):
+        _SubclassConnectionTracing.__init__(self, *args, **kwargs)
+        self._self_pipeline_operation_name = _operation_name(self, self._driver_class.pipeline)
+        # Pipeline of the traced pipeline() block, if any
+        self._self_pipeline = None
+
+    @classmethod
+    def connect(cls, conninfo='', **kwargs):
+        # psycopg instantiates connections itself, so they are configured once connected
+        tracing_kwargs = dict((name, kwargs.pop(name)) for name in _TRACING_ARGUMENTS if name in kwargs)
+        connection = super().connect(conninfo, **kwargs)
+        _ConnectionTracing.__init__(connection, **tracing_kwargs)
+        return connection
+
+    @property
+    def cursor_factory(self):
+        return _traced_cursor_class(self._self_cursor_factory, _cursor_flags(self._self_cursor_config))
+
+    @cursor_factory.setter
+    def cursor_factory(self, value):
+        self._self_cursor_factory = value
+
+    @property
+    def server_cursor_factory(self):
+        return _traced_cursor_class(self._self_server_cursor_factory, _cursor_flags(self._self_cursor_config))
+
+    @server_cursor_factory.setter
+    def server_cursor_factory(self, value):
+        self._self_server_cursor_factory = value
+
+    def cursor(self, *args, **kwargs):
+        config = self._get_cursor_config(kwargs)
+        cursor = self._driver_class.cursor(self, *args, **kwargs)
+        if not isinstance(cursor, _Cursor):
+            return Cursor(cursor, config=config)
+        if config is not self._self_cursor_config:
+            # Cursors with overridden trace flags are retyped to the subclass specialized for them
+            cursor.__class__ = _traced_cursor_class(cursor._driver_class, _cursor_flags(config))
+            cursor._self_config = config
+        return cursor
+
+    @contextmanager
+    def pipeline(self):
+        if self._pipeline is not None or self._self_pipeline is not None:  # Nested pipeline() blocks
+            with self._driver_class.pipeline(self) as pipeline:
+                yield pipeline
+            return
+
+        with self._self_tracer.start_active_span(self._self_pipeline_operation_name) as scope:
+            span = scope.span
+            span.set_tag(tags.DATABASE_TYPE, 'sql')
+            span.set_tag(tags.SPAN_KIND, tags.SPAN_KIND_RPC_CLIENT)
+            for tag, value in self._self_span_tags.items():
+                span.set_tag(tag, value)
+
+            # Pipelines of unsupported psycopg versions are traced without their statements
+            trace = self._self_pipeline = _PipelineTrace() if _pipeline_tracing() else None
+            try:
+                with self._driver_class.pipeline(self) as pipeline:
+                    yield pipeline
+            except Exception as e:
+                self._self_stack_capture.set_error_tags(span, e)
+                raise
+            finally:
+                self._self_pipeline = None
+                if trace is not None:
+                    for cursor in trace.cursors:
+                        cursor._discard_pipelined()
+                    trace.set_tags(span)
+
+    def __enter__(self):
+        return self._driver_class.__enter__(self)
+
+    def __exit__(self, exc, value, tb):
+        # psycopg connections commit or roll back through their (traced) methods
+        return self._driver_class.__exit__(self, exc, value, tb)
+
+
+class PsycopgConnectTracing(object):
+    """
+    Traced psycopg (3) connect() pseudo-metaclass, which generates (once) a traced subclass of the
+    `connection_factory` connection class (psycopg.Connection as default) and connects with it.  Its cursors are
+    traced subclasses of the connection's `cursor_factory` and `server_cursor_factory` classes.
+
+    connection = PsycopgConnectTracing('dbname=test', tracer=tracer, autocommit=True)
+    assert isinstance(connection, psycopg.Connection)
+
+    Statements executed in pipeline mode are traced without waiting for their results, and their spans are finished
+    as their results are received.  Traced pipeline() blocks are tagged with the number of `db.pipeline.statements`
+    queued by traced cursors, the `db.pipeline.round_trips` they were received in, and their difference as
+    `db.pipeline.round_trips_saved`.  slow_query_threshold does not apply to pipelined executions.
+    """
+    def __new__(cls, conninfo='', connection_factory=None, **kwargs):
+        if _PSYCOPG_VERSION is not None and _PSYCOPG_VERSION < PSYCOPG_MIN_VERSION:
+            raise RuntimeError('PsycopgConnectTracing requires psycopg {}.{} or later, not {}.'.format(
+                PSYCOPG_MIN_VERSION[0], PSYCOPG_MIN_VERSION[1], _psycopg_version))
+        factory = connection_factory or PsycopgConnection
+        flags = _enabled_flags(kwargs.get('tracer'), kwargs.get('trace_commit', True),
+                               kwargs.get('trace_rollback', True))
+        return traced_subclass(factory, _PsycopgConnectionTracing, flags).connect(conninfo, **kwargs)
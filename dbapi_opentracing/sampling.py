@@ -0,0 +1,92 @@
+from threading import Lock
+
+from .cache import LRUCache
+from .sql import normalize_statement, parse_statement
+
+try:
+    from time import monotonic
+except ImportError:  # py2
+    from time import time as monotonic
+
+
+def fingerprint_key(query):
+    """
+    Sampling key of a str or bytes `query`: its normalized statement fingerprint, memoized per query text, so that
+    each statement is sampled on its own regardless of its literals.
+    """
+    return normalize_statement(query).fingerprint
+
+
+def verb_table_key(query):
+    """
+    Sampling key of a `query`: its verb and table, parsed from its prefix and memoized per query text, which groups
+    all the statements of a verb on a table, but never normalizes queries of executions that are then dropped.
+    """
+    statement = parse_statement(query)
+    return statement.verb, statement.table
+
+
+class _TokenBucket(object):
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'dropped')
+
+    def __init__(self, rate, now):
+        self.rate = rate
+        # Allow a burst of one second's worth of spans (and at least one) after an idle period
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = now
+        self.dropped = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class TokenBucketSampler(object):
+    """
+    Head sampler of traced executions allowing up to `rate` spans per second for each statement key, and up to
+    `global_rate` spans per second overall if provided.  Statement keys are obtained from queries by `key`, their
+    fingerprint (fingerprint_key) by default.  Executions exceeding these rates are counted per key and reported by the
+    next sampled execution of the same key.  Token buckets are kept for the `max_fingerprints` most recently executed
+    statement keys.
+    """
+
+    def __init__(self, rate=10, global_rate=None, max_fingerprints=1024, clock=monotonic, key=fingerprint_key):
+        self.rate = rate
+        self.global_rate = global_rate
+        self.key = key
+        self._clock = clock
+        self._buckets = LRUCache(max_fingerprints)
+        self._global_bucket = _TokenBucket(global_rate, clock()) if global_rate else None
+        self._lock = Lock()
+
+    def sample(self, key):
+        """
+        Returns None if an execution of a statement of sampling `key` should not be traced, otherwise the number of its
+        executions dropped since it was last sampled.
+        """
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = _TokenBucket(self.rate, now)
+                self._buckets.put(key, bucket)
+            else:
+                bucket.refill(now)
+
+            global_bucket = self._global_bucket
+            if global_bucket is not None:
+                global_bucket.refill(now)
+                if global_bucket.tokens < 1:
+                    bucket.dropped += 1
+                    return None
+
+            if bucket.tokens < 1:
+                bucket.dropped += 1
+                return None
+
+            bucket.tokens -= 1
+            if global_bucket is not None:
+                global_bucket.tokens -= 1
+            dropped, bucket.dropped = bucket.dropped, 0
+            return dropped
@@ -0,0 +1,348 @@
+from collections import namedtuple
+import codecs
+import hashlib
+import re
+
+from .cache import LRUCache
+
+# Verb (upper case) and primary table (None if undetermined) of a SQL statement, and its verb as written in the query
+SQLStatement = namedtuple('SQLStatement', 'verb table keyword')
+
+_EMPTY_STATEMENT = SQLStatement('', None, '')
+
+# Literal-free query text and its stable 64-bit fingerprint (16 hexadecimal digits)
+NormalizedStatement = namedtuple('NormalizedStatement', 'text fingerprint')
+
+# db.statement tagging modes: raw query, normalized query and fingerprint, or fingerprint alone
+RAW = 'raw'
+NORMALIZED = 'normalized'
+FINGERPRINT = 'fingerprint'
+STATEMENT_MODES = (RAW, NORMALIZED, FINGERPRINT)
+
+# Queries are consumed in chunks of this many characters (or bytes) until the statement is resolved
+_CHUNK_SIZE = 1024
+# Upper bound of characters examined per query, beyond which the table is considered undetermined
+_MAX_SCAN_LENGTH = 16384
+
+_WORD, _IDENTIFIER, _LITERAL, _PUNCTUATION = range(4)
+
+# Tokens preceding the target table name that can be skipped for a given verb
+_UPDATE_MODIFIERS = frozenset(('ONLY', 'LOW_PRIORITY', 'IGNORE'))
+_DDL_MODIFIERS = frozenset(('OR', 'REPLACE', 'GLOBAL', 'LOCAL', 'TEMP', 'TEMPORARY', 'UNLOGGED', 'EXTERNAL'))
+_TABLE_MODIFIERS = frozenset(('IF', 'NOT', 'EXISTS', 'ONLY'))
+
+# Words prefixing string constants (e.g. E'\n' or N'text')
+_STRING_PREFIXES = frozenset(('E', 'e', 'N', 'n', 'B', 'b', 'X', 'x'))
+
+_statement_cache = LRUCache(1024)
+_normalized_statement_cache = LRUCache(1024)
+
+_NORMALIZE_PATTERN = re.compile(r"""
+    (?P<space>(?:\s|--[^\n]*|/\*.*?\*/)+)
+  | (?P<identifier>"(?:[^"]|"")*"|`[^`]*`)
+  | (?P<string>(?<![\w$])[EeNnXxBb]?'(?:[^'\\]|\\.|'')*'|\$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?\$(?P=tag)\$)
+  | (?P<number>(?<![\w$.])(?:0[xX][0-9a-fA-F]+|(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)(?![\w$]))
+""", re.DOTALL | re.VERBOSE)
+
+# Signs of normalized numbers following an opening parenthesis, a comma, or a comparison, which are unary
+_SIGNED_NUMBER_PATTERN = re.compile(r'([(,=<>] ?)[-+]\?')
+
+# Parenthesized lists of literals or parameter placeholders, and repetitions of VALUES rows
+_PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|\$[0-9]+|:\w+)'
+_IN_LIST_PATTERN = re.compile(r'\bIN \( ?{0}(?: ?, ?{0})* ?\)'.format(_PLACEHOLDER), re.IGNORECASE)
+_VALUES_ROWS_PATTERN = re.compile(r'(\( ?{0}(?: ?, ?{0})* ?\))(?: ?, ?\( ?{0}(?: ?, ?{0})* ?\))+'.format(_PLACEHOLDER))
+
+
+def _composable_chunks(composable):
+    """Text of psycopg2.sql.Composable objects, without rendering them against a connection."""
+    seq = getattr(composable, 'seq', None)
+    if seq is not None:  # Composed
+        for part in seq:
+            for chunk in _composable_chunks(part):
+                yield chunk
+        return
+
+    strings = getattr(composable, 'strings', None)
+    if strings is not None:  # Identifier (psycopg2 >= 2.8)
+        yield '.'.join('"{}"'.format(string) for string in strings)
+        return
+
+    string = getattr(composable, 'string', None)
+    if string is not None:  # SQL or Identifier (psycopg2 < 2.8)
+        yield string if composable.__class__.__name__ == 'SQL' else '"{}"'.format(string)
+        return
+
+    yield ' ? '  # Literal or Placeholder
+
+
+def _text_chunks(query):
+    if isinstance(query, bytes):
+        # Incrementally decode only as many leading bytes as the lexer consumes
+        decoder = codecs.getincrementaldecoder('utf8')('replace')
+        for start in range(0, len(query), _CHUNK_SIZE):
+            yield decoder.decode(query[start:start + _CHUNK_SIZE])
+    elif hasattr(query, 'as_string'):  # psycopg2.sql.Composable
+        for chunk in _composable_chunks(query):
+            yield chunk
+    else:
+        for start in range(0, len(query), _CHUNK_SIZE):
+            yield query[start:start + _CHUNK_SIZE]
+
+
+def _chars(query):
+    scanned = 0
+    for chunk in _text_chunks(query):
+        for char in chunk:
+            yield char
+        scanned += len(chunk)
+        if scanned >= _MAX_SCAN_LENGTH:
+            return
+
+
+def _quoted(chars, quote, backslashes=False):
+    """
+    Consumes the rest of a `quote` quoted token from `chars`, with doubled quotes (or backslashes if `backslashes`)
+    escaping quotes, returning its text (None for string literals) and the following char.
+    """
+    text = []
+    char = next(chars, None)
+    while char is not None:
+        if char == quote:
+            char = next(chars, None)
+            if char != quote:  # Doubled quotes are escaped quotes
+                break
+        elif backslashes and char == '\\':
+            char = next(chars, None)
+            if char is None:
+                break
+        text.append(char)
+        char = next(chars, None)
+    return (None if quote == '\'' else u''.join(text)), char
+
+
+def _dollar_quoted(chars, delimiter):
+    """Consumes the rest of a dollar-quoted string ending with `delimiter` from `chars`, returning the next char."""
+    window = u''
+    char = next(chars, None)
+    while char is not None:
+        window = (window + char)[-len(delimiter):]
+        char = next(chars, None)
+        if window == delimiter:
+            break
+    return char
+
+
+def _tokens(query):
+    """Generates (kind, text) tokens from `query`, skipping whitespace and comments."""
+    chars = _chars(query)
+    char = next(chars, None)
+    while char is not None:
+        if char.isspace():
+            char = next(chars, None)
+        elif char == '-' or char == '/':
+            following = next(chars, None)
+            if char == '-' and following == '-':
+                while char is not None and char != '\n':
+                    char = next(chars, None)
+            elif char == '/' and following == '*':
+                # Block comments may be nested in PostgreSQL
+                depth, previous, char = 1, None, next(chars, None)
+                while char is not None and depth:
+                    if previous == '*' and char == '/':
+                        depth, previous = depth - 1, None
+                    elif previous == '/' and char == '*':
+                        depth, previous = depth + 1, None
+                    else:
+                        previous = char
+                    char = next(chars, None)
+            else:
+                yield _PUNCTUATION, char
+                char = following
+        elif char in '\'"`':
+            text, char = _quoted(chars, char)
+            if text is None:
+                yield _LITERAL, None
+            else:
+                yield _IDENTIFIER, text
+        elif char == '$':
+            # Dollar-quoted strings ($$...$$ or $tag$...$tag$), or PostgreSQL positional parameters ($1)
+            text = []
+            char = next(chars, None)
+            while char is not None and (char.isalnum() or char == '_'):
+                text.append(char)
+                char = next(chars, None)
+            tag = u''.join(text)
+            if char == '$' and not tag[:1].isdigit():
+                char = _dollar_quoted(chars, u'${}$'.format(tag))
+            yield _LITERAL, None
+        elif char.isalnum() or char == '_':
+            text = []
+            while char is not None and (char.isalnum() or char in '_$'):
+                text.append(char)
+                char = next(chars, None)
+            word = u''.join(text)
+            if char == '\'' and word in _STRING_PREFIXES:
+                # Prefixed string constants, of which PostgreSQL E'' ones have backslash escapes
+                _, char = _quoted(chars, char, backslashes=word in 'Ee')
+                yield _LITERAL, None
+            else:
+                yield (_LITERAL, None) if word[0].isdigit() else (_WORD, word)
+        else:
+            yield _PUNCTUATION, char
+            char = next(chars, None)
+
+
+def _is_keyword(token, keyword):
+    return token is not None and token[0] == _WORD and token[1].upper() == keyword
+
+
+def _is_punctuation(token, punctuation):
+    return token is not None and token[0] == _PUNCTUATION and token[1] == punctuation
+
+
+def _skip_parentheses(tokens):
+    """Consumes tokens through the parenthesis closing an already consumed opening one."""
+    depth = 1
+    for token in tokens:
+        if _is_punctuation(token, '('):
+            depth += 1
+        elif _is_punctuation(token, ')'):
+            depth -= 1
+            if not depth:
+                return
+
+
+def _next_keyword(tokens, *keywords):
+    """Consumes tokens through the first of `keywords` outside of parentheses, returning whether one was found."""
+    for token in tokens:
+        if _is_punctuation(token, '('):
+            _skip_parentheses(tokens)
+        elif token[0] == _WORD and token[1].upper() in keywords:
+            return True
+    return False
+
+
+def _read_table(tokens, token=None):
+    """Reads a (possibly schema-qualified) table name starting with `token` or the next one."""
+    token = next(tokens, None) if token is None else token
+    names = []
+    while token is not None and token[0] in (_WORD, _IDENTIFIER):
+        names.append(token[1])
+        if not _is_punctuation(next(tokens, None), '.'):
+            break
+        token = next(tokens, None)
+    return u'.'.join(names) or None
+
+
+def _skip_words(tokens, words):
+    token = next(tokens, None)
+    while token is not None and token[0] == _WORD and token[1].upper() in words:
+        token = next(tokens, None)
+    return token
+
+
+def _resolve_common_table_expressions(tokens):
+    """Consumes WITH [RECURSIVE] clauses, returning the first token of the statement they precede."""
+    token = _skip_words(tokens, ('RECURSIVE',))
+    while token is not None:
+        # Skip the expression name and optional column list up to its AS (NOT MATERIALIZED) (...) body
+        if not _next_keyword(tokens, 'AS'):
+            return None
+        for token in tokens:
+            if _is_punctuation(token, '('):
+                _skip_parentheses(tokens)
+                break
+        token = next(tokens, None)
+        if not _is_punctuation(token, ','):
+            while _is_punctuation(token, '('):
+                token = next(tokens, None)
+            return token
+        token = next(tokens, None)
+    return None
+
+
+def _find_table(verb, tokens):
+    if verb in ('SELECT', 'DELETE'):
+        if _next_keyword(tokens, 'FROM'):
+            return _read_table(tokens, _skip_words(tokens, ('ONLY',)))
+    elif verb in ('INSERT', 'REPLACE', 'MERGE'):
+        if _next_keyword(tokens, 'INTO'):
+            return _read_table(tokens)
+    elif verb == 'UPDATE':
+        return _read_table(tokens, _skip_words(tokens, _UPDATE_MODIFIERS))
+    elif verb in ('COPY', 'TRUNCATE', 'LOCK'):
+        return _read_table(tokens, _skip_words(tokens, _TABLE_MODIFIERS | {'TABLE'}))
+    elif verb in ('CREATE', 'DROP', 'ALTER'):
+        if _is_keyword(_skip_words(tokens, _DDL_MODIFIERS), 'TABLE'):
+            return _read_table(tokens, _skip_words(tokens, _TABLE_MODIFIERS))
+    return None
+
+
+def _parse_statement(query):
+    tokens = _tokens(query)
+    token = next(tokens, None)
+    while _is_punctuation(token, '('):
+        token = next(tokens, None)
+    if token is None or token[0] != _WORD:
+        return _EMPTY_STATEMENT
+
+    keyword = token[1]
+    verb = keyword.upper()
+    if verb == 'WITH':
+        token = _resolve_common_table_expressions(tokens)
+        if token is None or token[0] != _WORD:
+            return SQLStatement(verb, None, keyword)
+        keyword = token[1]
+        verb = keyword.upper()
+    return SQLStatement(verb, _find_table(verb, tokens), keyword)
+
+
+def parse_statement(query):
+    """
+    Obtains the SQLStatement of a str, bytes, or psycopg2.sql.Composed query by lexing only as much of its prefix as
+    needed.  Results are memoized per query text.
+    """
+    if query is None:
+        return _EMPTY_STATEMENT
+    try:
+        statement = _statement_cache.get(query)
+    except TypeError:  # Unhashable Composed queries are parsed each time
+        return _parse_statement(query)
+
+    if statement is None:
+        statement = _parse_statement(query)
+        _statement_cache.put(query, statement)
+    return statement
+
+
+def _normalize_token(match):
+    kind = match.lastgroup
+    if kind == 'space':
+        return ' '
+    if kind == 'identifier':
+        return match.group()
+    return '?'
+
+
+def _normalize_statement(query):
+    if isinstance(query, bytes):
+        query = query.decode('utf8', 'replace')
+    text = _NORMALIZE_PATTERN.sub(_normalize_token, query).strip()
+    text = _SIGNED_NUMBER_PATTERN.sub(r'\1?', text)
+    text = _IN_LIST_PATTERN.sub('IN (...)', text)
+    text = _VALUES_ROWS_PATTERN.sub(r'\1', text)
+    fingerprint = hashlib.sha1(text.encode('utf8')).hexdigest()[:16]
+    return NormalizedStatement(text, fingerprint)
+
+
+def normalize_statement(query):
+    """
+    Obtains the NormalizedStatement of a str or bytes query, in which string and (signed) numeric literals are replaced
+    by `?` placeholders, IN lists are collapsed to `IN (...)`, repeated VALUES rows to a single one, and comments and
+    whitespace to single spaces.  Results are memoized per query text.
+    """
+    statement = _normalized_statement_cache.get(query)
+    if statement is None:
+        statement = _normalize_statement(query)
+        _normalized_statement_cache.put(query, statement)
+    return statement
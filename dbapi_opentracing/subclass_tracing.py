@@ -0,0 +1,274 @@
+from functools import partial
+from threading import Lock
+
+from .tracing import (_CONNECTION_FLAG_METHODS, _CURSOR_FLAG_METHODS, ConnectionTracing, Cursor, _ConnectionTracing,
+                      _Cursor, _cursor_flags, _enabled_flags, _get_driver_attribute, _operation_name,
+                      _rowcount_reset_methods, _set_driver_attribute, _traced_methods)
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# ConnectionTracing named arguments, popped from traced connection class arguments
+_TRACING_ARGUMENTS = ('tracer', 'span_tags', 'trace_commit', 'trace_rollback', 'trace_execute', 'trace_executemany',
+                      'trace_callproc', 'span_template_cache_size', 'statement_mode', 'sampler',
+                      'slow_query_threshold', 'stack_capture', 'max_statement_length', 'measure_batch_bytes',
+                      'trace_fetch', 'leaf_spans', 'insert_paging')
+
+# connection.cursor() arguments selecting the cursor class, and their default, for drivers whose connections do not
+# use a `cursorclass` attribute
+_CURSOR_CLASS_ARGUMENTS = {}
+if sqlite3 is not None:
+    _CURSOR_CLASS_ARGUMENTS[sqlite3.Connection] = ('factory', sqlite3.Cursor)
+
+# connection.cursor() named parameters of cursor classes, which drivers otherwise only accept as first argument
+_CURSOR_CLASS_PARAMETERS = ('cursor', 'cursorclass', 'cursor_factory', 'factory')
+
+# Traced methods enabled by trace_fetch additionally include close(), which reports the pending fetch span
+_SUBCLASS_CURSOR_FLAG_METHODS = _CURSOR_FLAG_METHODS[:-1] + (_CURSOR_FLAG_METHODS[-1] + ('close',),)
+
+
+class _SubclassCursorMethods(object):
+    """Traced _SubclassCursorTracing methods, defined by its subclasses specialized for their trace flag."""
+
+    def execute(self, *args, **kwargs):
+        return self._traced_execution(self._driver_class.execute, self, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        func = self._paged_executemany(self._driver_class.executemany, args, kwargs)
+        return self._traced_execution(func, self, *args, **kwargs)
+
+    def callproc(self, *args, **kwargs):
+        return self._traced_execution(self._driver_class.callproc, self, *args, **kwargs)
+
+    def fetchone(self):
+        return self._traced_fetch(self._driver_class.fetchone, self)
+
+    def fetchmany(self, *args, **kwargs):
+        return self._traced_fetch(self._driver_class.fetchmany, self, *args, **kwargs)
+
+    def fetchall(self):
+        return self._traced_fetch(self._driver_class.fetchall, self)
+
+    def __iter__(self):
+        if self._self_fetch is None:
+            return self._driver_class.__iter__(self)
+        # Driver iteration may use the traced fetchone(), so rows are obtained from the untraced one instead
+        return self._traced_rows(self._self_fetch, iter(partial(self._driver_class.fetchone, self), None))
+
+    def close(self):
+        self._finish_fetch()
+        return self._driver_class.close(self)
+
+    def _untraced_execute(self, *args, **kwargs):
+        self._self_rowcount = None
+        return self._driver_class.execute(self, *args, **kwargs)
+
+    def _untraced_callproc(self, *args, **kwargs):
+        self._self_rowcount = None
+        return self._driver_class.callproc(self, *args, **kwargs)
+
+
+class _SubclassConnectionMethods(object):
+    """Traced _SubclassConnectionTracing methods, defined by its subclasses specialized for their trace flag."""
+
+    def commit(self):
+        return self._traced_execution(self._self_commit_operation_name, self._driver_class.commit, self)
+
+    def rollback(self):
+        return self._traced_execution(self._self_rollback_operation_name, self._driver_class.rollback, self)
+
+
+class _SubclassCursorTracing(_Cursor):
+    """
+    Traced mixin for subclasses of DB API cursor classes.  Untraced attributes are those of the cursor class itself.
+    """
+    # Traced methods are invoked unbound, so the query follows the cursor instance in `args`
+    _query_index = 1
+    # Traced cursor class, set for each generated subclass
+    _driver_class = None
+    # Traced methods of generated subclasses, which are specialized per trace flag combination
+    _methods = _SubclassCursorMethods
+    _flag_methods = _SUBCLASS_CURSOR_FLAG_METHODS
+    _default_flags = (True, True, True, False, False)
+
+    def __init__(self, connection, *args, **kwargs):
+        self._driver_class.__init__(self, connection, *args, **kwargs)
+        _Cursor.__init__(self, config=getattr(connection, '_self_cursor_config', None))
+        self._self_executing = False
+
+    def _get_query(self, args):
+        return self._format_query(args[1])
+
+    def _driver_method(self, name):
+        method = getattr(self._driver_class, name, None)
+        return None if method is None else partial(method, self)
+
+    def _driver_rowcount(self):
+        return _get_driver_attribute(self, self._driver_class, 'rowcount')
+
+    def _set_driver_rowcount(self, value):
+        _set_driver_attribute(self, self._driver_class, 'rowcount', value)
+
+    def _traced_execution(self, func, *args, **kwargs):
+        # Driver executemany() and callproc() implementations may execute() each of their statements
+        if self._self_executing:
+            return func(*args, **kwargs)
+        self._self_executing = True
+        try:
+            return _Cursor._traced_execution(self, func, *args, **kwargs)
+        finally:
+            self._self_executing = False
+
+
+class _SubclassConnectionTracing(_ConnectionTracing):
+    """
+    Traced mixin for subclasses of DB API connection classes.  ConnectionTracing named arguments are popped before
+    the remaining ones are passed to the connection class.
+    """
+    # Traced connection class, set for each generated subclass
+    _driver_class = None
+    # Traced methods of generated subclasses, which are specialized per trace flag combination
+    _methods = _SubclassConnectionMethods
+    _flag_methods = _CONNECTION_FLAG_METHODS
+    _default_flags = (True, True)
+
+    def __init__(self, *args, **kwargs):
+        _ConnectionTracing.__init__(self, **dict((name, kwargs.pop(name)) for name in _TRACING_ARGUMENTS
+                                                 if name in kwargs))
+        self._self_commit_operation_name = _operation_name(self, self.commit)
+        self._self_rollback_operation_name = _operation_name(self, self.rollback)
+        self._driver_class.__init__(self, *args, **kwargs)
+
+        # e.g. pymysql and MySQLdb connections
+        cursor_class = getattr(self, 'cursorclass', None)
+        if isinstance(cursor_class, type):
+            flags = _cursor_flags(self._self_cursor_config)
+            self.cursorclass = traced_subclass(cursor_class, _SubclassCursorTracing, flags) or cursor_class
+
+    def cursor(self, *args, **kwargs):
+        config = self._get_cursor_config(kwargs)
+        flags = _cursor_flags(config)
+        # Cursor class arguments (e.g. pymysql's `cursor` or sqlite3's `factory`) are replaced by traced subclasses
+        if args:
+            args = (_traced_cursor_class(args[0], flags),) + args[1:]
+        for name in _CURSOR_CLASS_PARAMETERS:
+            if name in kwargs:
+                kwargs[name] = _traced_cursor_class(kwargs[name], flags)
+        for base, (argument, default) in _CURSOR_CLASS_ARGUMENTS.items():
+            if isinstance(self, base) and not args and argument not in kwargs:
+                kwargs[argument] = _traced_cursor_class(default, flags)
+        # Drivers with a `cursorclass` attribute (e.g. pymysql and MySQLdb) also accept cursor classes as the first
+        # argument, which provides a subclass specialized for the overridden trace flags
+        cursor_class = getattr(self, 'cursorclass', None)
+        if config is not self._self_cursor_config and not args and not kwargs and isinstance(cursor_class, type):
+            args = (_traced_cursor_class(cursor_class, flags),)
+
+        cursor = self._driver_class.cursor(self, *args, **kwargs)
+        if not isinstance(cursor, _Cursor):
+            return Cursor(cursor, config=config)
+        cursor._self_config = config
+        return cursor
+
+    def __exit__(self, exc, value, tb):
+        # As with ConnectionTracing, driver __exit__() implementations may not commit or rollback through methods
+        if exc:
+            if not self._self_trace_rollback:
+                return self._driver_class.__exit__(self, exc, value, tb)
+            operation_name = self._self_rollback_operation_name
+        else:
+            if not self._self_trace_commit:
+                return self._driver_class.__exit__(self, exc, value, tb)
+            operation_name = self._self_commit_operation_name
+
+        return self._traced_execution(operation_name, self._driver_class.__exit__, self, exc, value, tb)
+
+
+class _ExecuteShortcutsTracing(object):
+    """Traced connection.execute() and executemany() cursor shortcuts, for drivers providing them (e.g. sqlite3)."""
+
+    def execute(self, *args, **kwargs):
+        cursor = self.cursor()
+        cursor.execute(*args, **kwargs)
+        return cursor
+
+    def executemany(self, *args, **kwargs):
+        cursor = self.cursor()
+        cursor.executemany(*args, **kwargs)
+        return cursor
+
+
+# Storage for traced subclasses of (class, mixin, trace flags) to prevent redundant definitions, with False for
+# classes that cannot be subclassed
+_traced_subclasses = {}
+_traced_subclass_lock = Lock()
+
+
+def traced_subclass(cls, mixin, flags=None):
+    """
+    Returns the cached traced subclass of `cls` with `mixin`, or None if `cls` cannot be subclassed.  Subclasses are
+    specialized for the `flags` combination of trace flags (the mixin's `_default_flags` if None), and only define
+    the traced methods of enabled ones.
+    """
+    if flags is None:
+        flags = mixin._default_flags
+    if issubclass(cls, mixin):
+        if cls._driver_class is None:
+            return cls
+        cls = cls._driver_class
+    key = (cls, mixin, flags)
+    traced = _traced_subclasses.get(key)
+    if traced is None:
+        with _traced_subclass_lock:
+            traced = _traced_subclasses.get(key)
+            if traced is None:
+                bases = (mixin, cls)
+                if mixin is _SubclassConnectionTracing and hasattr(cls, 'execute'):
+                    bases = (mixin, _ExecuteShortcutsTracing, cls)
+                namespace = _traced_methods(mixin._methods, mixin._flag_methods, flags)
+                if issubclass(mixin, _SubclassCursorTracing):
+                    namespace.update(_rowcount_reset_methods(mixin._methods, mixin._flag_methods, flags))
+                namespace.update(__module__=cls.__module__, _driver_class=cls)
+                try:
+                    traced = type(cls.__name__, bases, namespace)
+                except TypeError:  # Final or layout-conflicting classes
+                    traced = False
+                _traced_subclasses[key] = traced
+    return traced or None
+
+
+def _traced_cursor_class(value, flags):
+    if isinstance(value, type):
+        return traced_subclass(value, _SubclassCursorTracing, flags) or value
+    return value
+
+
+class SubclassConnectionTracing(object):
+    """
+    Traced connection pseudo-metaclass for any DB API driver with a subclassable connection class, provided as the
+    `connection_factory` named argument.  It generates (once) and instantiates a traced subclass of it with the
+    remaining arguments, minus ConnectionTracing named arguments which configure its tracing.  Cursors are traced
+    subclasses of driver cursor classes (including those provided to cursor()) where possible, and Cursor proxies
+    otherwise.
+
+    connection = SubclassConnectionTracing(host='localhost', connection_factory=pymysql.connections.Connection,
+                                           tracer=tracer)
+    assert isinstance(connection, pymysql.connections.Connection)
+
+    connection = sqlite3.connect(':memory:', factory=functools.partial(
+        SubclassConnectionTracing, connection_factory=sqlite3.Connection, tracer=tracer
+    ))
+
+    Connection classes that cannot be subclassed are instead instantiated and wrapped by ConnectionTracing.
+    """
+    def __new__(cls, *args, **kwargs):
+        factory = kwargs.pop('connection_factory')
+        flags = _enabled_flags(kwargs.get('tracer'), kwargs.get('trace_commit', True),
+                               kwargs.get('trace_rollback', True))
+        traced = traced_subclass(factory, _SubclassConnectionTracing, flags)
+        if traced is not None:
+            return traced(*args, **kwargs)
+
+        tracing_kwargs = dict((name, kwargs.pop(name)) for name in _TRACING_ARGUMENTS if name in kwargs)
+        return ConnectionTracing(factory(*args, **kwargs), **tracing_kwargs)
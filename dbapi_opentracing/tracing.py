@@ -1,9 +1,77 @@
-import traceback
+from collections import namedtuple
+from threading import Lock, local
+import codecs
+import time
 
 from opentracing.ext import tags
 import opentracing
 import wrapt
 
+from .batch import _ParameterBatch
+from .cache import LRUCache
+from .errors import _full_stack_capture
+from .paging import _PagedInsert
+from .sql import RAW, NORMALIZED, STATEMENT_MODES, normalize_statement, parse_statement
+
+try:
+    from time import perf_counter
+except ImportError:  # py2
+    from time import time as perf_counter
+
+# Prebuilt operation name and initial span tags for a (cursor class, method, query) combination
+_SpanTemplate = namedtuple('_SpanTemplate', 'operation_name tags')
+
+# Converts perf_counter() values to the epoch-based timestamps expected by tracers
+_PERF_COUNTER_OFFSET = time.time() - perf_counter()
+
+# Exhausted row iterator sentinel
+_END = object()
+# Undefined class attribute sentinel
+_MISSING = object()
+
+
+class _PendingWaits(object):
+    """
+    Wait tags of the execution running in the current thread (or greenlet, once TracedWaitCallback(green=True) switched
+    them to gevent's local storage) whose span isn't active while it runs, i.e. leaf and tail-based spans, which
+    TracedWaitCallback accounts for instead.
+    """
+    tags = None
+
+
+def _use_pending_waits(local_class=None):
+    """
+    Keeps pending wait tags for TracedWaitCallback from now on, in `local_class` storage if provided, and otherwise in
+    thread-local storage unless they already are kept.
+    """
+    global _pending_waits
+    if local_class is None:
+        if _pending_waits is not None:
+            return
+        local_class = local
+    if not isinstance(_pending_waits, local_class):
+        _pending_waits = type('_PendingWaits', (_PendingWaits, local_class), {})()
+
+
+# Pending wait tags, which are only kept once a TracedWaitCallback is created, so that executions otherwise don't
+# allocate and clear them
+_pending_waits = None
+
+# Cursor configuration shared by all cursors of a connection, which only hold a reference to it
+_CursorConfig = namedtuple('_CursorConfig', 'tracer span_tags trace_execute trace_executemany trace_callproc '
+                                            'span_template_cache statement_mode sampler slow_query_threshold '
+                                            'stack_capture max_statement_length measure_batch_bytes trace_fetch '
+                                            'leaf_spans insert_paging')
+
+# Trace flags that can be overridden per cursor() call
+_CURSOR_TRACE_FLAGS = ('trace_execute', 'trace_executemany', 'trace_callproc', 'trace_fetch')
+
+# Traced methods enabled by each of the _CURSOR_TRACE_FLAGS, and by each of the connection `trace_commit` and
+# `trace_rollback` flags.  Traced classes are specialized per flag combination to only override enabled methods.
+_CURSOR_FLAG_METHODS = (('execute',), ('executemany',), ('callproc',),
+                        ('fetchone', 'fetchmany', 'fetchall', '__iter__'))
+_CONNECTION_FLAG_METHODS = (('commit',), ('rollback',))
+
 
 def _operation_name(caller, func, statement=''):
     """Span operation name obtained from caller's method and sql statement, if any."""
@@ -14,6 +82,213 @@ def _operation_name(caller, func, statement=''):
     return u'{}.{}({})'.format(class_name, operation_name, statement)
 
 
+def _is_noop_tracer(tracer):
+    """Whether `tracer` (opentracing.tracer if None) is the default no-op tracer, whose spans are never reported."""
+    return type(tracer or opentracing.tracer) is opentracing.Tracer
+
+
+def _enabled_flags(tracer, *flags):
+    """Trace `flags` as booleans, all disabled for a no-op `tracer`, whose wrappers only pass calls through untraced."""
+    if _is_noop_tracer(tracer):
+        return (False,) * len(flags)
+    return tuple(bool(flag) for flag in flags)
+
+
+def _cursor_config(tracer=None, span_tags=None, trace_execute=True, trace_executemany=True, trace_callproc=True,
+                   span_template_cache=None, statement_mode=RAW, sampler=None, slow_query_threshold=None,
+                   stack_capture=None, max_statement_length=None, measure_batch_bytes=False, trace_fetch=False,
+                   leaf_spans=False, insert_paging=None):
+    if statement_mode not in STATEMENT_MODES:
+        raise ValueError('statement_mode must be one of {}.'.format(STATEMENT_MODES))
+    trace_execute, trace_executemany, trace_callproc, trace_fetch = _enabled_flags(
+        tracer, trace_execute, trace_executemany, trace_callproc, trace_fetch
+    )
+    return _CursorConfig(tracer or opentracing.tracer, span_tags or {}, trace_execute, trace_executemany,
+                         trace_callproc, span_template_cache, statement_mode, sampler, slow_query_threshold,
+                         stack_capture or _full_stack_capture, max_statement_length, measure_batch_bytes, trace_fetch,
+                         leaf_spans, insert_paging)
+
+
+def _cursor_flags(config):
+    """
+    Combination of the _CURSOR_TRACE_FLAGS of a cursor configuration, for which cursor classes are specialized, and of
+    whether its traced executemany() calls are paged by insert_paging.
+    """
+    return (bool(config.trace_execute), bool(config.trace_executemany), bool(config.trace_callproc),
+            bool(config.trace_fetch), bool(config.trace_executemany and config.insert_paging is not None))
+
+
+def _enabled_cursor_flags(tracer, trace_execute, trace_executemany, trace_callproc, trace_fetch, insert_paging=None):
+    """_cursor_flags() of the cursor configuration of these arguments."""
+    flags = _enabled_flags(tracer, trace_execute, trace_executemany, trace_callproc, trace_fetch)
+    return flags + (flags[1] and insert_paging is not None,)
+
+
+def _traced_methods(methods, flag_methods, flags):
+    """Functions of the `methods` class named by the `flag_methods` entry of each of the enabled `flags`."""
+    return dict((name, methods.__dict__[name]) for names, enabled in zip(flag_methods, flags) if enabled
+                for name in names)
+
+
+def _get_paged_rowcount(self):
+    """Client cursor rowcount, or the total of all pages of a paged executemany(), as the client would report it."""
+    rowcount = self._driver_rowcount()
+    paged = self._self_rowcount
+    # The client's rowcount of any later (e.g. untraced COPY) operation isn't overridden
+    if paged is not None and paged[1] == rowcount:
+        return paged[0]
+    return rowcount
+
+
+def _set_paged_rowcount(self, value):
+    # Set by pure Python clients (e.g. pymysql) upon their executions
+    self._self_rowcount = None
+    self._set_driver_rowcount(value)
+
+
+def _paged_rowcount(flags):
+    """
+    `rowcount` property of cursor classes specialized for _cursor_flags() `flags` when executemany() is paged, so that
+    the client's own rowcount is read directly otherwise.
+    """
+    if not flags[4]:
+        return {}
+    return {'rowcount': property(_get_paged_rowcount, _set_paged_rowcount)}
+
+
+def _rowcount_reset_methods(methods, flag_methods, flags):
+    """
+    _paged_rowcount() of `flags`, along with untraced pass-through functions of the `methods` class (as its
+    `_untraced_<name>` functions) for the execute() and callproc() entries of disabled _cursor_flags() `flags`, when
+    executemany() is paged.  They reset the rowcount total of a preceding paged executemany(), which traced executions
+    otherwise reset.
+    """
+    if not flags[4]:
+        return {}
+    methods = dict((name, methods.__dict__['_untraced_' + name]) for index in (0, 2) if not flags[index]
+                   for name in flag_methods[index])
+    methods.update(_paged_rowcount(flags))
+    return methods
+
+
+class _SpecializedClasses(object):
+    """
+    Subclasses of wrapt traced classes specialized per combination of their trace flags, defined once under a lock
+    and then looked up without one.  Traced `methods` of enabled flags are provided by a mixin of `proxy`, the
+    ObjectProxy subclass among the traced class' bases, which precedes `proxy` itself in their __mro__, so that methods
+    of subclasses of the traced class (and their super() calls) resolve as usual.  Methods of disabled flags are the
+    untraced pass-through methods of `proxy`.  Mixins also define the `attributes` of their flags if provided.
+    """
+
+    def __init__(self, methods, flag_methods, proxy=wrapt.ObjectProxy, attributes=None):
+        self._methods = methods
+        self._flag_methods = flag_methods
+        self._proxy = proxy
+        self._attributes = attributes
+        self._classes = {}
+        self._lock = Lock()
+
+    def get(self, cls, flags):
+        key = (cls, flags)
+        specialized = self._classes.get(key)
+        if specialized is None:
+            with self._lock:
+                specialized = self._classes.get(key)
+                if specialized is None:
+                    namespace = _traced_methods(self._methods, self._flag_methods, flags)
+                    if self._attributes is not None:
+                        namespace.update(self._attributes(flags))
+                    namespace['__slots__'] = ()
+                    mixin = type('_TracedMethods', (self._proxy,), namespace)
+                    specialized = self._classes[key] = type(cls.__name__, (cls, mixin), {
+                        '__slots__': (), '__module__': cls.__module__, '_trace_flags': flags
+                    })
+        return specialized
+
+
+def _is_sampled(span):
+    """Sampling decision of `span` for tracers exposing one (e.g. Jaeger), otherwise None."""
+    is_sampled = getattr(span, 'is_sampled', None)
+    if is_sampled is not None:
+        return is_sampled()
+    return getattr(span.context, 'sampled', None)
+
+
+def _class_attribute(cls, name):
+    """Attribute `name` as defined by `cls` or its bases, without binding it, or _MISSING."""
+    for base in cls.__mro__:
+        if name in vars(base):
+            return vars(base)[name]
+    return _MISSING
+
+
+def _get_driver_attribute(obj, cls, name):
+    """Attribute `name` of `obj` as the driver class `cls` it derives from resolves it, ignoring traced overrides."""
+    attr = _class_attribute(cls, name)
+    if hasattr(type(attr), '__set__'):  # Data descriptors take precedence over instance attributes
+        return attr.__get__(obj, cls)
+    instance_attrs = getattr(obj, '__dict__', {})
+    if name in instance_attrs:
+        return instance_attrs[name]
+    if attr is _MISSING:
+        raise AttributeError(name)
+    return attr.__get__(obj, cls) if hasattr(type(attr), '__get__') else attr
+
+
+def _set_driver_attribute(obj, cls, name, value):
+    """Sets attribute `name` of `obj` as the driver class `cls` it derives from would, ignoring traced overrides."""
+    attr = _class_attribute(cls, name)
+    if hasattr(type(attr), '__set__'):
+        attr.__set__(obj, value)
+    else:
+        obj.__dict__[name] = value
+
+
+def _is_unsampled(parent):
+    """Whether the `parent` span, if any, is reported as unsampled by its tracer, so its children needn't be traced."""
+    return parent is not None and _is_sampled(parent) is False
+
+
+class _Fetch(object):
+    """Aggregated fetch*() calls and row iteration following a traced execution, reported as a single span."""
+    __slots__ = ('context', 'template', 'executed', 'started', 'first_row', 'finished', 'rows')
+
+    def __init__(self, context, template, executed):
+        self.context = context
+        self.template = template
+        self.executed = executed
+        self.started = None
+        self.first_row = None
+        self.finished = None
+        self.rows = 0
+
+    def fetched(self, start, rows):
+        """Records a fetch call started at `start` that produced `rows` rows."""
+        now = perf_counter()
+        if self.started is None:
+            self.started = start
+        if rows and self.first_row is None:
+            self.first_row = now
+        self.rows += rows
+        self.finished = now
+
+    def set_tags(self, span):
+        span.set_tag('db.fetch.rows', self.rows)
+        if self.first_row is not None:
+            span.set_tag('db.fetch.time_to_first_row', self.first_row - self.executed)
+
+    def finish(self, tracer, caller):
+        """Reports the fetch span following the traced execution, if there were any fetch calls."""
+        if self.started is None:
+            return
+        statement = self.template.operation_name.partition('(')[2]
+        span = tracer.start_span(u'{}.fetch({}'.format(caller.__class__.__name__, statement),
+                                 references=[opentracing.follows_from(self.context)],
+                                 tags=dict(self.template.tags), start_time=self.started + _PERF_COUNTER_OFFSET)
+        self.set_tags(span)
+        span.finish(finish_time=self.finished + _PERF_COUNTER_OFFSET)
+
+
 class _ConnectionTracing(object):
     """
     Base for traced connections.  Tracer and trace flag attributes will be in ObjectProxy attribute format despite not
@@ -21,17 +296,45 @@ class _ConnectionTracing(object):
     """
 
     def __init__(self, tracer=None, span_tags=None, trace_commit=True, trace_rollback=True, trace_execute=True,
-                 trace_executemany=True, trace_callproc=True, *args, **kwargs):
-        self._self_tracer = tracer or opentracing.tracer
-        self._self_span_tags = span_tags or {}
-        self._self_trace_commit = trace_commit
-        self._self_trace_rollback = trace_rollback
-        self._self_trace_execute = trace_execute
-        self._self_trace_executemany = trace_executemany
-        self._self_trace_callproc = trace_callproc
+                 trace_executemany=True, trace_callproc=True, span_template_cache_size=128, statement_mode=RAW,
+                 sampler=None, slow_query_threshold=None, stack_capture=None, max_statement_length=None,
+                 measure_batch_bytes=False, trace_fetch=False, leaf_spans=False, insert_paging=None, *args, **kwargs):
+        # Shared by all cursors of this connection.  A falsy size disables span template caching.
+        span_template_cache = LRUCache(span_template_cache_size) if span_template_cache_size else None
+        self._self_cursor_config = _cursor_config(tracer, span_tags, trace_execute, trace_executemany, trace_callproc,
+                                                  span_template_cache, statement_mode, sampler, slow_query_threshold,
+                                                  stack_capture, max_statement_length, measure_batch_bytes,
+                                                  trace_fetch, leaf_spans, insert_paging)
+        self._self_tracer = self._self_cursor_config.tracer
+        self._self_span_tags = self._self_cursor_config.span_tags
+        self._self_trace_commit, self._self_trace_rollback = _enabled_flags(tracer, trace_commit, trace_rollback)
+        self._self_stack_capture = self._self_cursor_config.stack_capture
+        self._self_leaf_spans = leaf_spans
+        # Initial tags of commit and rollback leaf spans
+        self._self_leaf_tags = {tags.DATABASE_TYPE: 'sql', tags.SPAN_KIND: tags.SPAN_KIND_RPC_CLIENT}
+        self._self_leaf_tags.update(self._self_span_tags)
+
+    @property
+    def span_template_cache(self):
+        """LRUCache of cursor span templates (with `hits` and `misses` counters), or None if disabled."""
+        return self._self_cursor_config.span_template_cache
+
+    def _get_cursor_config(self, kwargs):
+        """Pops trace flag overrides from cursor() `kwargs`, returning the resulting cursor configuration."""
+        config = self._self_cursor_config
+        overrides = dict((flag, kwargs.pop(flag)) for flag in _CURSOR_TRACE_FLAGS if flag in kwargs)
+        # Nothing is traced with a no-op tracer
+        if not overrides or _is_noop_tracer(config.tracer):
+            return config
+        return config._replace(**overrides)
 
     def _traced_execution(self, operation_name, func, *args, **kwargs):
         """Execute function under active span and return its value"""
+        if _is_unsampled(self._self_tracer.active_span):
+            return func(*args, **kwargs)
+        if self._self_leaf_spans:
+            return self._leaf_traced_execution(operation_name, func, *args, **kwargs)
+
         with self._self_tracer.start_active_span(operation_name) as scope:
             span = scope.span
             span.set_tag(tags.DATABASE_TYPE, 'sql')
@@ -43,48 +346,97 @@ class _ConnectionTracing(object):
             try:
                 val = func(*args, **kwargs)
             except Exception as e:
-                span.set_tag(tags.ERROR, True)
-                span.set_tag('sfx.error.message', str(e))
-                span.set_tag('sfx.error.object', str(e.__class__))
-                span.set_tag('sfx.error.kind', e.__class__.__name__)
-                span.set_tag('sfx.error.stack', traceback.format_exc())
+                self._self_stack_capture.set_error_tags(span, e)
                 raise
             return val
 
+    def _leaf_traced_execution(self, operation_name, func, *args, **kwargs):
+        """Execute function and only then start and finish its unactivated span, as a child of the active span"""
+        tracer = self._self_tracer
+        parent = tracer.active_span
+        span_tags = dict(self._self_leaf_tags)
+        pending, wait_tags = _pending_waits, None
+        if pending is not None:
+            pending.tags = wait_tags = {}
+        start = perf_counter()
+        try:
+            val = func(*args, **kwargs)
+        except Exception as e:
+            if wait_tags:
+                span_tags.update(wait_tags)
+            span = tracer.start_span(operation_name, child_of=parent, ignore_active_span=True, tags=span_tags,
+                                     start_time=start + _PERF_COUNTER_OFFSET)
+            self._self_stack_capture.set_error_tags(span, e)
+            span.finish()
+            raise
+        finally:
+            if pending is not None:
+                pending.tags = None
+        finish = perf_counter()
+        if wait_tags:
+            span_tags.update(wait_tags)
+        tracer.start_span(operation_name, child_of=parent, ignore_active_span=True, tags=span_tags,
+                          start_time=start + _PERF_COUNTER_OFFSET).finish(finish_time=finish + _PERF_COUNTER_OFFSET)
+        return val
+
     def __enter__(self):
         return self.cursor()
 
 
-class ConnectionTracing(_ConnectionTracing, wrapt.ObjectProxy):
-    """A wrapper for instantiated DB API Connection objects with traced commit() and rollback() methods."""
+class _ConnectionTracingMethods(object):
+    """Traced ConnectionTracing methods, overridden by its classes specialized for their trace flag."""
+
+    def commit(self):
+        return self._traced_execution(self._self_commit_operation_name, self.__wrapped__.commit)
+
+    def rollback(self):
+        return self._traced_execution(self._self_rollback_operation_name, self.__wrapped__.rollback)
+
+
+class _ConnectionProxy(wrapt.ObjectProxy):
+    """Untraced ConnectionTracing methods, which its classes specialized for their trace flags override if traced."""
+
+    def commit(self):
+        return self.__wrapped__.commit()
+
+    def rollback(self):
+        return self.__wrapped__.rollback()
+
+
+_connection_tracing_classes = _SpecializedClasses(_ConnectionTracingMethods, _CONNECTION_FLAG_METHODS, _ConnectionProxy)
+
+
+class ConnectionTracing(_ConnectionTracing, _ConnectionProxy):
+    """
+    A wrapper for instantiated DB API Connection objects with traced commit() and rollback() methods.  Instances are
+    of a subclass specialized for their `trace_commit` and `trace_rollback` flags.
+    """
+    # Trace flags of specialized subclasses
+    _trace_flags = None
+
+    def __new__(cls, connection, tracer=None, span_tags=None, trace_commit=True, trace_rollback=True, *args, **kwargs):
+        if cls._trace_flags is None:
+            cls = _connection_tracing_classes.get(cls, _enabled_flags(tracer, trace_commit, trace_rollback))
+        return wrapt.ObjectProxy.__new__(cls)
 
     def __init__(self, connection, tracer=None, span_tags=None, trace_commit=True, trace_rollback=True,
-                 trace_execute=True, trace_executemany=True, trace_callproc=True, *args, **kwargs):
+                 trace_execute=True, trace_executemany=True, trace_callproc=True, span_template_cache_size=128,
+                 statement_mode=RAW, sampler=None, slow_query_threshold=None, stack_capture=None,
+                 max_statement_length=None, measure_batch_bytes=False, trace_fetch=False, leaf_spans=False,
+                 insert_paging=None, *args, **kwargs):
         wrapt.ObjectProxy.__init__(self, connection)
         _ConnectionTracing.__init__(self, tracer, span_tags, trace_commit, trace_rollback, trace_execute,
-                                    trace_executemany, trace_callproc)
+                                    trace_executemany, trace_callproc, span_template_cache_size, statement_mode,
+                                    sampler, slow_query_threshold, stack_capture, max_statement_length,
+                                    measure_batch_bytes, trace_fetch, leaf_spans, insert_paging)
 
         self._self_commit_operation_name = _operation_name(self, self.__wrapped__.commit)
         self._self_rollback_operation_name = _operation_name(self, self.__wrapped__.rollback)
 
     def cursor(self, *args, **kwargs):
-        trace_execute = kwargs.pop('trace_execute', self._self_trace_execute)
-        trace_executemany = kwargs.pop('trace_executemany', self._self_trace_executemany)
-        trace_callproc = kwargs.pop('trace_callproc', self._self_trace_callproc)
-        return Cursor(self.__wrapped__.cursor(*args, **kwargs), self._self_tracer, self._self_span_tags,
-                      trace_execute=trace_execute, trace_executemany=trace_executemany, trace_callproc=trace_callproc)
-
-    def commit(self):
-        if not self._self_trace_commit:
-            return self.__wrapped__.commit()
-
-        return self._traced_execution(self._self_commit_operation_name, self.__wrapped__.commit)
-
-    def rollback(self):
-        if not self._self_trace_rollback:
-            return self.__wrapped__.rollback()
-
-        return self._traced_execution(self._self_rollback_operation_name, self.__wrapped__.rollback)
+        config = self._get_cursor_config(kwargs)
+        cursor = self.__wrapped__.cursor(*args, **kwargs)
+        return Cursor(cursor, config=config)
 
     def __exit__(self, exc, value, tb):
         # C extension clients (e.g. psycopg2) require self.__wrapped__.__class__ to be in ConnectionTracing.__bases__,
@@ -106,91 +458,439 @@ class ConnectionTracing(_ConnectionTracing, wrapt.ObjectProxy):
 
 class _Cursor(object):
     """
-    Base for traced cursors.  Tracer and trace flag attributes will be in ObjectProxy attribute format despite not
-    having direct wrapt parent class, to ensure their functionality in CursorTracing.
+    Base for traced cursors.  Their state will be in ObjectProxy attribute format despite not having direct wrapt
+    parent class, to ensure its functionality in CursorTracing.
     """
+    __slots__ = ()
+
+    # Position of the query in _traced_execution() `args`
+    _query_index = 0
 
     def __init__(self, tracer=None, span_tags=None, trace_execute=True, trace_executemany=True, trace_callproc=True,
-                 *args, **kwargs):
-        self._self_tracer = tracer or opentracing.tracer
-        self._self_span_tags = span_tags or {}
-        self._self_trace_execute = trace_execute
-        self._self_trace_executemany = trace_executemany
-        self._self_trace_callproc = trace_callproc
+                 span_template_cache=None, statement_mode=RAW, sampler=None, slow_query_threshold=None,
+                 stack_capture=None, max_statement_length=None, measure_batch_bytes=False, trace_fetch=False,
+                 leaf_spans=False, insert_paging=None, config=None, *args, **kwargs):
+        if config is None:
+            config = _cursor_config(tracer, span_tags, trace_execute, trace_executemany, trace_callproc,
+                                    span_template_cache, statement_mode, sampler, slow_query_threshold,
+                                    stack_capture, max_statement_length, measure_batch_bytes, trace_fetch, leaf_spans,
+                                    insert_paging)
+        self._self_config = config
+        # Fetch phase of the last traced execution, if being traced
+        self._self_fetch = None
+        # Rowcount total of the last execution if a paged executemany(), along with the client's rowcount of its last
+        # page, which the client cursor reports instead
+        self._self_rowcount = None
+
+    def _driver_rowcount(self):
+        return self.__wrapped__.rowcount
+
+    def _set_driver_rowcount(self, value):
+        self.__wrapped__.rowcount = value
+
+    @property
+    def span_template_cache(self):
+        """LRUCache of span templates shared with the originating connection, or None if disabled."""
+        return self._self_config.span_template_cache
 
     def _get_statement(self, args):
-        """Converts _traced_execution() `args` to partial operation name statement"""
-        raise NotImplementedError
+        """Parses _traced_execution() `args` query into a SQLStatement for operation name and sql tags"""
+        return parse_statement(args[self._query_index])
 
     def _get_query(self, args):
-        """Converts _traced_execution() `args` to db.statement tag value"""
+        """Converts _traced_execution() `args` to db.statement tag value and whether it was truncated"""
         raise NotImplementedError
 
     def _format_query(self, query):
+        limit = self._self_config.max_statement_length
+        if limit is None or len(query) <= limit:
+            if isinstance(query, bytes):
+                return query.decode('utf8', 'replace'), False
+            return query, False
+
         if isinstance(query, bytes):
-            return query.decode('utf8', 'replace')
-        return query
+            # Only decode leading bytes, without a trailing partial character
+            decoder = codecs.getincrementaldecoder('utf8')('replace')
+            return decoder.decode(memoryview(query)[:limit].tobytes()), True
+        return query[:limit], True
+
+    def _build_span_template(self, func, args):
+        query, truncated = self._get_query(args)
+        span_tags = {
+            tags.DATABASE_TYPE: 'sql',
+            tags.SPAN_KIND: tags.SPAN_KIND_RPC_CLIENT,
+        }
+        if truncated:
+            span_tags['db.statement.truncated'] = True
+        if self._self_config.statement_mode == RAW:
+            span_tags[tags.DATABASE_STATEMENT] = query
+        else:
+            normalized = normalize_statement(query)
+            span_tags['db.sql.fingerprint'] = normalized.fingerprint
+            if self._self_config.statement_mode == NORMALIZED:
+                span_tags[tags.DATABASE_STATEMENT] = normalized.text
+        if func.__name__ == 'callproc':
+            # Procedure names are used as is, as they are neither SQL nor of unbounded cardinality
+            operation_name = _operation_name(self, func, query)
+        else:
+            statement = self._get_statement(args)
+            # Verbs are named as written, like they were before being parsed
+            operation_name = _operation_name(self, func, statement.keyword)
+            span_tags['db.sql.verb'] = statement.verb
+            if statement.table:
+                span_tags['db.sql.table'] = statement.table
+        span_tags.update(self._self_config.span_tags)
+        return _SpanTemplate(operation_name, span_tags)
+
+    def _get_span_template(self, func, args):
+        """Obtains the span template for `func` and its query argument, building and caching it on first use."""
+        cache = self._self_config.span_template_cache
+        if cache is None:
+            return self._build_span_template(func, args)
+
+        key = (self.__class__, func.__name__, args[self._query_index])
+        try:
+            template = cache.get(key)
+        except TypeError:  # Unhashable query (e.g. psycopg2 Composed) cannot be cached
+            return self._build_span_template(func, args)
+
+        if template is None:
+            template = self._build_span_template(func, args)
+            cache.put(key, template)
+        return template
+
+    def _get_sampling_key(self, args):
+        """
+        Obtains the sampler key of _traced_execution() `args` query, from the query itself where possible, and otherwise
+        from its db.statement value, so that fingerprint keys are those of the span's db.sql.fingerprint tag.
+        """
+        key = self._self_config.sampler.key
+        if self._self_config.max_statement_length is None:
+            try:
+                return key(args[self._query_index])
+            except TypeError:  # Unhashable query (e.g. psycopg2 Composed) must be rendered first
+                pass
+        return key(self._get_query(args)[0])
+
+    def _get_batch(self, func, args):
+        """Replaces executemany() parameter sequence in `args` with a counting _ParameterBatch, returning both."""
+        index = self._query_index + 1
+        if func.__name__ != 'executemany' or len(args) <= index:
+            return args, None
+        batch = _ParameterBatch(args[index], self._self_config.measure_batch_bytes, getattr(func, 'page_size', None))
+        return args[:index] + (batch.parameters,) + args[index + 1:], batch
+
+    def _driver_method(self, name):
+        """Untraced client cursor method `name`, bound to the client cursor, or None if the cursor has none."""
+        raise NotImplementedError
+
+    def _rows_produced(self, func):
+        """Rows produced by the execution of `func`, totalled over the pages of paged executions."""
+        if isinstance(func, _PagedInsert):
+            return func.rowcount
+        return self.rowcount
+
+    def _paged_executemany(self, func, args, kwargs):
+        """Client executemany() `func`, or its paged replacement for `args` and `kwargs` if using insert_paging."""
+        paging = self._self_config.insert_paging
+        if paging is None:
+            return func
+        return paging.executemany(func, args, kwargs, self)
+
+    def _finish_fetch(self):
+        fetch = self._self_fetch
+        if fetch is not None:
+            self._self_fetch = None
+            fetch.finish(self._self_config.tracer, self)
+
+    def _new_fetch(self, context, template, executed):
+        return _Fetch(context, template, executed)
+
+    def _start_fetch(self, func, span, template, executed):
+        if self._self_config.trace_fetch and func.__name__ != 'executemany':
+            self._self_fetch = self._new_fetch(span.context, template, executed)
+
+    def _fetched(self, fetch, func, start, rows):
+        """Aggregates the `rows` of a fetch*() call started at `start` into `fetch`"""
+        if func.__name__ == 'fetchone':
+            fetch.fetched(start, 0 if rows is None else 1)
+        else:
+            fetch.fetched(start, len(rows))
+        if func.__name__ == 'fetchall' or not rows:
+            self._finish_fetch()
+
+    def _traced_fetch(self, func, *args, **kwargs):
+        """Execute fetch*() function, aggregating its rows into the fetch span of the last traced execution"""
+        fetch = self._self_fetch
+        if fetch is None:
+            return func(*args, **kwargs)
+
+        start = perf_counter()
+        rows = func(*args, **kwargs)
+        self._fetched(fetch, func, start, rows)
+        return rows
+
+    def _traced_rows(self, fetch, rows):
+        """Generates rows of the `rows` iterator, aggregating them into `fetch`"""
+        start = perf_counter()
+        # next() is used instead of for loops, as iter() of traced cursor subclasses would recurse
+        row = next(rows, _END)
+        fetch.fetched(start, 0 if row is _END else 1)
+        count = 0
+        try:
+            while row is not _END:
+                yield row
+                row = next(rows, _END)
+                count += 1
+        finally:
+            # The last count is that of the exhausting next() call, unless iteration was abandoned
+            fetch.rows += count - 1 if row is _END and count else count
+            fetch.finished = perf_counter()
+        if self._self_fetch is fetch:
+            self._finish_fetch()
 
     def _traced_execution(self, func, *args, **kwargs):
-        statement = self._get_statement(args)
-        operation_name = _operation_name(self, func, statement)
-        with self._self_tracer.start_active_span(operation_name) as scope:
+        self._finish_fetch()
+        self._self_rowcount = None
+        # Executions under an unsampled parent go straight to the client, without rendering their statement
+        if _is_unsampled(self._active_span()):
+            return func(*args, **kwargs)
+        config = self._self_config
+        dropped = 0
+        if config.sampler is not None:
+            dropped = config.sampler.sample(self._get_sampling_key(args))
+            if dropped is None:
+                return func(*args, **kwargs)
+
+        args, batch = self._get_batch(func, args)
+        if config.slow_query_threshold is not None:
+            return self._tail_traced_execution(dropped, batch, func, *args, **kwargs)
+        if config.leaf_spans:
+            return self._leaf_traced_execution(config, dropped, batch, func, *args, **kwargs)
+
+        template = self._get_span_template(func, args)
+        # Tracers may mutate provided tags, so the shared template dict is never handed out directly
+        with config.tracer.start_active_span(template.operation_name, tags=dict(template.tags)) as scope:
             span = scope.span
-            span.set_tag(tags.DATABASE_TYPE, 'sql')
-            span.set_tag(tags.SPAN_KIND, tags.SPAN_KIND_RPC_CLIENT)
-            span.set_tag(tags.DATABASE_STATEMENT, self._get_query(args))
-
-            for tag, value in self._self_span_tags.items():
-                span.set_tag(tag, value)
-
+            if dropped:
+                span.set_tag('db.sampler.dropped', dropped)
+            start = perf_counter()
             try:
                 val = func(*args, **kwargs)
             except Exception as e:
-                span.set_tag(tags.ERROR, True)
-                span.set_tag('sfx.error.message', str(e))
-                span.set_tag('sfx.error.object', str(e.__class__))
-                span.set_tag('sfx.error.kind', e.__class__.__name__)
-                span.set_tag('sfx.error.stack', traceback.format_exc())
+                config.stack_capture.set_error_tags(span, e)
                 raise
-            span.set_tag('db.rows_produced', self.rowcount)
+            finally:
+                if batch is not None:
+                    batch.set_tags(span, perf_counter() - start)
+            span.set_tag('db.rows_produced', self._rows_produced(func))
+        self._start_fetch(func, span, template, perf_counter())
+        return val
+
+    def _active_span(self):
+        """Span that traced executions are children of"""
+        return self._self_config.tracer.active_span
+
+    def _start_span(self, template, **kwargs):
+        """Starts an unactivated span from `template`, as a child of the active span"""
+        # Tracers may mutate provided tags, so the shared template dict is never handed out directly
+        return self._self_config.tracer.start_span(template.operation_name, tags=dict(template.tags), **kwargs)
+
+    def _finished_span(self, func, args, start, dropped, wait_tags=None, **kwargs):
+        """
+        Creates and returns a span for an execution that has already completed, to be finished by the caller, along
+        with its template and the `wait_tags` accounted for it.
+        """
+        template = self._get_span_template(func, args)
+        span = self._start_span(template, start_time=start + _PERF_COUNTER_OFFSET, **kwargs)
+        if dropped:
+            span.set_tag('db.sampler.dropped', dropped)
+        if wait_tags:
+            for tag, value in wait_tags.items():
+                span.set_tag(tag, value)
+        return span, template
+
+    def _tail_traced_execution(self, dropped, batch, func, *args, **kwargs):
+        """
+        Execute function and only create its span afterwards if it failed, was slow, or has a parent that its tracer
+        doesn't report as unsampled.
+        """
+        pending, wait_tags = _pending_waits, None
+        if pending is not None:
+            pending.tags = wait_tags = {}
+        start = perf_counter()
+        try:
+            val = func(*args, **kwargs)
+        except Exception as e:
+            finish = perf_counter()
+            span, _ = self._finished_span(func, args, start, dropped, wait_tags)
+            self._self_config.stack_capture.set_error_tags(span, e)
+            if batch is not None:
+                batch.set_tags(span, finish - start)
+            span.finish(finish_time=finish + _PERF_COUNTER_OFFSET)
+            raise
+        finally:
+            if pending is not None:
+                pending.tags = None
+        finish = perf_counter()
+
+        if finish - start < self._self_config.slow_query_threshold:
+            active_span = self._active_span()
+            if active_span is None or _is_unsampled(active_span):
+                return val
+
+        span, template = self._finished_span(func, args, start, dropped, wait_tags)
+        if batch is not None:
+            batch.set_tags(span, finish - start)
+        span.set_tag('db.rows_produced', self._rows_produced(func))
+        span.finish(finish_time=finish + _PERF_COUNTER_OFFSET)
+        self._start_fetch(func, span, template, finish)
+        return val
+
+    def _leaf_traced_execution(self, config, dropped, batch, func, *args, **kwargs):
+        """
+        Execute function and only then start and finish its unactivated span, as a child of the active span, with all
+        of its tags provided upfront.
+        """
+        tracer = config.tracer
+        parent = tracer.active_span
+        pending, wait_tags = _pending_waits, None
+        if pending is not None:
+            pending.tags = wait_tags = {}
+        start = perf_counter()
+        try:
+            val = func(*args, **kwargs)
+        except Exception as e:
+            finish = perf_counter()
+            span, _ = self._finished_span(func, args, start, dropped, wait_tags, child_of=parent,
+                                          ignore_active_span=True)
+            config.stack_capture.set_error_tags(span, e)
+            if batch is not None:
+                batch.set_tags(span, finish - start)
+            span.finish(finish_time=finish + _PERF_COUNTER_OFFSET)
+            raise
+        finally:
+            if pending is not None:
+                pending.tags = None
+        finish = perf_counter()
+
+        template = self._get_span_template(func, args)
+        span_tags = dict(template.tags)
+        if wait_tags:
+            span_tags.update(wait_tags)
+        span_tags['db.rows_produced'] = self._rows_produced(func)
+        if dropped:
+            span_tags['db.sampler.dropped'] = dropped
+        span = tracer.start_span(template.operation_name, child_of=parent, ignore_active_span=True, tags=span_tags,
+                                 start_time=start + _PERF_COUNTER_OFFSET)
+        if batch is not None:
+            batch.set_tags(span, finish - start)
+        span.finish(finish_time=finish + _PERF_COUNTER_OFFSET)
+        self._start_fetch(func, span, template, finish)
         return val
 
     def __enter__(self):
         return self
 
 
-class Cursor(_Cursor, wrapt.ObjectProxy):
-    """A wrapper for a DB API Cursor object with traced execute(), executemany(), and callproc() methods."""
+class _CursorMethods(object):
+    """Traced Cursor methods, overridden by its classes specialized for their trace flag."""
 
-    def __init__(self, cursor, tracer=None, span_tags=None, trace_execute=True, trace_executemany=True,
-                 trace_callproc=True, *args, **kwargs):
-        wrapt.ObjectProxy.__init__(self, cursor)
-        _Cursor.__init__(self, tracer, span_tags, trace_execute, trace_executemany, trace_callproc)
+    def execute(self, *args, **kwargs):
+        return self._traced_execution(self.__wrapped__.execute, *args, **kwargs)
 
-    def _get_statement(self, args):
-        if isinstance(args[0], bytes):
-            arg = args[0].decode('utf8', 'replace')
-        else:
-            arg = args[0]
-        return arg.split(' ')[0]
+    def executemany(self, *args, **kwargs):
+        return self._traced_execution(self._paged_executemany(self.__wrapped__.executemany, args, kwargs), *args,
+                                      **kwargs)
 
-    def _get_query(self, args):
-        return self._format_query(args[0])
+    def callproc(self, *args, **kwargs):
+        return self._traced_execution(self.__wrapped__.callproc, *args, **kwargs)
 
-    def execute(self, *args, **kwargs):
-        if not self._self_trace_execute:
-            return self.__wrapped__.execute(*args, **kwargs)
+    def fetchone(self):
+        return self._traced_fetch(self.__wrapped__.fetchone)
 
-        return self._traced_execution(self.__wrapped__.execute, *args, **kwargs)
+    def fetchmany(self, *args, **kwargs):
+        return self._traced_fetch(self.__wrapped__.fetchmany, *args, **kwargs)
 
-    def executemany(self, *args, **kwargs):
-        if not self._self_trace_executemany:
-            return self.__wrapped__.executemany(*args, **kwargs)
+    def fetchall(self):
+        return self._traced_fetch(self.__wrapped__.fetchall)
 
-        return self._traced_execution(self.__wrapped__.executemany, *args, **kwargs)
+    def __iter__(self):
+        if self._self_fetch is None:
+            return iter(self.__wrapped__)
+        return self._traced_rows(self._self_fetch, iter(self.__wrapped__))
+
+
+class _CursorProxy(wrapt.ObjectProxy):
+    """Untraced Cursor methods, which its classes specialized for their trace flags override if traced."""
+    __slots__ = ()
+
+    def execute(self, *args, **kwargs):
+        self._self_rowcount = None
+        return self.__wrapped__.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._self_rowcount = None
+        return self.__wrapped__.executemany(*args, **kwargs)
 
     def callproc(self, *args, **kwargs):
-        if not self._self_trace_callproc:
-            return self.__wrapped__.callproc(*args, **kwargs)
+        self._self_rowcount = None
+        return self.__wrapped__.callproc(*args, **kwargs)
 
-        return self._traced_execution(self.__wrapped__.callproc, *args, **kwargs)
+    def fetchone(self):
+        return self.__wrapped__.fetchone()
+
+    def fetchmany(self, *args, **kwargs):
+        return self.__wrapped__.fetchmany(*args, **kwargs)
+
+    def fetchall(self):
+        return self.__wrapped__.fetchall()
+
+
+_cursor_classes = _SpecializedClasses(_CursorMethods, _CURSOR_FLAG_METHODS, _CursorProxy, _paged_rowcount)
+
+
+class Cursor(_Cursor, _CursorProxy):
+    """
+    A wrapper for a DB API Cursor object with traced execute(), executemany(), and callproc() methods.  Instances are
+    of a subclass specialized for their trace flags, which only overrides the methods being traced.
+    """
+    __slots__ = ('_self_config', '_self_fetch', '_self_rowcount')
+    # Trace flags of specialized subclasses
+    _trace_flags = None
+
+    def __new__(cls, cursor, tracer=None, span_tags=None, trace_execute=True, trace_executemany=True,
+                trace_callproc=True, span_template_cache=None, statement_mode=RAW, sampler=None,
+                slow_query_threshold=None, stack_capture=None, max_statement_length=None, measure_batch_bytes=False,
+                trace_fetch=False, leaf_spans=False, insert_paging=None, config=None, *args, **kwargs):
+        if cls._trace_flags is None:
+            if config is not None:
+                flags = _cursor_flags(config)
+            else:
+                flags = _enabled_cursor_flags(tracer, trace_execute, trace_executemany, trace_callproc, trace_fetch,
+                                              insert_paging)
+            cls = _cursor_classes.get(cls, flags)
+        return wrapt.ObjectProxy.__new__(cls)
+
+    def __init__(self, cursor, tracer=None, span_tags=None, trace_execute=True, trace_executemany=True,
+                 trace_callproc=True, span_template_cache=None, statement_mode=RAW, sampler=None,
+                 slow_query_threshold=None, stack_capture=None, max_statement_length=None, measure_batch_bytes=False,
+                 trace_fetch=False, leaf_spans=False, insert_paging=None, config=None, *args, **kwargs):
+        wrapt.ObjectProxy.__init__(self, cursor)
+        _Cursor.__init__(self, tracer, span_tags, trace_execute, trace_executemany, trace_callproc,
+                         span_template_cache, statement_mode, sampler, slow_query_threshold, stack_capture,
+                         max_statement_length, measure_batch_bytes, trace_fetch, leaf_spans, insert_paging, config)
+
+    def _get_query(self, args):
+        return self._format_query(args[0])
+
+    def _driver_method(self, name):
+        return getattr(self.__wrapped__, name, None)
+
+    def close(self):
+        self._finish_fetch()
+        return self.__wrapped__.close()
+
+    def __exit__(self, exc, value, tb):
+        self._finish_fetch()
+        return self.__wrapped__.__exit__(exc, value, tb)
@@ -0,0 +1,94 @@
+from select import select
+from threading import local
+
+import opentracing
+
+from .psycopg2_tracing import POLL_OK, POLL_READ, POLL_WRITE
+from . import tracing
+from .tracing import perf_counter
+
+
+def _select_read(fileno):
+    select([fileno], [], [])
+
+
+def _select_write(fileno):
+    select([], [fileno], [])
+
+
+class _WaitTotals(object):
+    """Totals of the waits of the span (or pending execution wait tags) they were accumulated for."""
+    target = None
+    waits = 0
+    blocked = 0.0
+    polling = 0.0
+
+
+class TracedWaitCallback(object):
+    """
+    A psycopg2 wait callback (for psycopg2.extensions.set_wait_callback()) that waits for connections to be ready
+    with select(), or gevent's wait_read() and wait_write() if `green`, and accounts for its waits on the active
+    span of `tracer`, e.g. the execution span of a traced cursor or connection.  Each span is tagged with its total
+    `db.wait.count` of waits, the seconds blocked in them as `db.wait.blocked_time` (hub switches, including the
+    time for the hub to resume the waiting greenlet), and the seconds spent in connection poll() calls as
+    `db.wait.poll_time`.  Waits of leaf and tail-based execution spans, which aren't active while they run, are
+    tagged on their span once it is created.
+
+    psycopg2.extensions.set_wait_callback(TracedWaitCallback(tracer, green=True))
+
+    Totals are kept per thread (per greenlet if `green`), and are only reset once a different span is active.
+    Alternative `wait_read` and `wait_write` functions of a file descriptor may be provided.
+    """
+
+    def __init__(self, tracer=None, wait_read=None, wait_write=None, green=False):
+        self._tracer = tracer
+        local_class, default_read, default_write = local, _select_read, _select_write
+        if green:  # Only imported when asked for, as it switches waits to the gevent hub
+            from gevent.local import local as local_class
+            from gevent.socket import wait_read as default_read, wait_write as default_write
+        self._wait_read = wait_read or default_read
+        self._wait_write = wait_write or default_write
+        self._totals = type('_WaitTotals', (_WaitTotals, local_class), {})()
+        # Executions only keep pending wait tags once a callback may account for them, and those of concurrent
+        # greenlets of a thread must not share them
+        tracing._use_pending_waits(local_class if green else None)
+
+    @property
+    def tracer(self):
+        return self._tracer or opentracing.tracer
+
+    def __call__(self, conn):
+        pending = tracing._pending_waits.tags
+        span = self.tracer.active_span if pending is None else None
+        target = pending if pending is not None else span
+        totals = self._totals
+        if target is not totals.target:
+            totals.target = target
+            totals.waits = 0
+            totals.blocked = totals.polling = 0.0
+
+        try:
+            while True:
+                start = perf_counter()
+                state = conn.poll()
+                polled = perf_counter()
+                totals.polling += polled - start
+                if state == POLL_OK:
+                    break
+                elif state == POLL_READ:
+                    self._wait_read(conn.fileno())
+                elif state == POLL_WRITE:
+                    self._wait_write(conn.fileno())
+                else:
+                    raise conn.OperationalError('Bad result from poll: {!r}'.format(state))
+                totals.waits += 1
+                totals.blocked += perf_counter() - polled
+        finally:
+            if pending is not None:
+                pending['db.wait.count'] = totals.waits
+                pending['db.wait.blocked_time'] = totals.blocked
+                pending['db.wait.poll_time'] = totals.polling
+            elif span is not None:
+                span.set_tag('db.wait.count', totals.waits)
+                span.set_tag('db.wait.blocked_time', totals.blocked)
+                span.set_tag('db.wait.poll_time', totals.polling)
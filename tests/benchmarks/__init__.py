@@ -0,0 +1 @@
+# Copyright (C) 2019 SignalFx, Inc. All rights reserved.
@@ -0,0 +1,77 @@
+"""
+Per-call cost of looking up the traced psycopg2 connection and cursor factory classes of PsycopgConnectionTracing, in
+its steady state where all classes are defined, versus that of as many uncontended and contended lock acquisitions,
+which lookups don't take.  Lookups must not define any class, even once garbage collections discarded unused ones.
+
+    python -m tests.benchmarks.factory_classes [calls]
+"""
+from __future__ import print_function
+from threading import Event, Lock, Thread
+import gc
+import sys
+import timeit
+
+from dbapi_opentracing.psycopg2_tracing import _connection_factory_classes, _cursor_factory_classes
+
+
+class Cursor(object):
+    pass
+
+
+class Connection(object):
+    pass
+
+
+def lookup(calls):
+    # Default trace flags, then whether connections are asynchronous
+    cursor_flags = (True, True, True, False, False, False)
+    connection_flags = (True, True, False)
+
+    def call():
+        _connection_factory_classes.get(Connection, connection_flags)
+        _cursor_factory_classes.get(Cursor, cursor_flags)
+
+    call()
+    definitions = _connection_factory_classes.definitions + _cursor_factory_classes.definitions
+    # timeit disables garbage collection, which would otherwise discard classes that aren't kept alive
+    gc.collect()
+    seconds = min(timeit.repeat(call, 'import gc; gc.enable()', number=calls, repeat=5))
+    assert _connection_factory_classes.definitions + _cursor_factory_classes.definitions == definitions
+    return seconds / calls * 1e6
+
+
+def locking(calls, contended):
+    lock = Lock()
+    stop = Event()
+
+    def contend():
+        while not stop.is_set():
+            with lock:
+                pass
+
+    def call():
+        with lock:
+            pass
+        with lock:
+            pass
+
+    thread = Thread(target=contend)
+    if contended:
+        thread.start()
+    try:
+        return min(timeit.repeat(call, number=calls, repeat=5)) / calls * 1e6
+    finally:
+        stop.set()
+        if contended:
+            thread.join()
+
+
+def main(calls=100000):
+    print('{:<24}{:>16}'.format('connection + cursor', 'per call (us)'))
+    print('{:<24}{:>16.3f}'.format('lookup', lookup(calls)))
+    print('{:<24}{:>16.3f}'.format('uncontended locks', locking(calls, False)))
+    print('{:<24}{:>16.3f}'.format('contended locks', locking(calls, True)))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,74 @@
+"""
+Per-call cost of traced execute() and commit() calls with activated spans versus leaf spans (leaf_spans=True), with
+the MockTracer and the no-op opentracing.Tracer, along with that of the untraced driver calls.  Methods of no-op tracer
+connections and cursors aren't traced at all, so their cost should be close to the driver's.
+
+    python -m tests.benchmarks.leaf_spans [calls]
+"""
+from __future__ import print_function
+import sys
+import timeit
+
+from opentracing.mocktracer import MockTracer
+import opentracing
+
+from dbapi_opentracing import ConnectionTracing
+
+
+class Cursor(object):
+    rowcount = 1
+
+    def execute(self, query, args=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class Connection(object):
+
+    def cursor(self):
+        return Cursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def per_call(tracer, leaf_spans, method, calls):
+    connection = Connection()
+    if leaf_spans is not None:
+        connection = ConnectionTracing(connection, tracer, span_tags=dict(component='benchmark'),
+                                       leaf_spans=leaf_spans)
+    cursor = connection.cursor()
+    call = {
+        'execute': lambda: cursor.execute('SELECT * FROM some_table WHERE id = %s', (1,)),
+        'commit': connection.commit,
+    }[method]
+    # Best of several repetitions, in microseconds per call
+    seconds = []
+    for _ in range(5):
+        if isinstance(tracer, MockTracer):
+            tracer.reset()
+        with tracer.start_active_span('parent'):
+            seconds.append(timeit.timeit(call, number=calls))
+    return min(seconds) / calls * 1e6
+
+
+def main(calls=20000):
+    print('{:<12}{:<10}{:>12}{:>12}{:>10}{:>14}'.format('tracer', 'method', 'active (us)', 'leaf (us)', 'saving',
+                                                        'driver (us)'))
+    for name, tracer in (('MockTracer', MockTracer()), ('no-op', opentracing.Tracer())):
+        for method in ('execute', 'commit'):
+            active = per_call(tracer, False, method, calls)
+            leaf = per_call(tracer, True, method, calls)
+            driver = per_call(tracer, None, method, calls)
+            saving = (active - leaf) / active * 100
+            row = '{:<12}{:<10}{:>12.2f}{:>12.2f}{:>9.0f}%{:>14.2f}'
+            print(row.format(name, method, active, leaf, saving, driver))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -1,8 +1,26 @@
 # Copyright (C) 2018-2019 SignalFx, Inc. All rights reserved.
 from random import choice, random, randint
+import os.path
 import string
 
 from opentracing.ext import tags
+import docker
+import pytest
+
+
+@pytest.fixture(scope='session')
+def postgres_container():
+    client = docker.from_env()
+
+    env = dict(POSTGRES_USER='postgres', POSTGRES_PASSWORD='pass', POSTGRES_DB='test_db')
+    initdb_d = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'psycopg2/initdb.d')
+    volumes = ['{}:/docker-entrypoint-initdb.d'.format(initdb_d)]
+    postgres = client.containers.run('postgres:latest', environment=env, ports={'5432/tcp': 5432},
+                                     volumes=volumes, detach=True)
+    try:
+        yield postgres
+    finally:
+        postgres.remove(v=True, force=True)
 
 
 class DBAPITest(object):
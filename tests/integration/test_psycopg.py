@@ -0,0 +1,90 @@
+# Copyright (C) 2018-2019 SignalFx, Inc. All rights reserved.
+from time import sleep
+
+from opentracing.mocktracer import MockTracer
+from opentracing.ext import tags
+import opentracing
+import psycopg
+import pytest
+
+from dbapi_opentracing import PsycopgConnectTracing
+from .conftest import DBAPITest
+
+
+class PsycopgTest(DBAPITest):
+
+    @pytest.fixture
+    def connection_tracing(self, postgres_container):
+        tracer = MockTracer()
+        opentracing.tracer = tracer
+        for _ in range(240):
+            try:
+                conn = PsycopgConnectTracing(host='127.0.0.1', user='test_user', password='test_password',
+                                             dbname='test_db', port=5432, options='-c search_path=test_schema',
+                                             tracer=tracer, span_tags=dict(custom='tag'))
+                break
+            except psycopg.OperationalError:
+                sleep(.25)
+        try:
+            yield tracer, conn
+        finally:
+            conn.close()
+
+
+class TestPsycopgPipeline(PsycopgTest):
+
+    def test_pipelined_executions_are_finished_on_results(self, connection_tracing):
+        tracer, conn = connection_tracing
+        values = [(self.random_int(), self.random_int(), self.random_float(), self.random_float())
+                  for _ in range(4)]
+        with conn.pipeline():
+            cursor = conn.cursor()
+            for value in values:
+                cursor.execute('insert into table_two values (%s, %s, %s, %s)', value)
+        conn.commit()
+
+        spans = tracer.finished_spans()
+        assert len(spans) == 6
+        self.assert_base_tags(spans)
+        executions, pipeline, commit = spans[:4], spans[4], spans[5]
+        for span in executions:
+            assert span.operation_name == 'Cursor.execute(insert)'
+            assert span.tags['db.rows_produced'] == 1
+            assert span.parent_id == pipeline.context.span_id
+        assert pipeline.operation_name == 'Connection.pipeline()'
+        assert pipeline.tags['db.pipeline.statements'] == 4
+        assert 1 <= pipeline.tags['db.pipeline.round_trips'] <= 4
+        assert pipeline.tags['db.pipeline.round_trips_saved'] == 4 - pipeline.tags['db.pipeline.round_trips']
+        assert commit.operation_name == 'Connection.commit()'
+        assert not cursor._self_pipelined
+
+    def test_pipelined_errors_are_tagged(self, connection_tracing):
+        tracer, conn = connection_tracing
+        value = (self.random_int(), self.random_int(), self.random_float(), self.random_float())
+        with pytest.raises(psycopg.errors.UniqueViolation):
+            with conn.pipeline():
+                cursor = conn.cursor()
+                cursor.execute('insert into table_two values (%s, %s, %s, %s)', value)
+                cursor.execute('insert into table_two values (%s, %s, %s, %s)', value)
+        conn.rollback()
+
+        first, second, pipeline, rollback = tracer.finished_spans()
+        assert tags.ERROR not in first.tags
+        assert second.tags[tags.ERROR] is True
+        assert second.tags['sfx.error.kind'] == 'UniqueViolation'
+        assert pipeline.tags[tags.ERROR] is True
+        assert rollback.operation_name == 'Connection.rollback()'
+        assert not cursor._self_pipelined
+
+    def test_executions_after_pipeline_are_traced(self, connection_tracing):
+        tracer, conn = connection_tracing
+        with conn.pipeline():
+            cursor = conn.cursor()
+            cursor.execute('select 1')
+        cursor.execute('select 2')
+        assert cursor.fetchall() == [(2,)]
+
+        pipelined, pipeline, execute = tracer.finished_spans()
+        assert pipelined.parent_id == pipeline.context.span_id
+        assert execute.parent_id is None
+        assert execute.tags['db.rows_produced'] == 1
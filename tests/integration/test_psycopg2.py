@@ -1,7 +1,6 @@
 # Copyright (C) 2018-2019 SignalFx, Inc. All rights reserved.
 from datetime import datetime
 from time import sleep
-import os.path
 
 from opentracing.mocktracer import MockTracer
 from psycopg2.extras import LogicalReplicationConnection, DictCursor, register_uuid
@@ -9,28 +8,12 @@ from opentracing.ext import tags
 from psycopg2 import extensions, sql
 import opentracing
 import psycopg2
-import docker
 import pytest
 
-from dbapi_opentracing import PsycopgConnectionTracing
+from dbapi_opentracing import AutoPrepare, PsycopgConnectionTracing
 from .conftest import DBAPITest
 
 
-@pytest.fixture(scope='session')
-def postgres_container():
-    client = docker.from_env()
-
-    env = dict(POSTGRES_USER='postgres', POSTGRES_PASSWORD='pass', POSTGRES_DB='test_db')
-    initdb_d = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'psycopg2/initdb.d')
-    volumes = ['{}:/docker-entrypoint-initdb.d'.format(initdb_d)]
-    postgres = client.containers.run('postgres:latest', environment=env, ports={'5432/tcp': 5432},
-                                     volumes=volumes, detach=True)
-    try:
-        yield postgres
-    finally:
-        postgres.remove(v=True, force=True)
-
-
 class Psycopg2Test(DBAPITest):
 
     @pytest.fixture
@@ -402,4 +385,31 @@ class TestPsycopgConnectionContext(Psycopg2Test):
         assert execute.operation_name == 'cursor.execute(INSERT)'
         assert execute.tags[tags.DATABASE_STATEMENT] == 'INSERT INTO table_one values (%s, %s, %s, %s)'
         assert execute.tags['db.rows_produced'] == 1
-        assert commit.operation_name == 'LogicalReplicationConnection.commit()'
\ No newline at end of file
+        assert commit.operation_name == 'LogicalReplicationConnection.commit()'
+
+
+class TestAutoPrepare(DBAPITest):
+
+    @pytest.fixture
+    def connection(self, postgres_container):
+        for _ in range(240):
+            try:
+                return psycopg2.connect(host='127.0.0.1', user='test_user', password='test_password',
+                                        dbname='test_db', port=5432, options='-c search_path=test_schema',
+                                        connection_factory=lambda dsn: PsycopgConnectionTracing(
+                                            dsn, tracer=MockTracer(), auto_prepare=AutoPrepare(threshold=1),
+                                        ))
+            except psycopg2.OperationalError:
+                sleep(.25)
+
+    def test_parameters_beyond_prepared_types_are_executed_unprepared(self, connection):
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute('select %s + 1', (1,))
+            assert cursor.fetchall() == [(2,)]
+            cursor.execute('select %s + 1', (2 ** 70,))
+            assert cursor.fetchall() == [(2 ** 70 + 1,)]
+            cursor.execute('select %s + 1', (float('inf'),))
+            assert cursor.fetchall() == [(float('inf'),)]
+            cursor.execute('select %s + 1', (3,))
+            assert cursor.fetchall() == [(4,)]
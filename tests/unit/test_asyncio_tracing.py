@@ -0,0 +1,360 @@
+import asyncio
+import gc
+import threading
+import time
+
+from opentracing.mocktracer import MockTracer
+from opentracing.ext import tags
+from opentracing.scope_managers.contextvars import ContextVarsScopeManager
+import opentracing
+import pytest
+
+from dbapi_opentracing import AsyncConnectionTracing, AsyncCursor, ExecutorConnectionTracing
+from .conftest import BaseSuite, is_traced
+
+
+class SomeException(Exception):
+    pass
+
+
+class FakeCursor(object):
+    """aiopg-like cursor over fixed rows."""
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.remaining = []
+        self.rowcount = -1
+        self.executed = []
+        self.closed = False
+
+    async def execute(self, query, args=None):
+        await asyncio.sleep(0)
+        if query.startswith('FAIL'):
+            raise SomeException('failed')
+        self.executed.append(query)
+        self.remaining = list(self.rows)
+        self.rowcount = len(self.rows)
+
+    async def executemany(self, query, seq_of_args):
+        for args in seq_of_args:
+            await self.execute(query, args)
+
+    async def fetchone(self):
+        return self.remaining.pop(0) if self.remaining else None
+
+    async def fetchmany(self, size=1):
+        rows, self.remaining = self.remaining[:size], self.remaining[size:]
+        return rows
+
+    async def fetchall(self):
+        rows, self.remaining = self.remaining, []
+        return rows
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        row = await self.fetchone()
+        if row is None:
+            raise StopAsyncIteration
+        return row
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection(object):
+    """aiopg-like connection, whose cursor() is a coroutine."""
+
+    def __init__(self, rows=()):
+        self.rows = rows
+        self.cursors = []
+        self.committed = False
+
+    async def cursor(self):
+        cursor = FakeCursor(self.rows)
+        self.cursors.append(cursor)
+        return cursor
+
+    async def commit(self):
+        self.committed = True
+
+    async def rollback(self):
+        pass
+
+
+class FakeAsyncpgConnection(object):
+    """asyncpg-like connection, executing statements itself."""
+
+    async def execute(self, query, *args):
+        return 'SELECT 1'
+
+    async def executemany(self, command, args):
+        for _ in args:
+            await asyncio.sleep(0)
+
+    async def fetch(self, query, *args):
+        return [(1,), (2,)]
+
+    async def fetchrow(self, query, *args):
+        return (1,)
+
+    async def fetchval(self, query, *args):
+        return 1
+
+
+class TestAsyncCursor(BaseSuite):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer(scope_manager=ContextVarsScopeManager())
+
+    def test_execute_is_traced(self):
+        connection = AsyncConnectionTracing(FakeConnection([(1,), (2,)]), self.tracer, span_tags=dict(one=1))
+
+        async def query():
+            async with connection.cursor() as cursor:
+                assert isinstance(cursor, AsyncCursor)
+                await cursor.execute('SELECT * FROM some_table')
+                assert await cursor.fetchall() == [(1,), (2,)]
+            return cursor
+
+        cursor = asyncio.run(query())
+        assert cursor.closed
+        spans = self.tracer.finished_spans()
+        assert len(spans) == 1
+        self.assert_base_tags(spans)
+        span = spans.pop()
+        assert span.operation_name == 'FakeCursor.execute(SELECT)'
+        assert span.tags[tags.DATABASE_STATEMENT] == 'SELECT * FROM some_table'
+        assert span.tags['db.sql.table'] == 'some_table'
+        assert span.tags['db.rows_produced'] == 2
+        assert span.tags['one'] == 1
+
+    def test_errors_are_tagged(self):
+        cursor = AsyncCursor(FakeCursor(), self.tracer)
+        with pytest.raises(SomeException):
+            asyncio.run(cursor.execute('FAIL'))
+        span, = self.tracer.finished_spans()
+        assert span.tags[tags.ERROR] is True
+        assert span.tags['sfx.error.kind'] == 'SomeException'
+
+    def test_executemany_batch_is_tagged(self):
+        cursor = AsyncCursor(FakeCursor(), self.tracer)
+        asyncio.run(cursor.executemany('INSERT INTO some_table VALUES (%s)', iter([(1,), (2,), (3,)])))
+        span, = self.tracer.finished_spans()
+        assert span.operation_name == 'FakeCursor.executemany(INSERT)'
+        assert span.tags['db.batch.size'] == 3
+
+    def test_concurrent_executions_have_their_task_parent(self):
+        connection = AsyncConnectionTracing(FakeConnection(), self.tracer)
+
+        async def request(number):
+            with self.tracer.start_active_span('request {}'.format(number)):
+                cursor = await connection.cursor()
+                await cursor.execute('SELECT {}'.format(number))
+
+        async def requests():
+            await asyncio.gather(*(request(number) for number in range(50)))
+
+        asyncio.run(requests())
+        spans = self.tracer.finished_spans()
+        parents = dict((span.operation_name, span) for span in spans if span.operation_name.startswith('request'))
+        executions = [span for span in spans if span.operation_name.startswith('FakeCursor')]
+        assert len(executions) == 50
+        for span in executions:
+            number = span.tags[tags.DATABASE_STATEMENT].split()[1]
+            assert span.parent_id == parents['request ' + number].context.span_id
+
+    def test_fetch_and_async_iteration_are_traced(self):
+        cursor = AsyncCursor(FakeCursor([(1,), (2,), (3,)]), self.tracer, trace_fetch=True)
+
+        async def query():
+            await cursor.execute('SELECT * FROM some_table')
+            assert await cursor.fetchone() == (1,)
+            return [row async for row in cursor]
+
+        assert asyncio.run(query()) == [(2,), (3,)]
+        execute, fetch = self.tracer.finished_spans()
+        assert fetch.operation_name == 'FakeCursor.fetch(SELECT)'
+        assert fetch.tags['db.fetch.rows'] == 3
+        assert fetch.parent_id == execute.context.span_id
+
+    def test_disabled_methods_are_passed_through(self):
+        cursor = AsyncCursor(FakeCursor([(1,)]), self.tracer, trace_execute=False)
+        assert not is_traced(cursor, 'execute')
+        assert not is_traced(cursor, 'fetchone')
+
+        async def query():
+            await cursor.execute('SELECT 1')
+            return [row async for row in cursor]
+
+        assert asyncio.run(query()) == [(1,)]
+        assert not self.tracer.finished_spans()
+
+    def test_non_contextvars_tracers_use_separate_scope_manager(self):
+        tracer = MockTracer()
+        connection = AsyncConnectionTracing(FakeConnection(), tracer)
+
+        async def query():
+            cursor = await connection.cursor()
+            await cursor.execute('SELECT 1')
+
+        with tracer.start_active_span('thread local'):
+            asyncio.run(query())
+        execute, _ = tracer.finished_spans()
+        assert execute.parent_id is None
+
+
+class TestAsyncConnectionTracing(BaseSuite):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer(scope_manager=ContextVarsScopeManager())
+
+    def test_commit_is_traced(self):
+        connection = AsyncConnectionTracing(FakeConnection(), self.tracer, trace_rollback=False)
+        assert not is_traced(connection, 'rollback')
+        assert not hasattr(type(connection), 'fetchrow')
+        asyncio.run(connection.commit())
+        asyncio.run(connection.rollback())
+        assert connection.committed
+        span, = self.tracer.finished_spans()
+        self.assert_base_tags([span])
+        assert span.operation_name == 'FakeConnection.commit()'
+
+    def test_asyncpg_statements_are_traced(self):
+        connection = AsyncConnectionTracing(FakeAsyncpgConnection(), self.tracer)
+
+        async def queries():
+            with self.tracer.start_active_span('request'):
+                assert await connection.fetchrow('SELECT * FROM some_table WHERE id = $1', 1) == (1,)
+                assert await connection.fetch('SELECT * FROM other_table') == [(1,), (2,)]
+                await connection.executemany('INSERT INTO some_table VALUES ($1)', [(1,), (2,)])
+
+        asyncio.run(queries())
+        fetchrow, fetch, executemany, request = self.tracer.finished_spans()
+        assert fetchrow.operation_name == 'FakeAsyncpgConnection.fetchrow(SELECT)'
+        assert fetchrow.tags['db.sql.table'] == 'some_table'
+        assert 'db.rows_produced' not in fetchrow.tags
+        assert fetch.operation_name == 'FakeAsyncpgConnection.fetch(SELECT)'
+        assert executemany.tags['db.batch.size'] == 2
+        assert all(span.parent_id == request.context.span_id for span in (fetchrow, fetch, executemany))
+
+    def test_noop_tracer_asyncpg_statements_are_passed_through(self):
+        connection = AsyncConnectionTracing(FakeAsyncpgConnection(), opentracing.Tracer())
+        assert connection._trace_flags == (False, False, True)
+        assert asyncio.run(connection.fetchrow('SELECT 1')) == (1,)
+
+
+class BlockingCursor(object):
+    """Synchronous cursor, sleeping in execute() while tracking concurrent executions."""
+    arraysize = 2
+    rowcount = 1
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, query, args=None):
+        connection = self.connection
+        with connection.lock:
+            connection.executing += 1
+            connection.peak_executing = max(connection.peak_executing, connection.executing)
+        time.sleep(connection.delay)
+        with connection.lock:
+            connection.executing -= 1
+        connection.threads.add(threading.current_thread())
+        self.rows = [(1,), (2,), (3,)]
+
+    def fetchmany(self, size=1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class BlockingConnection(object):
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.executing = 0
+        self.peak_executing = 0
+        self.threads = set()
+        self.closed = False
+
+    def cursor(self):
+        return BlockingCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class TestExecutorConnectionTracing(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer(scope_manager=ContextVarsScopeManager())
+
+    def test_executions_run_on_executor_under_task_span(self):
+        connection = ExecutorConnectionTracing(BlockingConnection(), self.tracer)
+
+        async def query():
+            with self.tracer.start_active_span('request'):
+                async with connection.cursor() as cursor:
+                    await cursor.execute('SELECT * FROM some_table')
+                    assert cursor.rowcount == 1
+                    return [row async for row in cursor]
+
+        assert asyncio.run(query()) == [(1,), (2,), (3,)]
+        assert threading.main_thread() not in connection.threads
+        spans = dict((span.operation_name, span) for span in self.tracer.finished_spans())
+        offload, execute = spans['executor.execute'], spans['BlockingCursor.execute(SELECT)']
+        assert offload.parent_id == spans['request'].context.span_id
+        assert execute.parent_id == offload.context.span_id
+        assert offload.tags['db.executor.queue_wait'] >= 0
+        assert offload.tags['db.executor.in_flight'] == 1
+
+    def test_in_flight_calls_are_capped_and_queue_wait_is_recorded(self):
+        connection = ExecutorConnectionTracing(BlockingConnection(delay=.02), self.tracer, max_workers=4,
+                                               max_in_flight=2)
+
+        async def query():
+            cursor = await connection.cursor()
+            await cursor.execute('SELECT 1')
+
+        async def queries():
+            await asyncio.gather(*(query() for _ in range(6)))
+            await connection.close()
+
+        # A collection pausing the event loop while the first calls run would delay queueing the others
+        gc.collect()
+        asyncio.run(queries())
+        assert connection.peak_executing == 2
+        assert connection.closed
+        waits = sorted(span.tags['db.executor.queue_wait'] for span in self.tracer.finished_spans()
+                       if span.operation_name == 'executor.execute')
+        assert len(waits) == 6
+        assert waits[-1] >= .03
+
+    def test_untraced_offload_runs_under_task_span(self):
+        connection = ExecutorConnectionTracing(BlockingConnection(), self.tracer, trace_offload=False,
+                                               trace_commit=False)
+
+        async def query():
+            with self.tracer.start_active_span('request'):
+                cursor = await connection.cursor()
+                await cursor.execute('SELECT 1')
+                await connection.commit()
+
+        asyncio.run(query())
+        execute, request = self.tracer.finished_spans()
+        assert execute.parent_id == request.context.span_id
@@ -0,0 +1,39 @@
+# Copyright (C) 2019 SignalFx, Inc. All rights reserved.
+import pytest
+
+from dbapi_opentracing.cache import LRUCache
+
+
+class TestLRUCache(object):
+
+    def test_get_counts_hits_and_misses(self):
+        cache = LRUCache(2)
+        assert cache.get('one') is None
+        cache.put('one', 1)
+        assert cache.get('one') == 1
+        assert cache.get('two', 'default') == 'default'
+        assert cache.hits == 1
+        assert cache.misses == 2
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(2)
+        cache.put('one', 1)
+        cache.put('two', 2)
+        cache.get('one')
+        assert cache.put('three', 3) == ('two', 2)
+        assert 'one' in cache
+        assert 'two' not in cache
+        assert 'three' in cache
+        assert len(cache) == 2
+
+    def test_clear_resets_counters(self):
+        cache = LRUCache(2)
+        cache.put('one', 1)
+        cache.get('one')
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.hits == cache.misses == 0
+
+    def test_maxsize_must_be_positive(self):
+        with pytest.raises(ValueError):
+            LRUCache(0)
@@ -0,0 +1,155 @@
+# Copyright (C) 2019 SignalFx, Inc. All rights reserved.
+from types import ModuleType
+
+from opentracing.mocktracer import MockTracer
+from opentracing.ext import tags
+from mock import patch
+import pytest
+
+from dbapi_opentracing import ConnectionTracing, StackCapture
+from .test_tracing import MockDBAPIConnection, MockDBAPICursor
+
+
+class SomeException(Exception):
+    pass
+
+
+# Driver module whose execute() raises its DB API errors, as a C driver's would from the traced method's call
+driver = ModuleType('driver')
+exec(compile("""
+class Error(Exception):
+    pass
+
+
+class OperationalError(Error):
+    pass
+
+
+def execute(self, query, args=None):
+    raise OperationalError('failed')
+""", '<driver>', 'exec'), driver.__dict__)
+
+
+def raise_error(message='message'):
+    raise SomeException(message)
+
+
+def nested_raise_error():
+    raise_error()
+
+
+def raise_other_error():
+    raise SomeException('other')
+
+
+class TestStackCapture(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+
+    def capture(self, stack_capture, func=raise_error):
+        span = self.tracer.start_span('span')
+        try:
+            func()
+        except SomeException as e:
+            stack_capture.set_error_tags(span, e)
+        span.finish()
+        return span.tags
+
+    def test_full_stack_by_default(self):
+        span_tags = self.capture(StackCapture(), nested_raise_error)
+        assert span_tags[tags.ERROR] is True
+        assert span_tags['sfx.error.kind'] == 'SomeException'
+        assert span_tags['sfx.error.message'] == 'message'
+        assert span_tags['sfx.error.object'] == str(SomeException)
+        assert span_tags['sfx.error.stack'].startswith('Traceback (most recent call last):\n')
+        assert 'in nested_raise_error' in span_tags['sfx.error.stack']
+        assert 'sfx.error.stack_id' not in span_tags
+
+    def test_disabled_stack(self):
+        span_tags = self.capture(StackCapture(limit=0))
+        assert span_tags['sfx.error.kind'] == 'SomeException'
+        assert 'sfx.error.stack' not in span_tags
+
+    def test_innermost_frames(self):
+        stack = self.capture(StackCapture(limit=1), nested_raise_error)['sfx.error.stack']
+        assert 'in raise_error' in stack
+        assert "raise SomeException(message)" in stack
+        assert 'in nested_raise_error' not in stack
+        assert stack.endswith('SomeException: message\n')
+
+    def test_deduplicated_stacks(self):
+        stack_capture = StackCapture(deduplicate=True)
+        first = self.capture(stack_capture)
+        second = self.capture(stack_capture, nested_raise_error)
+        assert len(first['sfx.error.stack_id']) == 12
+        assert 'sfx.error.stack' in first
+        assert second['sfx.error.stack_id'] == first['sfx.error.stack_id']
+        assert 'sfx.error.stack' not in second
+
+        other_site = self.capture(stack_capture, raise_other_error)
+        assert other_site['sfx.error.stack_id'] != first['sfx.error.stack_id']
+        assert 'sfx.error.stack' in other_site
+
+    def test_rate_limited_stacks(self):
+        now = [0.0]
+        stack_capture = StackCapture(rate=1, clock=lambda: now[0])
+        assert 'sfx.error.stack' in self.capture(stack_capture)
+        assert 'sfx.error.stack' not in self.capture(stack_capture)
+        now[0] = 1.0
+        assert 'sfx.error.stack' in self.capture(stack_capture)
+
+    def test_rate_limited_stacks_keep_their_id(self):
+        stack_capture = StackCapture(deduplicate=True, rate=1, clock=lambda: 0.0)
+        first = self.capture(stack_capture, raise_other_error)
+        limited = self.capture(stack_capture)
+        assert 'sfx.error.stack' in first
+        assert 'sfx.error.stack' not in limited
+        assert len(limited['sfx.error.stack_id']) == 12
+        assert self.capture(stack_capture, nested_raise_error)['sfx.error.stack_id'] == limited['sfx.error.stack_id']
+
+    def test_rate_limited_sites_are_captured_once_refilled(self):
+        now = [0.0]
+        stack_capture = StackCapture(deduplicate=True, rate=1, clock=lambda: now[0])
+        assert 'sfx.error.stack' in self.capture(stack_capture, raise_other_error)
+        limited = self.capture(stack_capture)
+        assert 'sfx.error.stack' not in limited
+        now[0] = 200.0
+        refilled = self.capture(stack_capture)
+        assert 'sfx.error.stack' in refilled
+        assert refilled['sfx.error.stack_id'] == limited['sfx.error.stack_id']
+        assert 'sfx.error.stack' not in self.capture(stack_capture)
+
+
+class TestConnectionTracingStackCapture(object):
+
+    def test_cursor_uses_connection_stack_capture(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer, stack_capture=StackCapture(deduplicate=True))
+        with connection.cursor() as cursor:
+            with patch.object(MockDBAPICursor, 'execute', side_effect=SomeException('message')) as execute:
+                execute.__name__ = 'execute'
+                for _ in range(2):
+                    with pytest.raises(SomeException):
+                        cursor.execute('INSERT INTO some_table VALUES (1)')
+        first, second = tracer.finished_spans()
+        assert 'sfx.error.stack' in first.tags
+        assert 'sfx.error.stack' not in second.tags
+        assert second.tags['sfx.error.stack_id'] == first.tags['sfx.error.stack_id']
+
+    def test_driver_errors_are_deduplicated_per_call_site(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer, stack_capture=StackCapture(deduplicate=True))
+        with patch.object(MockDBAPICursor, 'execute', driver.execute):
+            with connection.cursor() as cursor:
+                for query in ('SELECT 1', 'SELECT 2'):
+                    with pytest.raises(driver.OperationalError):
+                        cursor.execute(query)
+                with pytest.raises(driver.OperationalError):
+                    cursor.execute('SELECT 3')
+        first, second, other_site = tracer.finished_spans()
+        assert second.tags['sfx.error.stack_id'] == first.tags['sfx.error.stack_id']
+        assert 'sfx.error.stack' not in second.tags
+        assert other_site.tags['sfx.error.stack_id'] != first.tags['sfx.error.stack_id']
+        assert 'sfx.error.stack' in other_site.tags
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+from decimal import Decimal
+from functools import partial
+import sqlite3
+
+from opentracing.mocktracer import MockTracer
+from opentracing.ext import tags
+import pytest
+
+from dbapi_opentracing import ConnectionTracing, InsertPaging, PsycopgConnectionTracing, SubclassConnectionTracing
+from .test_psycopg2 import MockDBAPIConnection
+
+
+class RecordingCursor(object):
+    rowcount = 1
+
+    def __init__(self):
+        self.executed = []
+        self.copied = []
+
+    def execute(self, query, args=None):
+        self.executed.append((query, args))
+
+    def executemany(self, query, args):
+        self.executed.append((query, list(args)))
+
+    def close(self):
+        pass
+
+
+class CopyingCursor(RecordingCursor):
+
+    def copy_expert(self, sql, file):
+        self.copied.append((sql, file.read()))
+
+
+class PsycopgCopyingCursor(CopyingCursor):
+
+    def __init__(self, connection, *args, **kwargs):
+        CopyingCursor.__init__(self)
+
+
+class RecordingConnection(object):
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class TestInsertPaging(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+
+    def executemany(self, cursor, query, parameters, **kwargs):
+        connection = ConnectionTracing(RecordingConnection(cursor), self.tracer,
+                                       insert_paging=InsertPaging(page_size=2, **kwargs))
+        connection.cursor().executemany(query, parameters)
+        return cursor
+
+    def test_inserts_are_sent_in_pages(self):
+        statement = 'INSERT INTO some_table (a, b) VALUES (%s, %s);'
+        cursor = self.executemany(RecordingCursor(), statement, [(1, 2), (3, 4), (5, 6)])
+        assert cursor.executed == [
+            ('INSERT INTO some_table (a, b) VALUES (%s, %s), (%s, %s)', [1, 2, 3, 4]),
+            ('INSERT INTO some_table (a, b) VALUES (%s, %s)', [5, 6]),
+        ]
+
+        span, = self.tracer.finished_spans()
+        assert span.operation_name == 'RecordingCursor.executemany(INSERT)'
+        assert span.tags[tags.DATABASE_STATEMENT] == statement
+        assert span.tags['db.batch.size'] == 3
+        assert span.tags['db.batch.page_size'] == 2
+        assert span.tags['db.batch.pages'] == 2
+        assert span.tags['db.batch.rows_per_second'] > 0
+        assert span.tags['db.rows_produced'] == 2
+
+    def test_unknown_page_rowcounts_are_reported(self):
+        class UncountedCursor(RecordingCursor):
+            def execute(self, query, args=None):
+                RecordingCursor.execute(self, query, args)
+                self.rowcount = -1 if len(self.executed) == 1 else 1
+
+        self.executemany(UncountedCursor(), 'INSERT INTO t VALUES (%s)', [(1,), (2,), (3,)])
+        span, = self.tracer.finished_spans()
+        assert span.tags['db.rows_produced'] == -1
+
+    def test_parameter_iterators_are_paged_lazily(self):
+        parameters = ((i,) for i in range(4))
+        cursor = self.executemany(RecordingCursor(), 'insert into t values (?)', parameters)
+        assert [query for query, _ in cursor.executed] == ['insert into t values (?), (?)'] * 2
+        span, = self.tracer.finished_spans()
+        assert span.tags['db.batch.size'] == 4
+        assert span.tags['db.batch.pages'] == 2
+
+    @pytest.mark.parametrize('statement', [
+        'INSERT INTO t VALUES (%s, now())',
+        'INSERT INTO t VALUES (%s) ON CONFLICT DO NOTHING',
+        'INSERT INTO t VALUES (%(a)s)',
+        'INSERT INTO t SELECT %s',
+        'UPDATE t SET a = %s',
+        b'INSERT INTO t VALUES (%s)',
+    ])
+    def test_other_statements_are_not_paged(self, statement):
+        cursor = self.executemany(RecordingCursor(), statement, [(1,), (2,)])
+        assert cursor.executed == [(statement, [(1,), (2,)])]
+        span, = self.tracer.finished_spans()
+        assert 'db.batch.pages' not in span.tags
+
+    def test_pages_are_copied(self):
+        parameters = [(1, u'a\tb\\c\nd', None), (True, b'\x00\xff', Decimal('1.5')),
+                      (2.5, float('nan'), date(2019, 1, 2))]
+        cursor = self.executemany(CopyingCursor(), 'INSERT INTO "s"."t" (a, b, c) VALUES (%s, %s, %s)', parameters,
+                                  copy=True)
+        assert not cursor.executed
+        assert cursor.copied == [
+            (u'COPY "s"."t" (a, b, c) FROM STDIN', u'1\ta\\tb\\\\c\\nd\t\\N\nt\t\\\\x00ff\t1.5\n'),
+            (u'COPY "s"."t" (a, b, c) FROM STDIN', u'2.5\tNaN\t2019-01-02\n'),
+        ]
+        span, = self.tracer.finished_spans()
+        assert span.tags['db.batch.pages'] == 2
+
+    def test_pages_of_unknown_values_are_inserted(self):
+        cursor = self.executemany(CopyingCursor(), 'INSERT INTO t VALUES (%s)', [(1,), ([2],), (3,)], copy=True)
+        assert cursor.copied == [(u'COPY t FROM STDIN', u'3\n')]
+        assert cursor.executed == [('INSERT INTO t VALUES (%s), (%s)', [1, [2]])]
+
+    def test_clients_without_copy_are_inserted(self):
+        cursor = self.executemany(RecordingCursor(), 'INSERT INTO t VALUES (%s)', [(1,)], copy=True)
+        assert cursor.executed == [('INSERT INTO t VALUES (%s)', [1])]
+
+    def test_page_size_is_validated(self):
+        with pytest.raises(ValueError):
+            InsertPaging(page_size=0)
+
+    def test_subclassed_cursors_are_paged(self):
+        connection = sqlite3.connect(':memory:', factory=partial(
+            SubclassConnectionTracing, tracer=self.tracer, connection_factory=sqlite3.Connection,
+            insert_paging=InsertPaging(page_size=3)
+        ))
+        cursor = connection.cursor()
+        cursor.execute('CREATE TABLE t (a, b)')
+        cursor.executemany('INSERT INTO t (a, b) VALUES (?, ?)', [(i, str(i)) for i in range(7)])
+        assert cursor.rowcount == 7
+        assert cursor.execute('SELECT * FROM t').fetchall() == [(i, str(i)) for i in range(7)]
+
+        create, executemany, select = self.tracer.finished_spans()
+        assert executemany.operation_name == 'Cursor.executemany(INSERT)'
+        assert executemany.tags['db.batch.size'] == 7
+        assert executemany.tags['db.batch.pages'] == 3
+        assert executemany.tags['db.rows_produced'] == 7
+
+    @pytest.mark.parametrize('trace_execute', [True, False])
+    @pytest.mark.parametrize('subclass', [True, False])
+    def test_rowcount_is_that_of_unpaged_executemany(self, subclass, trace_execute):
+        rowcounts = []
+        for paging in (None, InsertPaging(page_size=3)):
+            kwargs = dict(tracer=self.tracer, trace_execute=trace_execute, insert_paging=paging)
+            if subclass:
+                connection = sqlite3.connect(':memory:', factory=partial(
+                    SubclassConnectionTracing, connection_factory=sqlite3.Connection, **kwargs
+                ))
+            else:
+                connection = ConnectionTracing(sqlite3.connect(':memory:'), **kwargs)
+            cursor = connection.cursor()
+            cursor.execute('CREATE TABLE t (a, b)')
+            cursor.executemany('INSERT INTO t (a, b) VALUES (?, ?)', [(i, str(i)) for i in range(7)])
+            paged = cursor.rowcount
+            # The paged total is only that of executemany(), even if the next execution affects as many rows as its
+            # last page
+            cursor.execute('UPDATE t SET b = NULL WHERE a = 0')
+            rowcounts.append((paged, cursor.rowcount))
+        assert rowcounts == [(7, 1), (7, 1)]
+
+    @pytest.mark.parametrize('subclass', [True, False])
+    def test_rowcount_is_only_overridden_when_paged(self, subclass):
+        for paging in (None, InsertPaging(page_size=3)):
+            kwargs = dict(tracer=self.tracer, insert_paging=paging)
+            if subclass:
+                connection = sqlite3.connect(':memory:', factory=partial(
+                    SubclassConnectionTracing, connection_factory=sqlite3.Connection, **kwargs
+                ))
+            else:
+                connection = ConnectionTracing(sqlite3.connect(':memory:'), **kwargs)
+            overridden = any('rowcount' in vars(cls) for cls in type(connection.cursor()).__mro__
+                             if cls is not sqlite3.Cursor)
+            assert overridden is (paging is not None)
+
+    def test_psycopg_cursors_are_paged(self):
+        connection = PsycopgConnectionTracing('dbname=test', connection_factory=MockDBAPIConnection,
+                                              cursor_factory=PsycopgCopyingCursor, tracer=self.tracer,
+                                              insert_paging=InsertPaging(page_size=2, copy=True))
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO t VALUES (%s)', [(1,), (2,), (3,)])
+        assert cursor.copied == [(u'COPY t FROM STDIN', u'1\n2\n'), (u'COPY t FROM STDIN', u'3\n')]
+        assert cursor.rowcount == 2
+        span, = self.tracer.finished_spans()
+        assert span.operation_name == 'PsycopgCopyingCursor.executemany(INSERT)'
+        assert span.tags['db.batch.pages'] == 2
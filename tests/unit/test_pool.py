@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+from threading import Thread
+import time
+
+from opentracing.mocktracer import MockTracer
+from opentracing.ext import tags
+import pytest
+
+from dbapi_opentracing import ConnectionTracing, PoolError, TracedConnectionPool
+from .test_tracing import MockDBAPICursor
+
+
+class MockConnection(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def cursor(self):
+        return MockDBAPICursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class MockPool(object):
+    """
+    psycopg2.pool compatible pool keeping up to minconn idle connections, which returns the same connection for each
+    getconn() of a key until it is returned.
+    """
+    minconn = 1
+    maxconn = 4
+
+    def __init__(self):
+        self.idle = [MockConnection()]
+        self.keyed = {}
+
+    def getconn(self, key=None):
+        if key in self.keyed:
+            return self.keyed[key]
+        conn = self.idle.pop() if self.idle else MockConnection()
+        if key is not None:
+            self.keyed[key] = conn
+        return conn
+
+    def putconn(self, conn, key=None, close=False):
+        self.keyed.pop(key, None)
+        if close or len(self.idle) >= self.minconn:
+            conn.close()
+        else:
+            self.idle.append(conn)
+
+    def closeall(self):
+        for conn in self.idle:
+            conn.close()
+
+
+class TestTracedConnectionPool(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+        self.connections = []
+
+    def connect(self):
+        self.connections.append(MockConnection())
+        return self.connections[-1]
+
+    def test_connections_are_reused_and_traced(self):
+        pool = TracedConnectionPool(self.connect, self.tracer, span_tags=dict(one=1), maxconn=2)
+        first = pool.getconn()
+        assert isinstance(first, ConnectionTracing)
+        pool.putconn(first)
+        assert pool.getconn() is first
+        assert len(self.connections) == 1
+        assert pool.in_use == 1
+        assert pool.idle == 0
+
+        spans = self.tracer.finished_spans()
+        assert len(spans) == 2
+        for span in spans:
+            assert span.operation_name == 'TracedConnectionPool.getconn'
+            assert span.tags[tags.DATABASE_TYPE] == 'sql'
+            assert span.tags['one'] == 1
+            assert span.tags['db.pool.wait_time'] >= 0
+            assert span.tags['db.pool.in_use'] == 1
+            assert span.tags['db.pool.max'] == 2
+            assert span.tags['db.pool.saturation'] == .5
+            assert span.tags['db.pool.peak_in_use'] == 1
+
+    def test_prewarm(self):
+        pool = TracedConnectionPool(self.connect, self.tracer, maxconn=2, prewarm=3)
+        assert len(self.connections) == 2
+        assert pool.idle == 2
+        assert pool.in_use == 0
+        assert pool.peak_in_use == 2
+        assert not self.tracer.finished_spans()
+
+        pool.closeall()
+        assert pool.idle == 0
+        assert len(self.connections) == 2
+
+    def test_checkout_waits_for_returned_connection(self):
+        pool = TracedConnectionPool(self.connect, self.tracer, maxconn=1)
+        connection = pool.getconn()
+
+        def release():
+            time.sleep(.05)
+            pool.putconn(connection)
+
+        thread = Thread(target=release)
+        thread.start()
+        assert pool.getconn() is connection
+        thread.join()
+
+        span = self.tracer.finished_spans()[-1]
+        assert span.tags['db.pool.wait_time'] >= .04
+        assert span.tags['db.pool.saturation'] == 1
+
+    def test_checkout_timeout(self):
+        pool = TracedConnectionPool(self.connect, self.tracer, maxconn=1, timeout=.01)
+        pool.getconn()
+        with pytest.raises(PoolError):
+            pool.getconn()
+        span = self.tracer.finished_spans()[-1]
+        assert span.tags[tags.ERROR] is True
+        assert span.tags['sfx.error.kind'] == 'PoolError'
+
+    def test_closed_connections_are_replaced(self):
+        pool = TracedConnectionPool(self.connect, self.tracer, maxconn=1)
+        connection = pool.getconn()
+        pool.putconn(connection, close=True)
+        assert connection.__wrapped__.closed
+        assert pool.getconn() is not connection
+        assert len(self.connections) == 2
+
+    def test_psycopg2_pool_proxies_are_reused(self):
+        pool = TracedConnectionPool(MockPool(), self.tracer)
+        first = pool.getconn()
+        second = pool.getconn()
+        assert pool.in_use == 2
+        pool.putconn(first)
+        pool.putconn(second)
+        # Connections beyond minconn are closed by the pool
+        assert second.__wrapped__.closed
+        assert pool.idle == 1
+        assert pool.getconn() is first
+
+        span = self.tracer.finished_spans()[-1]
+        assert span.operation_name == 'MockPool.getconn'
+        assert span.tags['db.pool.max'] == 4
+        assert span.tags['db.pool.peak_in_use'] == 2
+
+    def test_psycopg2_pool_keyed_connections_are_counted_once(self):
+        pool = TracedConnectionPool(MockPool(), self.tracer)
+        connection = pool.getconn('k')
+        assert pool.getconn('k') is connection
+        assert pool.in_use == 1
+        assert pool.peak_in_use == 1
+        assert self.tracer.finished_spans()[-1].tags['db.pool.in_use'] == 1
+        pool.putconn(connection, key='k')
+        assert pool.in_use == 0
+        assert pool.idle == 1
+
+    def test_checkout_counts_are_tagged_as_of_checkout(self):
+        pool = TracedConnectionPool(self.connect, self.tracer, maxconn=2)
+        first = pool.getconn()
+        start_span = self.tracer.start_span
+
+        def return_first(*args, **kwargs):
+            # Another thread returning its connection before the checkout span is tagged
+            if pool.in_use == 2:
+                pool.putconn(first)
+            return start_span(*args, **kwargs)
+
+        self.tracer.start_span = return_first
+        pool.getconn()
+        span = self.tracer.finished_spans()[-1]
+        assert span.tags['db.pool.in_use'] == 2
+        assert span.tags['db.pool.idle'] == 0
+        assert span.tags['db.pool.saturation'] == 1
+        assert pool.in_use == 1
+
+    @pytest.mark.parametrize('pooled', [False, True])
+    def test_unknown_connections_are_not_returned(self, pooled):
+        pool = TracedConnectionPool(MockPool() if pooled else self.connect, self.tracer)
+        connection = pool.getconn()
+        with pytest.raises(PoolError):
+            pool.putconn(MockConnection())
+        pool.putconn(connection)
+        with pytest.raises(PoolError):
+            pool.putconn(connection)
+        assert pool.in_use == 0
+        assert pool.idle == 1
+
+    def test_untraced_checkout(self):
+        pool = TracedConnectionPool(self.connect, self.tracer, trace_checkout=False)
+        with pool.getconn().cursor() as cursor:
+            cursor.execute('SELECT 1')
+        span, = self.tracer.finished_spans()
+        assert span.operation_name == 'MockDBAPICursor.execute(SELECT)'
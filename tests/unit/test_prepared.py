@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from decimal import Decimal
+from uuid import UUID
+
+from opentracing.mocktracer import MockTracer
+import pytest
+
+from dbapi_opentracing import AutoPrepare, PsycopgConnectionTracing
+from dbapi_opentracing.prepared import _parameter_type, _prepared_query
+from .test_psycopg2 import MockDBAPIConnection
+
+
+class PreparingError(Exception):
+    pass
+
+
+class PreparingConnection(MockDBAPIConnection):
+    Error = PreparingError
+    autocommit = False
+    transaction_status = 0
+
+    def __init__(self, *args, **kwargs):
+        self.executed = []
+        # Queries failing when executed
+        self.failing = set()
+
+    def get_transaction_status(self):
+        return self.transaction_status
+
+
+class PreparingCursor(object):
+    rowcount = 1
+
+    def __init__(self, conn, name=None):
+        self.connection = conn
+        self.name = name
+
+    def execute(self, query, args=None):
+        self.connection.executed.append((query, args))
+        if query in self.connection.failing:
+            raise PreparingError(query)
+
+    def close(self):
+        pass
+
+
+class TestPreparedQuery(object):
+
+    @pytest.mark.parametrize('query, parameters, expected', [
+        ('SELECT 1', None, ('SELECT 1', None)),
+        ('SELECT a FROM t WHERE b = %s AND c = %s', (1, 2), (u'SELECT a FROM t WHERE b = $1 AND c = $2', None)),
+        ('SELECT %(a)s, %(b)s, %(a)s', {'a': 1, 'b': 2}, (u'SELECT $1, $2, $1', ['a', 'b'])),
+        ("SELECT 'a%%', %s LIKE '100%%' -- 50%%", (1,), (u"SELECT 'a%', $1 LIKE '100%' -- 50%", None)),
+        ("SELECT $$%%$$, %s", (1,), (u'SELECT $$%$$, $1', None)),
+        ("SELECT 10 %% %s", (3,), (u'SELECT 10 % $1', None)),
+        ("SELECT '%s'", (1,), None),
+        ('SELECT %d', (1,), None),
+        ('SELECT %s, %(a)s', {'a': 1}, None),
+    ])
+    def test_placeholders_are_numbered(self, query, parameters, expected):
+        assert _prepared_query(query, parameters) == expected
+
+    @pytest.mark.parametrize('value, expected', [
+        (None, None),
+        (True, 'boolean'),
+        (u'ü', 'unknown'),
+        (1, 'bigint'),
+        (-2 ** 63, 'bigint'),
+        (2 ** 63, 'numeric'),
+        (1.5, 'numeric'),
+        (float('inf'), 'double precision'),
+        (float('nan'), 'double precision'),
+        (Decimal('1.5'), 'numeric'),
+        (datetime(2019, 1, 2), 'timestamp'),
+        (UUID(int=1), 'uuid'),
+        ([1], False),
+    ])
+    def test_parameter_types(self, value, expected):
+        assert _parameter_type(value) == expected
+
+
+class TestAutoPrepare(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+        self.auto_prepare = AutoPrepare(threshold=2, max_prepared=2)
+        self.connection = self.connect()
+
+    def connect(self):
+        return PsycopgConnectionTracing('dbname=test', connection_factory=PreparingConnection,
+                                        cursor_factory=PreparingCursor, tracer=self.tracer,
+                                        auto_prepare=self.auto_prepare)
+
+    def test_hot_statements_are_prepared(self):
+        cursor = self.connection.cursor()
+        for value in (1, 2, 3):
+            cursor.execute('SELECT a FROM t WHERE b = %s', (value,))
+        assert self.connection.executed == [
+            ('SELECT a FROM t WHERE b = %s', (1,)),
+            ('SAVEPOINT _dbapi_opentracing_prepare', None),
+            (u'PREPARE _dbapi_1 (bigint) AS SELECT a FROM t WHERE b = $1', None),
+            ('RELEASE SAVEPOINT _dbapi_opentracing_prepare', None),
+            (u'EXECUTE _dbapi_1 (%s)', (2,)),
+            (u'EXECUTE _dbapi_1 (%s)', (3,)),
+        ]
+        spans = self.tracer.finished_spans()
+        assert [span.tags['db.prepared'] for span in spans] == [False, True, True]
+        assert spans[1].operation_name == 'PreparingCursor.execute(SELECT)'
+        assert spans[1].tags['db.statement'] == 'SELECT a FROM t WHERE b = %s'
+
+    def test_executions_are_counted_across_connections(self):
+        self.connect().cursor().execute('SELECT %(a)s', {'a': 1})
+        self.connection.autocommit = True
+        self.connection.cursor().execute('SELECT %(a)s', {'a': 2})
+        assert self.connection.executed == [
+            (u'PREPARE _dbapi_1 (bigint) AS SELECT $1', None),
+            (u'EXECUTE _dbapi_1 (%(a)s)', {'a': 2}),
+        ]
+
+    def test_other_parameter_types_are_executed_unprepared(self):
+        cursor = self.connection.cursor()
+        self.connection.autocommit = True
+        for value in (1, 2, None, u'a'):
+            cursor.execute('SELECT %s', (value,))
+        assert [query for query, _ in self.connection.executed] == [
+            'SELECT %s', u'PREPARE _dbapi_1 (bigint) AS SELECT $1', u'EXECUTE _dbapi_1 (%s)',
+            u'EXECUTE _dbapi_1 (%s)', 'SELECT %s',
+        ]
+
+    def test_out_of_bigint_range_integers_are_executed_unprepared(self):
+        cursor = self.connection.cursor()
+        self.connection.autocommit = True
+        for value in (1, 2, 2 ** 70, float('inf')):
+            cursor.execute('SELECT %s + 1', (value,))
+        assert [query for query, _ in self.connection.executed] == [
+            'SELECT %s + 1', u'PREPARE _dbapi_1 (bigint) AS SELECT $1 + 1', u'EXECUTE _dbapi_1 (%s)', 'SELECT %s + 1',
+            'SELECT %s + 1',
+        ]
+
+    def test_null_parameters_delay_preparing(self):
+        cursor = self.connection.cursor()
+        self.connection.autocommit = True
+        for value in (None, None, 1):
+            cursor.execute('SELECT %s', (value,))
+        assert [query for query, _ in self.connection.executed] == [
+            'SELECT %s', 'SELECT %s', u'PREPARE _dbapi_1 (bigint) AS SELECT $1', u'EXECUTE _dbapi_1 (%s)',
+        ]
+
+    def test_failed_prepares_are_rolled_back_and_not_retried(self):
+        self.connection.failing.add(u'PREPARE _dbapi_1 (bigint) AS SELECT $1')
+        cursor = self.connection.cursor()
+        for value in (1, 2, 3):
+            cursor.execute('SELECT %s', (value,))
+        assert [query for query, _ in self.connection.executed] == [
+            'SELECT %s', 'SAVEPOINT _dbapi_opentracing_prepare', u'PREPARE _dbapi_1 (bigint) AS SELECT $1',
+            'ROLLBACK TO SAVEPOINT _dbapi_opentracing_prepare', 'RELEASE SAVEPOINT _dbapi_opentracing_prepare',
+            'SELECT %s', 'SELECT %s',
+        ]
+
+    def test_least_recently_executed_statements_are_deallocated(self):
+        cursor = self.connection.cursor()
+        self.connection.autocommit = True
+        for query in ('SELECT 1', 'SELECT 2', 'SELECT 3'):
+            cursor.execute(query)
+            cursor.execute(query)
+        assert [query for query, _ in self.connection.executed] == [
+            'SELECT 1', u'PREPARE _dbapi_1 AS SELECT 1', u'EXECUTE _dbapi_1',
+            'SELECT 2', u'PREPARE _dbapi_2 AS SELECT 2', u'EXECUTE _dbapi_2',
+            'SELECT 3', u'PREPARE _dbapi_3 AS SELECT 3', u'DEALLOCATE _dbapi_1', u'EXECUTE _dbapi_3',
+        ]
+
+    @pytest.mark.parametrize('query, parameters', [
+        ('CREATE TABLE t (a int)', None),
+        ('SELECT %s', ([1],)),
+        ("SELECT '%s'", (1,)),
+    ])
+    def test_unpreparable_statements_are_executed_as_is(self, query, parameters):
+        cursor = self.connection.cursor()
+        for _ in range(3):
+            cursor.execute(query, parameters)
+        assert self.connection.executed == [(query, parameters)] * 3
+
+    def test_failed_transactions_are_not_prepared(self):
+        self.connection.transaction_status = 3
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.execute('SELECT 1')
+        assert self.connection.executed == [('SELECT 1', None)] * 2
+
+    def test_named_cursors_are_not_prepared(self):
+        cursor = self.connection.cursor('named')
+        cursor.execute('SELECT 1')
+        cursor.execute('SELECT 1')
+        assert self.connection.executed == [('SELECT 1', None)] * 2
+        assert 'db.prepared' not in self.tracer.finished_spans()[0].tags
+
+    def test_threshold_is_validated(self):
+        with pytest.raises(ValueError):
+            AutoPrepare(threshold=0)
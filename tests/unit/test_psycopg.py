@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+
+from opentracing.mocktracer import MockTracer
+from opentracing.ext import tags
+import pytest
+
+from dbapi_opentracing import PsycopgConnectTracing, psycopg_tracing
+from .conftest import BaseSuite
+
+
+class SomeException(Exception):
+    pass
+
+
+class Result(object):
+
+    def __init__(self, query):
+        self.error = query.startswith('FAIL')
+        self.command_tuples = 2
+
+
+def run(gen):
+    try:
+        while True:
+            next(gen)
+    except StopIteration as stop:
+        return stop.value
+
+
+class FakeCursor(object):
+    """
+    psycopg (>= 3.2) like cursor, whose statements are queued in pipeline mode and whose results are then checked and
+    set by sync().
+    """
+
+    def __init__(self, connection, row_factory=None):
+        self._conn = connection
+        self.rowcount = -1
+        self.results = []
+
+    def _maybe_prepare_gen(self, query):
+        yield
+        if self._conn._pipeline is not None:
+            self._conn._pipeline.append((self, query))
+            return
+        results = [Result(query)]
+        self._check_results(results)
+        self._set_results(results)
+
+    def _check_results(self, results):
+        if results[0].error:
+            raise SomeException('failed')
+
+    def _set_results(self, results):
+        self.results.extend(results)
+        self.rowcount = results[0].command_tuples
+
+    def execute(self, query, params=None):
+        run(self._maybe_prepare_gen(query))
+        return self
+
+    def executemany(self, query, params_seq):
+        with self._conn.pipeline():
+            for _ in params_seq:
+                run(self._maybe_prepare_gen(query))
+
+    def fetchall(self):
+        return [(1,), (2,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self._pipeline = None
+        self.cursor_factory = FakeCursor
+        self.server_cursor_factory = FakeCursor
+        self.syncs = 0
+
+    @classmethod
+    def connect(cls, conninfo='', **kwargs):
+        connection = cls()
+        connection.conninfo = conninfo
+        connection.kwargs = kwargs
+        return connection
+
+    def cursor(self, name='', row_factory=None):
+        return (self.server_cursor_factory if name else self.cursor_factory)(self, row_factory=row_factory)
+
+    def execute(self, query, params=None):
+        return self.cursor().execute(query, params)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    @contextmanager
+    def pipeline(self):
+        if self._pipeline is not None:
+            yield self
+            return
+        self._pipeline = []
+        try:
+            yield self
+            self.sync()
+        finally:
+            self._pipeline = None
+
+    def sync(self):
+        self.syncs += 1
+        queued, self._pipeline[:] = list(self._pipeline), []
+        error = None
+        for cursor, query in queued:
+            results = [Result(query)]
+            try:
+                cursor._check_results(results)
+                cursor._set_results(results)
+            except SomeException as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        if exc:
+            self.rollback()
+        else:
+            self.commit()
+
+
+class TestPsycopgConnectTracing(BaseSuite):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+
+    def connect(self, **kwargs):
+        return PsycopgConnectTracing('dbname=test', connection_factory=FakeConnection, tracer=self.tracer,
+                                     span_tags=dict(one=1), **kwargs)
+
+    def test_connection_is_traced_subclass(self):
+        connection = self.connect(autocommit=True)
+        assert isinstance(connection, FakeConnection)
+        assert connection.conninfo == 'dbname=test'
+        assert connection.kwargs == dict(autocommit=True)
+        with connection as entered:
+            assert entered is connection
+            connection.execute('SELECT * FROM some_table')
+
+        execute, commit = self.tracer.finished_spans()
+        self.assert_base_tags([execute, commit])
+        assert execute.operation_name == 'FakeCursor.execute(SELECT)'
+        assert execute.tags['db.rows_produced'] == 2
+        assert execute.tags['one'] == 1
+        assert commit.operation_name == 'FakeConnection.commit()'
+
+    def test_cursor_factories_are_traced_subclasses(self):
+        connection = self.connect()
+        connection.cursor_factory = type('OtherCursor', (FakeCursor,), {})
+        cursor = connection.cursor()
+        assert cursor.__class__.__name__ == 'OtherCursor'
+        assert 'callproc' not in cursor.__class__.__dict__
+
+        untraced = connection.cursor(trace_execute=False)
+        assert 'execute' not in untraced.__class__.__dict__
+        untraced.execute('SELECT 1')
+        assert not self.tracer.finished_spans()
+
+    def test_pipelined_statements_are_finished_on_results(self):
+        connection = self.connect()
+        with connection.pipeline():
+            first, second = connection.cursor(), connection.cursor()
+            first.execute('SELECT * FROM some_table')
+            second.execute('INSERT INTO some_table VALUES (1)')
+            first.execute('SELECT 2')
+            assert not self.tracer.finished_spans()
+            connection.sync()
+            assert len(self.tracer.finished_spans()) == 3
+            second.executemany('INSERT INTO some_table VALUES (%s)', [(1,), (2,), (3,)])
+
+        select, insert, select_2, executemany, pipeline = self.tracer.finished_spans()
+        assert pipeline.operation_name == 'FakeConnection.pipeline()'
+        assert pipeline.tags['one'] == 1
+        assert pipeline.tags['db.pipeline.statements'] == 6
+        assert pipeline.tags['db.pipeline.round_trips'] == 2
+        assert pipeline.tags['db.pipeline.round_trips_saved'] == 4
+        assert [span.operation_name for span in (select, insert, select_2)] == [
+            'FakeCursor.execute(SELECT)', 'FakeCursor.execute(INSERT)', 'FakeCursor.execute(SELECT)'
+        ]
+        assert all(span.parent_id == pipeline.context.span_id for span in (select, insert, select_2, executemany))
+        assert executemany.tags['db.batch.size'] == 3
+        assert executemany.tags['db.rows_produced'] == 6
+        assert connection.syncs == 2
+
+    def test_pipelined_errors_are_tagged(self):
+        connection = self.connect()
+        with pytest.raises(SomeException):
+            with connection.pipeline():
+                cursor = connection.cursor()
+                cursor.execute('SELECT 1')
+                cursor.execute('FAIL')
+
+        select, fail, pipeline = self.tracer.finished_spans()
+        assert tags.ERROR not in select.tags
+        assert fail.tags[tags.ERROR] is True
+        assert fail.tags['sfx.error.kind'] == 'SomeException'
+        assert pipeline.tags[tags.ERROR] is True
+
+    def test_executemany_pipeline_is_traced_under_execution(self):
+        connection = self.connect()
+        connection.cursor().executemany('INSERT INTO some_table VALUES (%s)', [(1,), (2,)])
+        pipeline, executemany = self.tracer.finished_spans()
+        assert pipeline.parent_id == executemany.context.span_id
+        assert pipeline.tags['db.pipeline.statements'] == 2
+        assert pipeline.tags['db.pipeline.round_trips'] == 1
+        assert executemany.tags['db.batch.size'] == 2
+
+    def test_nested_pipelines_are_not_traced(self):
+        connection = self.connect()
+        with connection.pipeline():
+            with connection.pipeline():
+                connection.execute('SELECT 1')
+        execute, pipeline = self.tracer.finished_spans()
+        assert pipeline.tags['db.pipeline.statements'] == 1
+
+    def test_unreceived_pipelined_statements_are_finished_on_exit(self):
+        connection = self.connect()
+        with connection.pipeline():
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            # Results lost with the connection
+            connection._pipeline[:] = []
+        select, pipeline = self.tracer.finished_spans()
+        assert 'db.rows_produced' not in select.tags
+        assert not cursor._self_pipelined
+        connection.execute('SELECT 2')
+        assert self.tracer.finished_spans()[-1].tags['db.rows_produced'] == 2
+
+    def test_unsupported_pipeline_versions_are_traced_without_statements(self, monkeypatch):
+        monkeypatch.setattr(psycopg_tracing, '_PSYCOPG_VERSION', (3, 99))
+        connection = self.connect()
+        with connection.pipeline():
+            connection.execute('SELECT 1')
+        execute, pipeline = self.tracer.finished_spans()
+        assert execute.parent_id == pipeline.context.span_id
+        assert 'db.pipeline.statements' not in pipeline.tags
+
+    def test_unsupported_versions_are_refused(self, monkeypatch):
+        monkeypatch.setattr(psycopg_tracing, '_PSYCOPG_VERSION', (3, 0))
+        with pytest.raises(RuntimeError):
+            self.connect()
+
+    def test_installed_psycopg_has_traced_internals(self):
+        psycopg = pytest.importorskip('psycopg')
+        if not psycopg_tracing._pipeline_tracing():
+            pytest.skip('Unsupported psycopg version')
+        assert callable(psycopg.Cursor._maybe_prepare_gen)
+        assert callable(psycopg.Cursor._check_results)
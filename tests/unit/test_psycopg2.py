@@ -1,15 +1,23 @@
 # -*- coding: utf-8 -*-
 #  Copyright (C) 2018-2019 SignalFx, Inc. All rights reserved.
 
+import gc
 import types
+import weakref
 
 from opentracing.mocktracer import MockTracer
 from opentracing.ext import tags
+from psycopg2 import sql
+from psycopg2.extensions import cursor as PsycopgCursor
+from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE
+import opentracing
 import pytest
 from mock import Mock, patch
 
 
-from dbapi_opentracing.psycopg2_tracing import PsycopgConnectionTracing
+from dbapi_opentracing import AutoPrepare
+from dbapi_opentracing.psycopg2_tracing import (PsycopgConnectionTracing, _connection_factory_classes,
+                                                _cursor_factory_classes)
 from .conftest import BaseSuite
 
 row_count = 'SomeRowCount'
@@ -41,6 +49,38 @@ class MockDBAPICursor(object):
         return self
 
 
+class RowsCursor(MockDBAPICursor):
+    rows = [(1,), (2,), (3,)]
+    itersize = 2
+
+    def __init__(self, conn, name=None):
+        self.name = name
+        self.remaining = list(self.rows)
+        self.fetches = 0
+
+    def fetchone(self):
+        return self.remaining.pop(0) if self.remaining else None
+
+    def fetchmany(self, size):
+        self.fetches += 1
+        rows, self.remaining = self.remaining[:size], self.remaining[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.remaining = self.remaining, []
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.remaining:
+            raise StopIteration
+        return self.remaining.pop(0)
+
+    next = __next__  # py2
+
+
 class MockDBAPIConnection(object):
     commit = Mock(spec=types.MethodType)
     commit.__name__ = 'commit'
@@ -319,3 +359,251 @@ class TestPsycopgConnectionTracing(object):
             assert span.tags[tags.SPAN_KIND] == tags.SPAN_KIND_RPC_CLIENT
             assert span.tags['one'] == 123
             assert span.tags['two'] == 234
+
+    def test_repeated_statements_use_cached_templates(self):
+        tracer = MockTracer()
+        connection = PsycopgConnectionTracing('dbname=test', tracer=tracer, span_template_cache_size=4,
+                                              connection_factory=MockDBAPIConnection, cursor_factory=MockDBAPICursor)
+        statement = b'SELECT * FROM some_table'
+        with connection.cursor() as cursor:
+            cursor.execute(statement)
+            cursor.execute(statement)
+
+        cache = connection.span_template_cache
+        assert cache.maxsize == 4
+        assert cache.misses == 1
+        assert cache.hits == 1
+
+        spans = tracer.finished_spans()
+        assert len(spans) == 2
+        for span in spans:
+            assert span.operation_name == 'MockDBAPICursor.execute(SELECT)'
+            assert span.tags[tags.DATABASE_STATEMENT] == statement.decode()
+
+    def test_normalized_statements(self):
+        tracer = MockTracer()
+        connection = PsycopgConnectionTracing('dbname=test', tracer=tracer, statement_mode='normalized',
+                                              connection_factory=MockDBAPIConnection, cursor_factory=MockDBAPICursor)
+        with connection.cursor() as cursor:
+            cursor.execute(b'SELECT * FROM some_table WHERE id = 123')
+        span = tracer.finished_spans().pop()
+        assert span.tags[tags.DATABASE_STATEMENT] == 'SELECT * FROM some_table WHERE id = ?'
+        assert len(span.tags['db.sql.fingerprint']) == 16
+
+    def test_composed_statements_are_truncated(self):
+        tracer = MockTracer()
+        connection = PsycopgConnectionTracing('dbname=test', tracer=tracer, max_statement_length=12,
+                                              connection_factory=MockDBAPIConnection, cursor_factory=MockDBAPICursor)
+        query = sql.SQL(' ').join([sql.SQL('SELECT *'), sql.SQL('FROM'), sql.SQL('some_table'), sql.SQL('WHERE a = 1')])
+        with patch.object(sql.SQL, 'as_string', autospec=True, side_effect=lambda self, conn: self.string) as as_string:
+            with connection.cursor() as cursor:
+                cursor.connection = connection
+                cursor.execute(query)
+                cursor.execute(sql.SQL('SELECT 1'))
+        # Rendering stops once the limit is exceeded
+        assert as_string.call_count == 4
+
+        composed, short = tracer.finished_spans()
+        assert composed.operation_name == 'MockDBAPICursor.execute(SELECT)'
+        assert composed.tags[tags.DATABASE_STATEMENT] == 'SELECT * FRO'
+        assert composed.tags['db.statement.truncated'] is True
+        assert composed.tags['db.sql.table'] == 'some_table'
+        assert short.tags[tags.DATABASE_STATEMENT] == 'SELECT 1'
+        assert 'db.statement.truncated' not in short.tags
+
+    def test_fetch_is_traced(self):
+        tracer = MockTracer()
+        connection = PsycopgConnectionTracing('dbname=test', tracer=tracer, trace_fetch=True,
+                                              connection_factory=MockDBAPIConnection, cursor_factory=RowsCursor)
+        cursor = connection.cursor()
+        cursor.execute('SELECT * FROM some_table')
+        assert list(cursor) == [(1,), (2,), (3,)]
+        cursor = connection.cursor()
+        cursor.execute('SELECT * FROM some_table')
+        assert cursor.fetchone() == (1,)
+        assert cursor.fetchall() == [(2,), (3,)]
+
+        spans = tracer.finished_spans()
+        assert [span.operation_name for span in spans] == ['RowsCursor.execute(SELECT)', 'RowsCursor.fetch(SELECT)'] * 2
+        assert [span.tags['db.fetch.rows'] for span in spans[1::2]] == [3, 3]
+
+    def test_named_cursor_round_trips_are_traced(self):
+        tracer = MockTracer()
+        connection = PsycopgConnectionTracing('dbname=test', tracer=tracer, trace_fetch=True,
+                                              connection_factory=MockDBAPIConnection, cursor_factory=RowsCursor)
+        cursor = connection.cursor('streaming')
+        cursor.execute('SELECT * FROM some_table')
+        assert list(cursor) == [(1,), (2,), (3,)]
+        # Rows are fetched by itersize, until an empty round trip
+        assert cursor.fetches == 3
+
+        execute, fetch = tracer.finished_spans()
+        assert fetch.operation_name == 'RowsCursor.fetch(SELECT)'
+        assert fetch.parent_id == execute.context.span_id
+        assert fetch.tags['db.fetch.rows'] == 3
+        assert fetch.tags['db.fetch.itersize'] == 2
+        assert fetch.tags['db.fetch.round_trips'] == 3
+        assert fetch.tags['db.fetch.rows_per_round_trip'] == 1
+        assert fetch.tags['db.fetch.round_trip_latency.le_1ms'] == 3
+
+    def test_named_cursor_fetch_calls_are_round_trips(self):
+        tracer = MockTracer()
+        connection = PsycopgConnectionTracing('dbname=test', tracer=tracer, trace_fetch=True,
+                                              connection_factory=MockDBAPIConnection, cursor_factory=RowsCursor)
+        cursor = connection.cursor('streaming')
+        cursor.execute('SELECT * FROM some_table')
+        assert cursor.fetchone() == (1,)
+        assert cursor.fetchall() == [(2,), (3,)]
+
+        fetch = tracer.finished_spans().pop()
+        assert fetch.tags['db.fetch.rows'] == 3
+        assert fetch.tags['db.fetch.round_trips'] == 2
+        assert fetch.tags['db.fetch.rows_per_round_trip'] == 1.5
+
+
+class AsyncConnection(MockDBAPIConnection):
+    """Asynchronous connection whose poll() returns its scripted states, or raises them if exceptions."""
+    states = ()
+
+    def __init__(self, dsn, async_=False, **kwargs):
+        self.states = list(self.states)
+
+    def poll(self):
+        state = self.states.pop(0)
+        if isinstance(state, Exception):
+            raise state
+        return state
+
+
+class AsyncCursor(MockDBAPICursor):
+
+    def __init__(self, conn, name=None):
+        self.connection = conn
+
+
+class TestAsyncConnectionPolling(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+
+    def connect(self, states, **kwargs):
+        connection = PsycopgConnectionTracing('dbname=test', 1, tracer=self.tracer,
+                                              connection_factory=AsyncConnection, cursor_factory=AsyncCursor, **kwargs)
+        connection.states = list(states)
+        return connection
+
+    def test_noop_tracer_connections_remain_asynchronous(self):
+        connection = PsycopgConnectionTracing('dbname=test', 1, tracer=opentracing.Tracer(),
+                                              connection_factory=AsyncConnection, cursor_factory=AsyncCursor,
+                                              auto_prepare=AutoPrepare())
+        assert connection._is_async
+        assert connection._prepared_statements is None
+
+    def test_execution_span_is_finished_at_poll_ok(self):
+        connection = self.connect([POLL_WRITE, POLL_READ, POLL_READ, POLL_OK])
+        cursor = connection.cursor()
+        cursor.execute('SELECT * FROM some_table')
+        assert not self.tracer.finished_spans()
+        while connection.poll() != POLL_OK:
+            assert not self.tracer.finished_spans()
+
+        span, = self.tracer.finished_spans()
+        assert span.operation_name == 'AsyncCursor.execute(SELECT)'
+        assert span.tags[tags.DATABASE_STATEMENT] == 'SELECT * FROM some_table'
+        assert span.tags['db.rows_produced'] == row_count
+        assert span.tags['db.poll.count'] == 4
+        assert span.tags['db.poll.read'] == 2
+        assert span.tags['db.poll.write'] == 1
+        assert span.tags['db.poll.wait_time'] >= 0
+        assert span.tags['db.poll.processing_time'] >= 0
+        assert connection._polled_execution is None
+
+    def test_poll_errors_are_tagged(self):
+        connection = self.connect([POLL_READ, SomeException('failed')])
+        connection.cursor().execute('SELECT 1')
+        assert connection.poll() == POLL_READ
+        with pytest.raises(SomeException):
+            connection.poll()
+
+        span, = self.tracer.finished_spans()
+        assert span.tags[tags.ERROR] is True
+        assert span.tags['sfx.error.kind'] == 'SomeException'
+        assert span.tags['db.poll.count'] == 2
+        assert 'db.rows_produced' not in span.tags
+
+    def test_polls_without_execution_are_untraced(self):
+        connection = self.connect([POLL_OK])
+        assert connection.poll() == POLL_OK
+        assert not self.tracer.finished_spans()
+
+    def test_synchronous_connections_do_not_override_poll(self):
+        connection = PsycopgConnectionTracing('dbname=test', connection_factory=AsyncConnection,
+                                              cursor_factory=AsyncCursor)
+        assert 'poll' not in connection.__class__.__dict__
+        assert '_traced_execution' not in connection.cursor().__class__.__dict__
+        assert 'poll' in self.connect([]).__class__.__dict__
+
+
+class TestSpecializedFactoryClasses(object):
+
+    def test_only_enabled_methods_are_defined(self):
+        connection = PsycopgConnectionTracing('dbname=test', connection_factory=MockDBAPIConnection,
+                                              cursor_factory=MockDBAPICursor, tracer=MockTracer(), trace_commit=False)
+        assert 'commit' not in connection.__class__.__dict__
+        assert 'rollback' in connection.__class__.__dict__
+
+        cursor = connection.cursor(trace_execute=False)
+        assert 'execute' not in cursor.__class__.__dict__
+        assert cursor.__class__.execute is MockDBAPICursor.execute
+        assert 'executemany' in cursor.__class__.__dict__
+        assert 'fetchone' not in cursor.__class__.__dict__
+        assert 'fetchone' in connection.cursor(trace_fetch=True).__class__.__dict__
+        assert connection.cursor().__class__ is not cursor.__class__
+        assert connection.cursor(trace_execute=False).__class__ is cursor.__class__
+
+
+class TestFactoryClassCache(object):
+
+    def connect(self):
+        connection = PsycopgConnectionTracing('dbname=test', connection_factory=MockDBAPIConnection,
+                                              cursor_factory=MockDBAPICursor)
+        return connection, connection.cursor()
+
+    def test_repeated_connections_define_no_classes(self):
+        connection, cursor = self.connect()
+        definitions = _connection_factory_classes.definitions, _cursor_factory_classes.definitions
+        for _ in range(3):
+            other_connection, other_cursor = self.connect()
+            assert other_connection.__class__ is connection.__class__
+            assert other_cursor.__class__ is cursor.__class__
+        assert (_connection_factory_classes.definitions, _cursor_factory_classes.definitions) == definitions
+
+    def test_classes_outlive_their_instances(self):
+        connection, cursor = self.connect()
+        connection_class, cursor_class = weakref.ref(connection.__class__), weakref.ref(cursor.__class__)
+        definitions = _connection_factory_classes.definitions, _cursor_factory_classes.definitions
+        del connection, cursor
+        gc.collect()
+        connection, cursor = self.connect()
+        assert (_connection_factory_classes.definitions, _cursor_factory_classes.definitions) == definitions
+        assert connection.__class__ is connection_class()
+        assert cursor.__class__ is cursor_class()
+
+    def test_extension_types_are_cached(self):
+        flags = (True, True, True, False, False)
+        traced = _cursor_factory_classes.get(PsycopgCursor, flags)
+        assert issubclass(traced, PsycopgCursor)
+        assert _cursor_factory_classes.get(PsycopgCursor, flags) is traced
+        assert _cursor_factory_classes._classes[PsycopgCursor][flags] is traced
+
+    def test_discarded_factories_are_not_retained(self):
+        class DiscardedCursor(MockDBAPICursor):
+            pass
+
+        flags = (True, True, True, True, False)
+        assert issubclass(_cursor_factory_classes.get(DiscardedCursor, flags), DiscardedCursor)
+        factory = weakref.ref(DiscardedCursor)
+        del DiscardedCursor
+        gc.collect()
+        assert factory() is None
@@ -0,0 +1,127 @@
+from mock import Mock, patch
+from opentracing.mocktracer import MockTracer
+from opentracing.ext import tags
+from psycopg2.sql import SQL
+import psycopg2.extras
+import pytest
+
+from dbapi_opentracing import PsycopgConnectionTracing
+from dbapi_opentracing.psycopg2_extras import execute_batch, execute_values
+from .test_psycopg2 import MockDBAPIConnection
+
+
+class EncodedConnection(MockDBAPIConnection):
+    encoding = 'UTF8'
+
+
+class MogrifyingCursor(object):
+    rowcount = 1
+
+    def __init__(self, conn, name=None):
+        self.connection = conn
+        self.name = name
+        self.executed = []
+
+    def mogrify(self, query, args):
+        if isinstance(query, bytes):
+            query = query.decode('utf8')
+        return (query % tuple(repr(arg) for arg in args)).encode('utf8')
+
+    def execute(self, query, args=None):
+        self.executed.append(query)
+
+    def fetchall(self):
+        return [(len(self.executed),)]
+
+    def close(self):
+        pass
+
+
+class TestPsycopg2Extras(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+        self.connection = PsycopgConnectionTracing('dbname=test', connection_factory=EncodedConnection,
+                                                   cursor_factory=MogrifyingCursor, tracer=self.tracer,
+                                                   trace_fetch=True)
+
+    def test_execute_values_is_a_single_span(self):
+        cursor = self.connection.cursor()
+        statement = 'INSERT INTO t (a, b) VALUES %s'
+        execute_values(cursor, statement, [(1, 2), (3, 4), (5, 6)], page_size=2)
+        assert cursor.executed == [b'INSERT INTO t (a, b) VALUES (1,2),(3,4)', b'INSERT INTO t (a, b) VALUES (5,6)']
+
+        span, = self.tracer.finished_spans()
+        assert span.operation_name == 'MogrifyingCursor.execute_values(INSERT)'
+        assert span.tags[tags.DATABASE_STATEMENT] == statement
+        assert span.tags['db.batch.size'] == 3
+        assert span.tags['db.batch.page_size'] == 2
+        assert span.tags['db.batch.pages'] == 2
+        assert span.tags['db.rows_produced'] == 2
+        assert 0 < span.tags['db.batch.page_latency.mean'] <= span.tags['db.batch.page_latency.max']
+
+    def test_execute_values_results_are_fetched_untraced(self):
+        cursor = self.connection.cursor()
+        rows = execute_values(cursor, SQL('INSERT INTO {} VALUES %s RETURNING 1').format(SQL('t')),
+                              ((i,) for i in range(3)), template='(%s)', page_size=2, fetch=True)
+        assert rows == [(1,), (2,)]
+        assert cursor.executed == [b'INSERT INTO t VALUES (0),(1) RETURNING 1', b'INSERT INTO t VALUES (2) RETURNING 1']
+        cursor.fetchall()
+
+        span, = self.tracer.finished_spans()
+        assert span.operation_name == 'MogrifyingCursor.execute_values(INSERT)'
+        assert span.tags['db.batch.size'] == 3
+        assert span.tags['db.batch.pages'] == 2
+
+    def test_execute_values_without_fetch_argument(self):
+        # psycopg2 2.7 execute_values() signature
+        def execute_values_27(cur, sql, argslist, template=None, page_size=100):
+            return original(cur, sql, argslist, template=template, page_size=page_size)
+
+        original = psycopg2.extras.execute_values
+        cursor = self.connection.cursor()
+        with patch.object(psycopg2.extras, 'execute_values', execute_values_27):
+            execute_values(cursor, 'INSERT INTO t VALUES %s', [(1,), (2,)])
+        assert cursor.executed == [b'INSERT INTO t VALUES (1),(2)']
+        span, = self.tracer.finished_spans()
+        assert span.tags['db.batch.size'] == 2
+
+    def test_execute_batch_is_a_single_span(self):
+        cursor = self.connection.cursor()
+        execute_batch(cursor, 'UPDATE t SET a = %s', [(1,), (2,), (3,)])
+        assert cursor.executed == [b'UPDATE t SET a = 1;UPDATE t SET a = 2;UPDATE t SET a = 3']
+
+        span, = self.tracer.finished_spans()
+        assert span.operation_name == 'MogrifyingCursor.execute_batch(UPDATE)'
+        assert span.tags['db.batch.size'] == 3
+        assert span.tags['db.batch.page_size'] == 100
+        assert span.tags['db.batch.pages'] == 1
+
+    def test_failed_pages_are_tagged(self):
+        cursor = self.connection.cursor()
+        cursor._cursor_factory = type('FailingCursor', (MogrifyingCursor,), {
+            'execute': Mock(side_effect=[None, ValueError('failed')])
+        })
+        with pytest.raises(ValueError):
+            execute_batch(cursor, 'UPDATE t SET a = %s', [(1,), (2,), (3,)], page_size=1)
+
+        span, = self.tracer.finished_spans()
+        assert span.tags['error'] is True
+        assert span.tags['db.batch.pages'] == 2
+
+    def test_invalid_argument_lists_raise_their_error(self):
+        cursor = self.connection.cursor()
+        with pytest.raises(TypeError, match='not iterable'):
+            execute_values(cursor, 'INSERT INTO t VALUES %s', 5)
+
+        span, = self.tracer.finished_spans()
+        assert span.tags['error'] is True
+        assert span.tags['sfx.error.kind'] == 'TypeError'
+        assert span.tags['db.batch.pages'] == 0
+
+    def test_untraced_cursors_use_psycopg2_extras(self):
+        cursor = self.connection.cursor(trace_execute=False)
+        execute_values(cursor, 'INSERT INTO t VALUES %s', [(1,), (2,)], page_size=1)
+        assert cursor.executed == [b'INSERT INTO t VALUES (1)', b'INSERT INTO t VALUES (2)']
+        assert not self.tracer.finished_spans()
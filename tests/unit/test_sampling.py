@@ -0,0 +1,103 @@
+# Copyright (C) 2019 SignalFx, Inc. All rights reserved.
+from mock import patch
+from opentracing.mocktracer import MockTracer
+
+from dbapi_opentracing import ConnectionTracing, TokenBucketSampler, verb_table_key
+from dbapi_opentracing.sql import normalize_statement
+from .test_tracing import MockDBAPIConnection, MockDBAPICursor
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucketSampler(object):
+
+    def test_rate_is_limited_per_fingerprint(self):
+        clock = Clock()
+        sampler = TokenBucketSampler(rate=2, clock=clock)
+        assert [sampler.sample('one') for _ in range(4)] == [0, 0, None, None]
+        assert sampler.sample('two') == 0
+
+        clock.now = 0.5
+        assert sampler.sample('one') == 2
+        assert sampler.sample('one') is None
+        clock.now = 1.0
+        assert sampler.sample('one') == 1
+
+    def test_global_rate_is_limited(self):
+        clock = Clock()
+        sampler = TokenBucketSampler(rate=10, global_rate=2, clock=clock)
+        assert sampler.sample('one') == 0
+        assert sampler.sample('two') == 0
+        assert sampler.sample('three') is None
+        assert sampler.sample('one') is None
+
+        clock.now = 1.0
+        assert sampler.sample('three') == 1
+        assert sampler.sample('one') == 1
+
+
+class TestSampledConnectionTracing(object):
+
+    def test_unsampled_executions_are_not_traced(self):
+        tracer = MockTracer()
+        clock = Clock()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer,
+                                       sampler=TokenBucketSampler(rate=1, clock=clock))
+        MockDBAPICursor.execute.reset_mock()
+        with connection.cursor() as cursor:
+            for i in range(5):
+                cursor.execute('SELECT * FROM some_table WHERE id = {}'.format(i))
+            cursor.execute('SELECT * FROM other_table')
+            clock.now = 1.0
+            cursor.execute('SELECT * FROM some_table WHERE id = 5')
+
+        assert MockDBAPICursor.execute.call_count == 7
+        first, other, second = tracer.finished_spans()
+        assert 'db.sampler.dropped' not in first.tags
+        assert 'db.sampler.dropped' not in other.tags
+        assert second.tags['db.sampler.dropped'] == 4
+        assert second.tags['db.statement'] == 'SELECT * FROM some_table WHERE id = 5'
+
+    def test_dropped_executions_are_not_normalized(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer, statement_mode='normalized',
+                                       sampler=TokenBucketSampler(rate=1, clock=Clock()))
+        with patch('dbapi_opentracing.tracing.normalize_statement', wraps=normalize_statement) as normalize:
+            with connection.cursor() as cursor:
+                for i in range(3):
+                    cursor.execute('UPDATE some_table SET a = {}'.format(i))
+        assert normalize.call_count == 1
+        span, = tracer.finished_spans()
+        assert span.tags['db.statement'] == 'UPDATE some_table SET a = ?'
+
+    def test_statements_on_a_table_are_sampled_per_fingerprint(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer,
+                                       sampler=TokenBucketSampler(rate=1, clock=Clock()))
+        with connection.cursor() as cursor:
+            for _ in range(2):
+                cursor.execute('SELECT a FROM some_table WHERE id = 1')
+            cursor.execute('SELECT b FROM some_table')
+            cursor.execute('UPDATE some_table SET a = 1')
+        assert [span.tags['db.statement'] for span in tracer.finished_spans()] == [
+            'SELECT a FROM some_table WHERE id = 1', 'SELECT b FROM some_table', 'UPDATE some_table SET a = 1'
+        ]
+
+    def test_verb_table_key_groups_statements(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer,
+                                       sampler=TokenBucketSampler(rate=1, clock=Clock(), key=verb_table_key))
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT a FROM some_table WHERE id = 1')
+            cursor.execute('SELECT b FROM some_table')
+            cursor.execute('UPDATE some_table SET a = 1')
+        assert [span.tags['db.statement'] for span in tracer.finished_spans()] == [
+            'SELECT a FROM some_table WHERE id = 1', 'UPDATE some_table SET a = 1'
+        ]
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2019 SignalFx, Inc. All rights reserved.
+from psycopg2 import sql
+import pytest
+
+from dbapi_opentracing.sql import SQLStatement, normalize_statement, parse_statement
+
+
+class TestParseStatement(object):
+
+    @pytest.mark.parametrize('query, expected', [
+        ('SELECT * FROM some_table', ('SELECT', 'some_table')),
+        ('select a, b from public.some_table where c = 1', ('SELECT', 'public.some_table')),
+        ('\n\t  SELECT 1', ('SELECT', None)),
+        ('-- leading comment\nSELECT * FROM "Quoted ""Table"""', ('SELECT', 'Quoted "Table"')),
+        ('/* outer /* nested */ comment */ DELETE FROM `some_table`', ('DELETE', 'some_table')),
+        ('(SELECT 1 FROM one) UNION (SELECT 2 FROM two)', ('SELECT', 'one')),
+        ("SELECT 'FROM not_a_table', extract(year FROM ts) FROM events", ('SELECT', 'events')),
+        ('SELECT * FROM (SELECT * FROM inner_table) AS sub', ('SELECT', None)),
+        ('INSERT INTO some_table VALUES (%s, %s)', ('INSERT', 'some_table')),
+        ('INSERT IGNORE INTO some_table VALUES (%s)', ('INSERT', 'some_table')),
+        ('UPDATE ONLY some_table SET a = 1', ('UPDATE', 'some_table')),
+        ('DELETE FROM ONLY some_table WHERE a = 1', ('DELETE', 'some_table')),
+        ('SELECT * FROM only some_table', ('SELECT', 'some_table')),
+        ('CREATE TEMPORARY TABLE IF NOT EXISTS some_table (a int)', ('CREATE', 'some_table')),
+        ('DROP TABLE some_table', ('DROP', 'some_table')),
+        ('DROP DB', ('DROP', None)),
+        ('TRUNCATE TABLE some_table', ('TRUNCATE', 'some_table')),
+        ('COPY some_table FROM STDIN', ('COPY', 'some_table')),
+        ('WITH cte AS (SELECT * FROM one) SELECT * FROM cte', ('SELECT', 'cte')),
+        ('WITH RECURSIVE a(x) AS (SELECT 1), b AS NOT MATERIALIZED (SELECT 2) '
+         'INSERT INTO target SELECT * FROM a', ('INSERT', 'target')),
+        ('WITH unterminated AS (SELECT', ('WITH', None)),
+        (r"SELECT $1::int, $$x$$, E'\'' FROM t", ('SELECT', 't')),
+        (r"SELECT e'it\'s FROM a', N'FROM b' FROM t", ('SELECT', 't')),
+        ("SELECT $fn$ 'FROM a $ $fn $fn$, $$$$ FROM t WHERE a = $2", ('SELECT', 't')),
+        ("SELECT $$unterminated FROM t", ('SELECT', None)),
+        ('', ('', None)),
+        ('   ', ('', None)),
+        (None, ('', None)),
+    ])
+    def test_statements(self, query, expected):
+        assert parse_statement(query)[:2] == expected
+
+    def test_keywords_are_named_as_written(self):
+        assert parse_statement('with cte AS (SELECT 1) insert INTO t SELECT * FROM cte') == SQLStatement(
+            'INSERT', 't', 'insert'
+        )
+        assert parse_statement('Select 1') == ('SELECT', None, 'Select')
+
+    def test_bytes(self):
+        assert parse_statement(b'  select * from t\xc3\xa4ble') == (u'SELECT', u't\xe4ble', u'select')
+        assert parse_statement(b'\x80 SELECT 1') == ('', None, '')
+
+    def test_bytes_beyond_scan_length_are_not_decoded(self):
+        query = b'SELECT ' + b'a, ' * 10000 + b'\xff' * 10 ** 6 + b' FROM some_table'
+        assert parse_statement(query) == ('SELECT', None, 'SELECT')
+
+    def test_composed(self):
+        query = sql.SQL('SELECT {} FROM {} WHERE a = {}').format(
+            sql.Identifier('column'), sql.Identifier('some_table'), sql.Literal('FROM')
+        )
+        assert parse_statement(query) == ('SELECT', 'some_table', 'SELECT')
+        assert parse_statement(sql.Composed([])) == ('', None, '')
+
+    def test_results_are_memoized(self):
+        query = 'SELECT * FROM memoized_table'
+        assert parse_statement(query) is parse_statement(query)
+
+
+class TestNormalizeStatement(object):
+
+    @pytest.mark.parametrize('query, expected', [
+        ("SELECT * FROM t WHERE a = 1 AND b = 'it''s' AND c = -2.5e3",
+         'SELECT * FROM t WHERE a = ? AND b = ? AND c = ?'),
+        (r"SELECT * FROM t WHERE name = 'O\'Brien' AND id = 5 AND c = E'\\' AND d = e'it\'s'",
+         'SELECT * FROM t WHERE name = ? AND id = ? AND c = ? AND d = ?'),
+        ('SELECT a - 1, a-1 FROM t WHERE id IN (-1, -2, +3) AND b >-4',
+         'SELECT a - ?, a-? FROM t WHERE id IN (...) AND b >?'),
+        ('INSERT INTO t VALUES (-1, %s), (2, %s)', 'INSERT INTO t VALUES (?, %s)'),
+        ('SELECT "col 1", t2.c3, $1 FROM t WHERE id IN (1, 2, 3)',
+         'SELECT "col 1", t2.c3, $1 FROM t WHERE id IN (...)'),
+        ('SELECT * FROM t WHERE id in (%s,%s, %(name)s)', 'SELECT * FROM t WHERE id IN (...)'),
+        ('INSERT INTO t VALUES (1, %s), (2, %s),(3, %s)', 'INSERT INTO t VALUES (?, %s)'),
+        ("SELECT $$body$$, $tag$it's$tag$, E'x', 0x1F -- comment\n /* block */  FROM t", 'SELECT ?, ?, ?, ? FROM t'),
+        (b'SELECT 1', 'SELECT ?'),
+    ])
+    def test_literals_are_replaced(self, query, expected):
+        assert normalize_statement(query).text == expected
+
+    def test_fingerprint_is_stable_and_literal_independent(self):
+        one = normalize_statement("SELECT * FROM t WHERE a = 1 AND b IN ('x')")
+        two = normalize_statement("SELECT  *  FROM t\nWHERE a = 22 AND b in ('y', 'z')")
+        assert one.fingerprint == two.fingerprint
+        assert len(one.fingerprint) == 16
+        int(one.fingerprint, 16)
+        assert normalize_statement('SELECT * FROM other').fingerprint != one.fingerprint
+        assert normalize_statement('SELECT ?').fingerprint == 'd41673f80456e405'
+
+    def test_results_are_memoized(self):
+        query = 'SELECT * FROM memoized_table WHERE a = 1'
+        assert normalize_statement(query) is normalize_statement(query)
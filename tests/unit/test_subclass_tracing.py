@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from functools import partial
+import sqlite3
+
+from opentracing.mocktracer import MockTracer
+from opentracing.ext import tags
+import pytest
+
+from dbapi_opentracing import ConnectionTracing, SubclassConnectionTracing
+from dbapi_opentracing.subclass_tracing import _SubclassCursorTracing, traced_subclass
+
+
+class PureCursor(object):
+    """pymysql-like cursor, whose executemany() executes each statement."""
+    rowcount = 1
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.executed = []
+
+    def execute(self, query, args=None):
+        self.executed.append(query)
+
+    def executemany(self, query, args):
+        for arg in args:
+            self.execute(query, arg)
+
+    def close(self):
+        pass
+
+
+class PureConnection(object):
+    """pymysql-like connection, creating instances of its `cursorclass` attribute."""
+
+    def __init__(self, host, cursorclass=PureCursor):
+        self.host = host
+        self.cursorclass = cursorclass
+
+    def cursor(self, cursor=None):
+        return (cursor or self.cursorclass)(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class RowTypeConnection(PureConnection):
+    """Connection whose cursor() also accepts a non cursor class argument."""
+
+    def cursor(self, cursor=None, row_type=tuple):
+        cursor = PureConnection.cursor(self, cursor)
+        cursor.row_type = row_type
+        return cursor
+
+
+class FinalConnection(PureConnection):
+
+    def __init_subclass__(cls, **kwargs):
+        raise TypeError('final')
+
+
+class TestSubclassConnectionTracing(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+
+    def test_sqlite3_connections_and_cursors_are_subclassed(self):
+        connection = sqlite3.connect(':memory:', factory=partial(SubclassConnectionTracing, tracer=self.tracer,
+                                                                 connection_factory=sqlite3.Connection))
+        assert isinstance(connection, sqlite3.Connection)
+        connection.execute('CREATE TABLE some_table (a INTEGER)')
+        cursor = connection.cursor()
+        assert isinstance(cursor, sqlite3.Cursor)
+        assert isinstance(cursor, _SubclassCursorTracing)
+        cursor.executemany('INSERT INTO some_table VALUES (?)', [(1,), (2,)])
+        cursor.execute('SELECT * FROM some_table')
+        assert cursor.fetchall() == [(1,), (2,)]
+        connection.commit()
+
+        spans = self.tracer.finished_spans()
+        assert [span.operation_name for span in spans] == [
+            'Cursor.execute(CREATE)', 'Cursor.executemany(INSERT)', 'Cursor.execute(SELECT)', 'Connection.commit()'
+        ]
+        assert spans[1].tags['db.batch.size'] == 2
+        assert spans[2].tags[tags.DATABASE_STATEMENT] == 'SELECT * FROM some_table'
+
+    def test_cursor_class_attributes_are_subclassed(self):
+        connection = SubclassConnectionTracing('localhost', connection_factory=PureConnection, tracer=self.tracer,
+                                               span_tags=dict(one=1))
+        assert isinstance(connection, PureConnection)
+        assert connection.host == 'localhost'
+        assert connection.cursorclass is traced_subclass(PureCursor, _SubclassCursorTracing)
+        assert SubclassConnectionTracing('other', connection_factory=PureConnection,
+                                         tracer=MockTracer()).__class__ is connection.__class__
+
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO some_table VALUES (%s)', [(1,), (2,)])
+        assert cursor.executed == ['INSERT INTO some_table VALUES (%s)'] * 2
+        # Driver executions of executemany() are not traced separately
+        span, = self.tracer.finished_spans()
+        assert span.operation_name == 'PureCursor.executemany(INSERT)'
+        assert span.tags['one'] == 1
+
+    def test_cursor_arguments_are_reassigned(self):
+        connection = SubclassConnectionTracing('localhost', connection_factory=PureConnection, tracer=self.tracer)
+        cursor = connection.cursor(PureCursor, trace_execute=False)
+        assert isinstance(cursor, _SubclassCursorTracing)
+        cursor.execute('SELECT 1')
+        assert not self.tracer.finished_spans()
+
+    def test_only_cursor_class_arguments_are_reassigned(self):
+        connection = SubclassConnectionTracing('localhost', connection_factory=RowTypeConnection, tracer=self.tracer)
+        cursor = connection.cursor(cursor=PureCursor, row_type=dict)
+        assert isinstance(cursor, _SubclassCursorTracing)
+        assert cursor.row_type is dict
+        cursor = connection.cursor(None, list)
+        assert isinstance(cursor, _SubclassCursorTracing)
+        assert cursor.row_type is list
+
+    def test_subclasses_only_define_enabled_methods(self):
+        connection = SubclassConnectionTracing('localhost', connection_factory=PureConnection, tracer=self.tracer,
+                                               trace_rollback=False)
+        assert 'commit' in connection.__class__.__dict__
+        assert 'rollback' not in connection.__class__.__dict__
+        assert 'execute' in connection.cursorclass.__dict__
+        assert 'fetchone' not in connection.cursorclass.__dict__
+
+        # Per cursor overrides are passed as cursor class argument for `cursorclass` drivers
+        cursor = connection.cursor(trace_execute=False, trace_fetch=True)
+        assert cursor.__class__ is traced_subclass(PureCursor, _SubclassCursorTracing, (False, True, True, True, False))
+        assert 'execute' not in cursor.__class__.__dict__
+        assert 'fetchone' in cursor.__class__.__dict__
+        cursor.execute('SELECT 1')
+        connection.rollback()
+        assert not self.tracer.finished_spans()
+
+    def test_unsubclassable_connections_are_proxied(self):
+        assert traced_subclass(FinalConnection, _SubclassCursorTracing) is None
+        connection = SubclassConnectionTracing('localhost', connection_factory=FinalConnection, tracer=self.tracer)
+        assert isinstance(connection, ConnectionTracing)
+        assert connection.host == 'localhost'
+        connection.cursor().execute('SELECT 1')
+        assert self.tracer.finished_spans().pop().operation_name == 'PureCursor.execute(SELECT)'
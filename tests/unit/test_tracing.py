@@ -1,13 +1,15 @@
 # Copyright (C) 2018-2019 SignalFx, Inc. All rights reserved.
 import types
+import weakref
 
 from opentracing.mocktracer import MockTracer
 from opentracing.ext import tags
 from mock import Mock, patch
+import opentracing
 import pytest
 
-from dbapi_opentracing.tracing import ConnectionTracing
-from .conftest import BaseSuite
+from dbapi_opentracing.tracing import ConnectionTracing, Cursor
+from .conftest import BaseSuite, is_traced
 
 
 row_count = 'SomeRowCount'
@@ -302,3 +304,534 @@ class TestConnectionTracing(object):
             assert span.tags[tags.SPAN_KIND] == tags.SPAN_KIND_RPC_CLIENT
             assert span.tags['one'] == 123
             assert span.tags['two'] == 234
+
+
+class TestConnectionTracingSpanTemplateCache(object):
+
+    def test_repeated_statements_use_cached_templates(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer, span_tags=dict(one=123))
+        statement = 'SELECT * FROM some_table'
+
+        with connection.cursor() as cursor:
+            cursor.execute(statement)
+            cursor.execute(statement)
+        with connection.cursor() as cursor:
+            cursor.execute(statement)
+            cursor.executemany(statement)
+
+        cache = connection.span_template_cache
+        assert cache.misses == 2
+        assert cache.hits == 2
+        assert len(cache) == 2
+
+        spans = tracer.finished_spans()
+        assert len(spans) == 4
+        for span in spans:
+            assert span.tags[tags.DATABASE_STATEMENT] == statement
+            assert span.tags['one'] == 123
+            assert span.tags['db.rows_produced'] == row_count
+        assert [span.operation_name for span in spans] == ['MockDBAPICursor.execute(SELECT)'] * 3 + [
+            'MockDBAPICursor.executemany(SELECT)'
+        ]
+
+    def test_cached_template_tags_are_not_mutated_by_spans(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        template = list(connection.span_template_cache._data.values())[0]
+        assert 'db.rows_produced' not in template.tags
+
+    def test_cache_size_is_bounded(self):
+        connection = ConnectionTracing(MockDBAPIConnection(), MockTracer(), span_template_cache_size=2)
+        with connection.cursor() as cursor:
+            for i in range(5):
+                cursor.execute('SELECT {}'.format(i))
+        assert len(connection.span_template_cache) == 2
+
+    def test_cache_can_be_disabled(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer, span_template_cache_size=0)
+        assert connection.span_template_cache is None
+        with connection.cursor() as cursor:
+            assert cursor.span_template_cache is None
+            cursor.execute('SELECT 1')
+        span = tracer.finished_spans().pop()
+        assert span.operation_name == 'MockDBAPICursor.execute(SELECT)'
+
+
+class TestConnectionTracingSQLTags(DBAPITestSuite):
+
+    def test_statement_verb_and_table_are_tagged(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('/* report */\nwith t AS (SELECT 1) select * from t')
+            cursor.executemany(b'INSERT INTO some_table VALUES (%s)', [(1,), (2,)])
+            cursor.callproc('my_procedure')
+        execute, executemany, callproc = self.tracer.finished_spans()
+
+        assert execute.operation_name == 'MockDBAPICursor.execute(select)'
+        assert execute.tags['db.sql.verb'] == 'SELECT'
+        assert execute.tags['db.sql.table'] == 't'
+        assert executemany.operation_name == 'MockDBAPICursor.executemany(INSERT)'
+        assert executemany.tags['db.sql.verb'] == 'INSERT'
+        assert executemany.tags['db.sql.table'] == 'some_table'
+        assert callproc.operation_name == 'MockDBAPICursor.callproc(my_procedure)'
+        assert 'db.sql.verb' not in callproc.tags
+
+
+class TestConnectionTracingStatementMode(object):
+
+    def test_normalized_statements(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer, statement_mode='normalized')
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT * FROM some_table WHERE id IN (1, 2) AND name = 'name'")
+            cursor.execute("SELECT * FROM some_table WHERE id IN (3) AND name = 'other'")
+        one, two = tracer.finished_spans()
+        assert one.tags[tags.DATABASE_STATEMENT] == 'SELECT * FROM some_table WHERE id IN (...) AND name = ?'
+        assert two.tags[tags.DATABASE_STATEMENT] == one.tags[tags.DATABASE_STATEMENT]
+        assert two.tags['db.sql.fingerprint'] == one.tags['db.sql.fingerprint']
+
+    def test_fingerprint_only_statements(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer, statement_mode='fingerprint')
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        span = tracer.finished_spans().pop()
+        assert tags.DATABASE_STATEMENT not in span.tags
+        assert len(span.tags['db.sql.fingerprint']) == 16
+
+    def test_raw_statements_are_default(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        span = tracer.finished_spans().pop()
+        assert span.tags[tags.DATABASE_STATEMENT] == 'SELECT 1'
+        assert 'db.sql.fingerprint' not in span.tags
+
+    def test_invalid_statement_mode(self):
+        with pytest.raises(ValueError):
+            ConnectionTracing(MockDBAPIConnection(), MockTracer(), statement_mode='unknown')
+
+
+class TestConnectionTracingSlowQueryThreshold(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+
+    def connection(self, threshold):
+        return ConnectionTracing(MockDBAPIConnection(), self.tracer, slow_query_threshold=threshold)
+
+    def test_fast_executions_are_not_traced(self):
+        with self.connection(60).cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.executemany('INSERT INTO some_table VALUES (%s)', [(1,)])
+        assert not self.tracer.finished_spans()
+
+    def test_slow_executions_are_traced(self):
+        with self.connection(0).cursor() as cursor:
+            cursor.execute('SELECT * FROM some_table')
+        span = self.tracer.finished_spans().pop()
+        assert span.operation_name == 'MockDBAPICursor.execute(SELECT)'
+        assert span.tags[tags.DATABASE_STATEMENT] == 'SELECT * FROM some_table'
+        assert span.tags['db.rows_produced'] == row_count
+        assert 0 < span.start_time <= span.finish_time
+
+    def test_failed_executions_are_traced(self):
+        error = SomeException('message')
+        with self.connection(60).cursor() as cursor:
+            with patch.object(MockDBAPICursor, 'execute', side_effect=error) as execute:
+                execute.__name__ = 'execute'
+                with pytest.raises(SomeException):
+                    cursor.execute('SELECT 1')
+        span = self.tracer.finished_spans().pop()
+        assert span.operation_name == 'MockDBAPICursor.execute(SELECT)'
+        assert span.tags[tags.ERROR] is True
+        assert span.tags['sfx.error.kind'] == 'SomeException'
+        assert len(span.tags['sfx.error.stack']) > 50
+        assert 'db.rows_produced' not in span.tags
+
+    def test_executions_with_sampled_parent_are_traced(self):
+        with self.tracer.start_active_span('unsampled') as scope:
+            scope.span.is_sampled = lambda: False
+            with self.connection(60).cursor() as cursor:
+                cursor.execute('SELECT 1')
+        assert len(self.tracer.finished_spans()) == 1
+
+        for is_sampled in (lambda: True, None):
+            with self.tracer.start_active_span('sampled') as scope:
+                if is_sampled is not None:
+                    scope.span.is_sampled = is_sampled
+                with self.connection(60).cursor() as cursor:
+                    cursor.execute('SELECT 1')
+            execute, parent = self.tracer.finished_spans()[-2:]
+            assert execute.parent_id == parent.context.span_id
+            assert execute.operation_name == 'MockDBAPICursor.execute(SELECT)'
+        assert len(self.tracer.finished_spans()) == 5
+
+
+class TestConnectionTracingLeafSpans(BaseSuite):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+        self.connection = ConnectionTracing(MockDBAPIConnection(), self.tracer, span_tags=dict(one=1),
+                                            leaf_spans=True)
+
+    def test_executions_are_not_activated(self):
+        with self.tracer.start_active_span('parent') as scope:
+            with patch.object(self.tracer.scope_manager, 'activate') as activate:
+                with self.connection.cursor() as cursor:
+                    cursor.execute('SELECT * FROM some_table')
+                self.connection.commit()
+        assert not activate.called
+
+        execute, commit, parent = self.tracer.finished_spans()
+        self.assert_base_tags([execute, commit])
+        assert execute.operation_name == 'MockDBAPICursor.execute(SELECT)'
+        assert execute.tags['db.sql.table'] == 'some_table'
+        assert execute.tags['db.rows_produced'] == row_count
+        assert execute.tags['one'] == commit.tags['one'] == 1
+        assert commit.operation_name == 'MockDBAPIConnection.commit()'
+        assert execute.parent_id == commit.parent_id == scope.span.context.span_id
+        assert 0 < execute.start_time <= execute.finish_time <= commit.start_time
+
+    def test_span_tags_are_provided_upfront(self):
+        with patch.object(self.tracer, 'start_span', wraps=self.tracer.start_span) as start_span:
+            with self.connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        assert start_span.call_args[1]['tags']['db.rows_produced'] == row_count
+
+    def test_failed_executions_are_tagged(self):
+        with self.connection.cursor() as cursor:
+            with patch.object(MockDBAPICursor, 'execute', side_effect=SomeException('message')) as execute:
+                execute.__name__ = 'execute'
+                with pytest.raises(SomeException):
+                    cursor.execute('SELECT 1')
+        span, = self.tracer.finished_spans()
+        assert span.tags[tags.ERROR] is True
+        assert 'db.rows_produced' not in span.tags
+
+    def test_template_tags_are_not_mutated(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.execute('SELECT 1')
+        template, = self.connection.span_template_cache._data.values()
+        assert 'db.rows_produced' not in template.tags
+
+
+class TestConnectionTracingFastPaths(object):
+
+    def test_noop_tracer_passes_calls_through(self):
+        connection = ConnectionTracing(MockDBAPIConnection(), opentracing.Tracer(), trace_fetch=True)
+        assert 'commit' not in type(connection).__dict__
+        assert not connection._self_trace_commit
+        cursor = connection.cursor(trace_execute=True)
+        assert cursor._self_config is connection._self_cursor_config
+        assert not is_traced(cursor, 'execute')
+        assert not is_traced(cursor, 'fetchone')
+        assert not is_traced(Cursor(MockDBAPICursor(), opentracing.Tracer()), 'execute')
+
+    def test_global_noop_tracer_is_detected(self):
+        class ExecutingCursor(Cursor):
+            __slots__ = ()
+
+            def execute(self, *args, **kwargs):
+                return super(ExecutingCursor, self).execute(*args, **kwargs)
+
+        with patch.object(opentracing, 'tracer', opentracing.Tracer()):
+            assert not is_traced(Cursor(MockDBAPICursor()), 'execute')
+            cursor = ExecutingCursor(MockDBAPICursor())
+            cursor.execute('SELECT 1')
+            cursor.__wrapped__.execute.assert_called_with('SELECT 1')
+        assert is_traced(Cursor(MockDBAPICursor(), MockTracer()), 'execute')
+
+    def test_unsampled_parent_executions_are_not_traced(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer)
+        with tracer.start_active_span('unsampled') as scope:
+            scope.span.is_sampled = lambda: False
+            with connection.cursor() as cursor:
+                with patch.object(cursor, '_get_span_template') as get_span_template:
+                    cursor.execute('SELECT 1')
+                assert not get_span_template.called
+            connection.commit()
+        unsampled, = tracer.finished_spans()
+        assert unsampled.operation_name == 'unsampled'
+
+        with tracer.start_active_span('sampled') as scope:
+            scope.span.is_sampled = lambda: True
+            connection.commit()
+        assert len(tracer.finished_spans()) == 3
+
+
+class TestConnectionTracingMaxStatementLength(object):
+
+    def test_statements_are_truncated(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer, max_statement_length=10)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT * FROM some_table')
+            cursor.execute(u'SELECT \xe4 FROM t'.encode('utf8') + b'\x00' * 10 ** 6)
+            cursor.execute(u'SELECT \xe4\xe4\xe4 FROM t'.encode('utf8'))
+            cursor.execute('SELECT 1')
+        text, large, partial, short = tracer.finished_spans()
+
+        assert text.tags[tags.DATABASE_STATEMENT] == 'SELECT * F'
+        assert text.tags['db.statement.truncated'] is True
+        assert text.tags['db.sql.table'] == 'some_table'
+        assert large.tags[tags.DATABASE_STATEMENT] == u'SELECT \xe4 '
+        assert large.tags['db.statement.truncated'] is True
+        # Partially included trailing characters are omitted
+        assert partial.tags[tags.DATABASE_STATEMENT] == u'SELECT \xe4'
+        assert short.tags[tags.DATABASE_STATEMENT] == 'SELECT 1'
+        assert 'db.statement.truncated' not in short.tags
+
+
+class TestConnectionTracingExecutemanyBatch(object):
+
+    @staticmethod
+    def consume(statement, parameters):
+        for _ in parameters:
+            pass
+
+    def test_generator_parameters_are_counted_lazily(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer, measure_batch_bytes=True)
+        parameters = ((i, 'name') for i in range(1000))
+        with patch.object(MockDBAPICursor, 'executemany', side_effect=self.consume) as executemany:
+            executemany.__name__ = 'executemany'
+            with connection.cursor() as cursor:
+                cursor.executemany('INSERT INTO some_table VALUES (%s, %s)', parameters)
+        passed = executemany.call_args[0][1]
+        assert passed is not parameters
+        assert not isinstance(passed, list)
+
+        span = tracer.finished_spans().pop()
+        assert span.tags['db.batch.size'] == 1000
+        assert span.tags['db.batch.bytes'] == 1000 * (8 + 4)
+        assert span.tags['db.batch.rows_per_second'] > 0
+
+    def test_sequence_parameters_are_passed_unchanged(self):
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer)
+        parameters = [dict(a=1, b=b'bytes'), dict(a=2, b=None)]
+        with patch.object(MockDBAPICursor, 'executemany', side_effect=self.consume) as executemany:
+            executemany.__name__ = 'executemany'
+            with connection.cursor() as cursor:
+                cursor.executemany('INSERT INTO some_table VALUES (%(a)s, %(b)s)', parameters)
+        assert executemany.call_args[0][1] is parameters
+
+        span = tracer.finished_spans().pop()
+        assert span.tags['db.batch.size'] == 2
+        assert 'db.batch.bytes' not in span.tags
+
+    def test_partially_consumed_parameters_are_counted_on_error(self):
+        def fail(statement, parameters):
+            next(parameters)
+            raise SomeException('message')
+
+        tracer = MockTracer()
+        connection = ConnectionTracing(MockDBAPIConnection(), tracer, measure_batch_bytes=True)
+        with patch.object(MockDBAPICursor, 'executemany', side_effect=fail) as executemany:
+            executemany.__name__ = 'executemany'
+            with connection.cursor() as cursor:
+                with pytest.raises(SomeException):
+                    cursor.executemany('INSERT INTO some_table VALUES (%s)', iter([(b'abc',), (b'def',)]))
+        span = tracer.finished_spans().pop()
+        assert span.tags[tags.ERROR] is True
+        assert span.tags['db.batch.size'] == 1
+        assert span.tags['db.batch.bytes'] == 3
+
+
+class RowsCursor(object):
+    """DB API cursor producing `rows` after each execution."""
+    rowcount = -1
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.remaining = []
+        self.closed = False
+
+    def execute(self, statement, *args):
+        self.remaining = list(self.rows)
+
+    def fetchone(self):
+        return self.remaining.pop(0) if self.remaining else None
+
+    def fetchmany(self, size=2):
+        rows, self.remaining = self.remaining[:size], self.remaining[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.remaining = self.remaining, []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self.closed = True
+
+
+class TestCursorFetch(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+        self.cursor = Cursor(RowsCursor([(1,), (2,), (3,)]), self.tracer, trace_fetch=True)
+
+    def fetch_span(self):
+        execute, fetch = self.tracer.finished_spans()
+        assert execute.operation_name == 'RowsCursor.execute(SELECT)'
+        assert fetch.operation_name == 'RowsCursor.fetch(SELECT)'
+        assert fetch.parent_id == execute.context.span_id
+        assert fetch.tags[tags.DATABASE_STATEMENT] == 'SELECT * FROM some_table'
+        assert fetch.start_time >= execute.finish_time
+        return fetch
+
+    def test_fetchone_calls_are_aggregated(self):
+        self.cursor.execute('SELECT * FROM some_table')
+        while self.cursor.fetchone() is not None:
+            pass
+        fetch = self.fetch_span()
+        assert fetch.tags['db.fetch.rows'] == 3
+        assert fetch.tags['db.fetch.time_to_first_row'] >= 0
+
+    def test_fetchmany_and_fetchall_are_aggregated(self):
+        self.cursor.execute('SELECT * FROM some_table')
+        assert self.cursor.fetchmany() == [(1,), (2,)]
+        assert len(self.tracer.finished_spans()) == 1
+        assert self.cursor.fetchall() == [(3,)]
+        assert self.fetch_span().tags['db.fetch.rows'] == 3
+
+    def test_iteration_is_aggregated(self):
+        self.cursor.execute('SELECT * FROM some_table')
+        assert list(self.cursor) == [(1,), (2,), (3,)]
+        assert self.fetch_span().tags['db.fetch.rows'] == 3
+
+    def test_abandoned_iteration_is_reported_by_next_execution(self):
+        self.cursor.execute('SELECT * FROM some_table')
+        for row in self.cursor:
+            break
+        assert len(self.tracer.finished_spans()) == 1
+        self.cursor.execute('SELECT * FROM other_table')
+        execute, fetch, _ = self.tracer.finished_spans()
+        assert fetch.operation_name == 'RowsCursor.fetch(SELECT)'
+        assert fetch.tags['db.fetch.rows'] == 1
+        assert fetch.tags['db.sql.table'] == 'some_table'
+
+    def test_partial_fetch_is_reported_on_close(self):
+        self.cursor.execute('SELECT * FROM some_table')
+        self.cursor.fetchone()
+        self.cursor.close()
+        assert self.cursor.closed
+        assert self.fetch_span().tags['db.fetch.rows'] == 1
+
+    def test_empty_result(self):
+        self.cursor.__wrapped__.rows = []
+        self.cursor.execute('SELECT * FROM some_table')
+        assert self.cursor.fetchone() is None
+        fetch = self.fetch_span()
+        assert fetch.tags['db.fetch.rows'] == 0
+        assert 'db.fetch.time_to_first_row' not in fetch.tags
+
+    def test_unfetched_executions_have_no_fetch_span(self):
+        self.cursor.execute('SELECT * FROM some_table')
+        self.cursor.close()
+        assert len(self.tracer.finished_spans()) == 1
+
+    def test_fetch_is_not_traced_by_default(self):
+        cursor = Cursor(RowsCursor([(1,)]), self.tracer)
+        cursor.execute('SELECT * FROM some_table')
+        assert list(cursor) == [(1,)]
+        assert cursor.fetchall() == []
+        assert len(self.tracer.finished_spans()) == 1
+
+
+class TestSpecializedClasses(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+
+    def test_disabled_methods_are_passed_through(self):
+        connection = ConnectionTracing(MockDBAPIConnection(), self.tracer, trace_rollback=False)
+        assert isinstance(connection, ConnectionTracing)
+        assert is_traced(connection, 'commit')
+        assert not is_traced(connection, 'rollback')
+
+        cursor = connection.cursor(trace_execute=False)
+        assert isinstance(cursor, Cursor)
+        assert not is_traced(cursor, 'execute')
+        assert is_traced(cursor, 'executemany')
+        assert not is_traced(cursor, 'fetchone')
+        cursor.execute('SELECT 1')
+        cursor.__wrapped__.execute.assert_called_with('SELECT 1')
+        connection.rollback()
+        assert not self.tracer.finished_spans()
+
+    def test_classes_are_shared_per_flag_combination(self):
+        cursor = Cursor(MockDBAPICursor(), self.tracer, trace_fetch=True)
+        assert type(Cursor(MockDBAPICursor(), MockTracer(), trace_fetch=True)) is type(cursor)
+        assert type(Cursor(MockDBAPICursor(), self.tracer)) is not type(cursor)
+        assert type(cursor).__name__ == 'Cursor'
+
+    def test_subclass_methods_are_preserved(self):
+        class CountingCursor(Cursor):
+            __slots__ = ()
+            executions = 0
+
+            def execute(self, *args, **kwargs):
+                CountingCursor.executions += 1
+                return super(CountingCursor, self).execute(*args, **kwargs)
+
+        cursor = CountingCursor(MockDBAPICursor(), self.tracer)
+        assert isinstance(cursor, CountingCursor)
+        cursor.execute('SELECT 1')
+        assert CountingCursor.executions == 1
+        assert len(self.tracer.finished_spans()) == 1
+
+        # super() calls of disabled methods resolve to their pass-through
+        CountingCursor(MockDBAPICursor(), self.tracer, trace_execute=False).execute('SELECT 2')
+        assert CountingCursor.executions == 2
+        assert len(self.tracer.finished_spans()) == 1
+
+    def test_subclass_super_calls_of_disabled_connection_methods(self):
+        class CommittingConnection(ConnectionTracing):
+
+            def commit(self):
+                return super(CommittingConnection, self).commit()
+
+        wrapped = MockDBAPIConnection()
+        wrapped.commit = Mock(__name__='commit')
+        CommittingConnection(wrapped, self.tracer, trace_commit=False).commit()
+        wrapped.commit.assert_called_once_with()
+        assert not self.tracer.finished_spans()
+
+
+class TestConnectionTracingCursorConfig(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+        self.connection = ConnectionTracing(MockDBAPIConnection(), self.tracer)
+
+    def test_cursors_share_connection_config(self):
+        first, second = self.connection.cursor(), self.connection.cursor()
+        assert first._self_config is second._self_config
+        untraced = self.connection.cursor(trace_execute=False)
+        assert untraced._self_config is not first._self_config
+        assert untraced._self_config.trace_execute is False
+        assert untraced._self_config.span_template_cache is first._self_config.span_template_cache
+
+    def test_closed_cursor_wrappers_are_released(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        wrapper = weakref.ref(cursor)
+        del cursor
+        assert wrapper() is None
+        assert self.connection.cursor(trace_fetch=True)._self_config.trace_fetch is True
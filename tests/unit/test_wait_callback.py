@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+from threading import Thread, local
+from types import ModuleType
+import time
+
+from mock import Mock, patch
+from opentracing.mocktracer import MockTracer
+from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE
+import psycopg2
+import pytest
+
+from dbapi_opentracing import ConnectionTracing, TracedWaitCallback, tracing
+from dbapi_opentracing.wait_callback import _select_read, _select_write
+from .test_tracing import MockDBAPIConnection, MockDBAPICursor
+
+
+class PollingConnection(object):
+    """Green connection whose poll() returns its scripted states."""
+    OperationalError = psycopg2.OperationalError
+
+    def __init__(self, *states):
+        self.states = list(states)
+
+    def poll(self):
+        return self.states.pop(0)
+
+    def fileno(self):
+        return 3
+
+
+class TestTracedWaitCallback(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.tracer = MockTracer()
+        self.wait_read = Mock(side_effect=lambda fileno: time.sleep(.01))
+        self.wait_write = Mock()
+        self.callback = TracedWaitCallback(self.tracer, wait_read=self.wait_read, wait_write=self.wait_write)
+
+    def test_waits_are_tagged_on_active_span(self):
+        with self.tracer.start_active_span('execute'):
+            self.callback(PollingConnection(POLL_WRITE, POLL_READ, POLL_READ, POLL_OK))
+        span, = self.tracer.finished_spans()
+        assert span.tags['db.wait.count'] == 3
+        assert span.tags['db.wait.blocked_time'] >= .02
+        assert span.tags['db.wait.poll_time'] >= 0
+        self.wait_write.assert_called_once_with(3)
+        assert self.wait_read.call_count == 2
+
+    def test_waits_accumulate_until_another_span_is_active(self):
+        with self.tracer.start_active_span('commit'):
+            self.callback(PollingConnection(POLL_WRITE, POLL_OK))
+            self.callback(PollingConnection(POLL_READ, POLL_OK))
+        with self.tracer.start_active_span('rollback'):
+            self.callback(PollingConnection(POLL_OK))
+        commit, rollback = self.tracer.finished_spans()
+        assert commit.tags['db.wait.count'] == 2
+        assert rollback.tags['db.wait.count'] == 0
+
+    def test_totals_are_not_shared_between_threads(self):
+        def wait():
+            with self.tracer.start_active_span('other'):
+                self.callback(PollingConnection(POLL_READ, POLL_READ, POLL_OK))
+
+        with self.tracer.start_active_span('execute'):
+            self.callback(PollingConnection(POLL_READ, POLL_OK))
+            thread = Thread(target=wait)
+            thread.start()
+            thread.join()
+            self.callback(PollingConnection(POLL_READ, POLL_OK))
+        other, execute = self.tracer.finished_spans()
+        assert other.tags['db.wait.count'] == 2
+        assert execute.tags['db.wait.count'] == 2
+
+    def test_bad_poll_states_raise_and_tag_prior_waits(self):
+        with self.tracer.start_active_span('execute'):
+            with pytest.raises(psycopg2.OperationalError):
+                self.callback(PollingConnection(POLL_READ, 42))
+        span, = self.tracer.finished_spans()
+        assert span.tags['db.wait.count'] == 1
+
+    def test_traced_commit_span_is_tagged(self):
+        connection = MockDBAPIConnection()
+        connection.commit = lambda: self.callback(PollingConnection(POLL_READ, POLL_OK))
+        ConnectionTracing(connection, self.tracer).commit()
+        span, = self.tracer.finished_spans()
+        assert span.tags['db.wait.count'] == 1
+
+    def test_untraced_waits_are_not_tagged(self):
+        self.callback(PollingConnection(POLL_READ, POLL_OK))
+        assert not self.tracer.finished_spans()
+
+    @pytest.mark.parametrize('kwargs', [{'leaf_spans': True}, {'slow_query_threshold': 0}])
+    def test_unactivated_execution_spans_are_tagged(self, kwargs):
+        cursor = MockDBAPICursor()
+        cursor.execute = lambda *args: self.callback(PollingConnection(POLL_READ, POLL_READ, POLL_OK))
+        tracing = ConnectionTracing(MockDBAPIConnection(cursor=Mock(return_value=cursor)), self.tracer, **kwargs)
+        with self.tracer.start_active_span('parent'):
+            tracing.cursor().execute('SELECT 1')
+        execute, parent = self.tracer.finished_spans()
+        assert execute.tags['db.wait.count'] == 2
+        assert execute.tags['db.wait.blocked_time'] >= .02
+        assert 'db.wait.count' not in parent.tags
+
+    def test_failed_leaf_execution_spans_are_tagged(self):
+        def execute(*args):
+            self.callback(PollingConnection(POLL_READ, POLL_OK))
+            raise psycopg2.OperationalError()
+
+        cursor = MockDBAPICursor()
+        cursor.execute = execute
+        tracing = ConnectionTracing(MockDBAPIConnection(cursor=Mock(return_value=cursor)), self.tracer, leaf_spans=True)
+        with pytest.raises(psycopg2.OperationalError):
+            tracing.cursor().execute('SELECT 1')
+        span, = self.tracer.finished_spans()
+        assert span.tags['error'] is True
+        assert span.tags['db.wait.count'] == 1
+
+    def test_leaf_commit_spans_are_tagged(self):
+        connection = MockDBAPIConnection()
+        connection.commit = lambda: self.callback(PollingConnection(POLL_READ, POLL_OK))
+        tracing = ConnectionTracing(connection, self.tracer, leaf_spans=True)
+        with self.tracer.start_active_span('parent'):
+            tracing.commit()
+        commit, parent = self.tracer.finished_spans()
+        assert commit.tags['db.wait.count'] == 1
+        assert 'db.wait.count' not in parent.tags
+
+    def test_waits_select_unless_green(self):
+        callback = TracedWaitCallback(self.tracer)
+        assert callback._wait_read is _select_read
+        assert callback._wait_write is _select_write
+
+    def test_green_pending_waits_are_kept_per_greenlet(self, monkeypatch):
+        green_local = type('local', (local,), {})
+        gevent_local, gevent_socket = ModuleType('gevent.local'), ModuleType('gevent.socket')
+        gevent_local.local = green_local
+        gevent_socket.wait_read, gevent_socket.wait_write = self.wait_read, self.wait_write
+        monkeypatch.setattr(tracing, '_pending_waits', tracing._pending_waits)
+        with patch.dict('sys.modules', {'gevent': ModuleType('gevent'), 'gevent.local': gevent_local,
+                                        'gevent.socket': gevent_socket}):
+            callback = TracedWaitCallback(self.tracer, green=True)
+        assert isinstance(callback._totals, green_local)
+        assert isinstance(tracing._pending_waits, green_local)
+        assert callback._wait_read is self.wait_read
+        TracedWaitCallback(self.tracer)
+        assert isinstance(tracing._pending_waits, green_local)
+
+        connection = ConnectionTracing(MockDBAPIConnection(), self.tracer, leaf_spans=True)
+        MockDBAPICursor.execute.side_effect = lambda *args: callback(PollingConnection(POLL_READ, POLL_OK))
+        try:
+            connection.cursor().execute('SELECT 1')
+        finally:
+            MockDBAPICursor.execute.side_effect = None
+        span, = self.tracer.finished_spans()
+        assert span.tags['db.wait.count'] == 1
+
+    def test_pending_waits_are_only_kept_with_callbacks(self, monkeypatch):
+        monkeypatch.setattr(tracing, '_pending_waits', None)
+        connection = ConnectionTracing(MockDBAPIConnection(), self.tracer, leaf_spans=True)
+        connection.cursor().execute('SELECT 1')
+        connection.commit()
+        assert tracing._pending_waits is None
+        assert 'db.wait.count' not in self.tracer.finished_spans()[0].tags
+
+        TracedWaitCallback(self.tracer)
+        assert isinstance(tracing._pending_waits, local)
+        assert tracing._pending_waits.tags is None